@@ -0,0 +1,212 @@
+"""Benchmark of the whole app: seed a database with users and log entries,
+then drive the app in-process via the Flask test client, and through
+a real threaded WSGI server. Report req/s and percentiles of the latency,
+and store the results as JSON for comparison between commits.
+
+Scenarios:
+  login   POST /user/login; password check.
+  apikey  GET /api with an API key; get_current_user by apikey.
+  users   GET /api/user/; the first page of users.
+  logs    GET /api/user/<username>/logs; the first page of a user's logs.
+  save    POST /user/display/<username>/edit; UserSaver write of a user.
+"""
+
+import argparse
+import json
+import logging
+import os.path
+import re
+import tempfile
+import threading
+
+import base
+
+CSRF_TOKEN_RX = re.compile(r'name="_csrf_token" value="([^"]+)"')
+
+SCENARIOS = ["login", "apikey", "users", "logs", "save"]
+
+
+class TestClient:
+    "Requests in-process via the Flask test client."
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path, headers=None):
+        response = self.client.get(path, headers=headers)
+        return response.status_code, response.get_data(as_text=True)
+
+    def post(self, path, data):
+        response = self.client.post(path, data=data)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpClient:
+    "Requests over HTTP to a server, using a session for cookies."
+
+    def __init__(self, url, host):
+        import requests
+        self.url = url
+        self.session = requests.Session()
+        # The app builds URLs from SERVER_NAME; use it as host header.
+        self.session.headers["Host"] = host
+
+    def get(self, path, headers=None):
+        response = self.session.get(self.url + path, headers=headers,
+                                    allow_redirects=False)
+        return response.status_code, response.text
+
+    def post(self, path, data):
+        response = self.session.post(self.url + path, data=data,
+                                     allow_redirects=False)
+        return response.status_code, response.text
+
+
+def login(client, username):
+    "Login the client as the user. Return the CSRF token of the session."
+    status, text = client.get("/user/login")
+    token = CSRF_TOKEN_RX.search(text).group(1)
+    status, text = client.post("/user/login",
+                               data=dict(username=username,
+                                         password=base.PASSWORD,
+                                         _csrf_token=token))
+    assert status == 302, f"login of {username} failed: {status}"
+    return token
+
+def get_setup(scenario, get_client, usernames):
+    """Return the function setting up a client in a thread, and returning
+    the operation for the scenario.
+    """
+    admin = {"x-apikey": base.ADMIN_APIKEY}
+    users = usernames[1:] or usernames
+
+    def setup(rnd):
+        client = get_client()
+        if scenario == "login":
+            username = rnd.choice(users)
+            status, text = client.get("/user/login")
+            token = CSRF_TOKEN_RX.search(text).group(1)
+            data = dict(username=username,
+                        password=base.PASSWORD,
+                        _csrf_token=token)
+            return lambda: client.post("/user/login", data=data)[0] == 302
+        elif scenario == "apikey":
+            return lambda: client.get("/api", headers=admin)[0] == 200
+        elif scenario == "users":
+            return lambda: client.get("/api/user/", headers=admin)[0] == 200
+        elif scenario == "logs":
+            def operation():
+                path = f"/api/user/{rnd.choice(usernames)}/logs"
+                return client.get(path, headers=admin)[0] == 200
+            return operation
+        elif scenario == "save":
+            token = login(client, "admin")
+            def operation():
+                username = rnd.choice(users)
+                data = dict(email=f"{username}@example.com",
+                            role="user",
+                            apikey="true",
+                            _csrf_token=token)
+                path = f"/user/display/{username}/edit"
+                return client.post(path, data)[0] == 302
+            return operation
+        raise ValueError(f"no such scenario {scenario}")
+
+    return setup
+
+def run_scenarios(scenarios, get_client, usernames, runner):
+    "Run the scenarios using the clients, and return the results."
+    results = {}
+    for scenario in scenarios:
+        setup = get_setup(scenario, get_client, usernames)
+        result = results[scenario] = runner.run(setup)
+        if not result["requests"]:
+            print(f"  {scenario:8} no requests  errors {result['errors']}")
+            continue
+        print(f"  {scenario:8} {result['rps']:9.1f} req/s"
+              f"  p50 {result['p50_ms']:8.2f}"
+              f"  p95 {result['p95_ms']:8.2f}"
+              f"  p99 {result['p99_ms']:8.2f} ms"
+              f"  errors {result['errors']}")
+    return results
+
+def run_server(app):
+    "Start a threaded WSGI server for the app. Return it and its URL."
+    import werkzeug.serving
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = werkzeug.serving.make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+def get_parser():
+    "Get the parser for the command line interface."
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+    p.add_argument("-u", "--users", type=int, default=1000,
+                   help="Number of users to seed.")
+    p.add_argument("-l", "--logs", type=int, default=10000,
+                   help="Number of log entries to seed.")
+    p.add_argument("-n", "--requests", type=int, default=1000,
+                   help="Number of requests per scenario.")
+    p.add_argument("-c", "--concurrency", type=int, default=4,
+                   help="Number of concurrent client threads.")
+    p.add_argument("-s", "--scenario", action="append", choices=SCENARIOS,
+                   help="Scenario to run; may be repeated. Default: all.")
+    p.add_argument("-m", "--mode", choices=["client", "server", "both"],
+                   default="both",
+                   help="In-process test client, WSGI server, or both.")
+    p.add_argument("-S", "--settings", metavar="FILE",
+                   help="JSON file of app settings to use, e.g. to compare.")
+    p.add_argument("-d", "--dirpath",
+                   help="Directory for the database; default temporary.")
+    p.add_argument("-o", "--output", metavar="FILE",
+                   help="JSON file for the results; default"
+                   " 'bench/results/<commit>.json'.")
+    return p
+
+def main():
+    args = get_parser().parse_args()
+    settings = None
+    if args.settings:
+        with open(args.settings) as infile:
+            settings = json.load(infile)
+    dirpath = args.dirpath or tempfile.mkdtemp(prefix="webapp-bench-")
+    app = base.get_app(dirpath, settings)
+    print(f"seeding {args.users} users, {args.logs} log entries in {dirpath}")
+    usernames = base.seed(app, args.users, args.logs)
+    runner = base.Runner(args.requests, args.concurrency)
+    scenarios = args.scenario or SCENARIOS
+    results = dict(environment=base.get_environment(),
+                   parameters=dict(users=args.users,
+                                   logs=args.logs,
+                                   requests=args.requests,
+                                   concurrency=args.concurrency,
+                                   settings=settings),
+                   results={})
+    if args.mode in ("client", "both"):
+        print("test client")
+        results["results"]["client"] = run_scenarios(
+            scenarios, lambda: TestClient(app), usernames, runner)
+    if args.mode in ("server", "both"):
+        server, url = run_server(app)
+        print(f"server {url}")
+        try:
+            results["results"]["server"] = run_scenarios(
+                scenarios,
+                lambda: HttpClient(url, app.config["SERVER_NAME"]),
+                usernames, runner)
+        finally:
+            server.shutdown()
+    output = args.output
+    if not output:
+        name = (results["environment"]["commit"] or "unknown")[:12]
+        if results["environment"]["dirty"]:
+            name += "-dirty"
+        output = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "results", f"{name}.json")
+    base.write_results(output, results)
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
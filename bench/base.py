@@ -0,0 +1,200 @@
+"""Base for the benchmarks of the whole app: seeding a database,
+running timed operations concurrently, and recording the results.
+"""
+
+import json
+import os
+import os.path
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIRPATH)
+
+# The password of all seeded users.
+PASSWORD = "benchmark"
+
+# The API key of the seeded admin user.
+ADMIN_APIKEY = "0" * 32
+
+def get_app(dirpath, settings=None):
+    "Write a settings file in the directory, and return an app using it."
+    filepath = os.path.join(dirpath, "settings.json")
+    with open(filepath, "w") as outfile:
+        json.dump(get_settings(dirpath, settings), outfile, indent=2)
+    os.environ["SETTINGS_FILEPATH"] = filepath
+    import webapp.main
+    return webapp.main.create_app()
+
+def get_settings(dirpath, settings=None):
+    "Return the settings for the app; modified by those given."
+    result = dict(SECRET_KEY="benchmark",
+                  SERVER_NAME="localhost",
+                  SQLITE3_FILEPATH=os.path.join(dirpath, "bench.sqlite3"),
+                  MAIL_SERVER=None,
+                  USER_ENABLE_IMMEDIATELY=True)
+    result.update(settings or {})
+    return result
+
+def seed(app, users, logs):
+    """Insert an admin user, 'users' ordinary users 'user0', 'user1',...,
+    and 'logs' log entries spread evenly over the users.
+    All have the same password. Return the list of usernames.
+    """
+    from werkzeug.security import generate_password_hash
+    import webapp.user
+    from webapp import constants
+    from webapp import jsoncodec
+    from webapp import logstore
+    from webapp import utils
+
+    config = app.config
+    kwargs = dict(salt_length=config["SALT_LENGTH"])
+    if config["PASSWORD_HASH_METHOD"]:
+        kwargs["method"] = config["PASSWORD_HASH_METHOD"]
+    pwhash = generate_password_hash(PASSWORD, **kwargs)
+    with app.app_context():
+        now = utils.get_time()
+        rows = [dict(iuid=utils.get_iuid(),
+                     username="admin",
+                     email="admin@example.com",
+                     role=constants.ADMIN,
+                     status=constants.ENABLED,
+                     password=pwhash,
+                     apikey=ADMIN_APIKEY,
+                     created=now,
+                     modified=now)]
+        for n in range(users):
+            rows.append(dict(iuid=utils.get_iuid(),
+                             username=f"user{n}",
+                             email=f"user{n}@example.com",
+                             role=constants.USER,
+                             status=constants.ENABLED,
+                             password=pwhash,
+                             apikey=utils.get_iuid(),
+                             created=now,
+                             modified=now))
+        keys = webapp.user.KEYS
+        with utils.connection() as db, db:
+            db.executemany(f"INSERT INTO users ({','.join(keys)})"
+                           f" VALUES ({','.join('?'*len(keys))})",
+                           [[row[k] for k in keys] for row in rows])
+            chunk = []
+            for n in range(logs):
+                row = rows[n % len(rows)]
+                diff = {"updated": {"email": {"new_value": f"new{n}@example.com",
+                                              "old_value": row["email"]}}}
+                chunk.append([utils.get_iuid(),
+                              row["iuid"],
+                              jsoncodec.dumps(diff),
+                              utils.get_time(offset=n - logs),
+                              "admin",
+                              "127.0.0.1",
+                              "bench"])
+                if len(chunk) >= 10000:
+                    logstore.add(db, chunk)
+                    chunk = []
+            if chunk:
+                logstore.add(db, chunk)
+    return [row["username"] for row in rows]
+
+
+class Runner:
+    """Run an operation a number of times in concurrent threads,
+    and record the duration of each.
+    """
+
+    def __init__(self, count, concurrency):
+        self.count = count
+        self.concurrency = concurrency
+
+    def run(self, setup):
+        """Call 'setup' once in each thread to get the operation; a callable
+        returning True if successful. Return a summary of the timings.
+        """
+        lock = threading.Lock()
+        remaining = [self.count]
+        durations = []
+        errors = [0]
+        operations = [setup(random.Random(n)) for n in range(self.concurrency)]
+        def work(operation):
+            while True:
+                with lock:
+                    if remaining[0] <= 0: return
+                    remaining[0] -= 1
+                start = time.perf_counter()
+                ok = operation()
+                duration = time.perf_counter() - start
+                with lock:
+                    durations.append(duration)
+                    if not ok:
+                        errors[0] += 1
+        threads = [threading.Thread(target=work, args=(operation,))
+                   for operation in operations]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return summary(durations, errors[0], time.perf_counter() - start)
+
+def summary(durations, errors, seconds):
+    """Return a dictionary summarizing the durations; times in milliseconds.
+    The rate and the times are not included if there were no requests.
+    """
+    durations = sorted(durations)
+    count = len(durations)
+    result = dict(requests=count, errors=errors, seconds=round(seconds, 3))
+    if not count:
+        return result
+    result.update(rps=round(count / seconds, 1),
+                  mean_ms=round(1000 * sum(durations) / count, 3),
+                  p50_ms=round(1000 * percentile(durations, 0.50), 3),
+                  p95_ms=round(1000 * percentile(durations, 0.95), 3),
+                  p99_ms=round(1000 * percentile(durations, 0.99), 3),
+                  max_ms=round(1000 * durations[-1], 3))
+    return result
+
+def percentile(durations, q):
+    "Return the nearest-rank percentile of the sorted durations."
+    rank = max(1, int(round(q * len(durations) + 0.5)))
+    return durations[min(rank, len(durations)) - 1]
+
+def get_commit():
+    """Return the current git commit, and whether the working tree has
+    uncommitted changes. None if not available.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"],
+                                cwd=ROOT_DIRPATH, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain",
+                                 "--untracked-files=no"],
+                                cwd=ROOT_DIRPATH, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status)
+
+def get_environment():
+    "Return information about the environment of the benchmark."
+    commit, dirty = get_commit()
+    return dict(commit=commit,
+                dirty=dirty,
+                time=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                python=platform.python_version(),
+                sqlite=sqlite3.sqlite_version,
+                platform=platform.platform(),
+                cpus=os.cpu_count())
+
+def write_results(filepath, results):
+    "Write the results as JSON to the file; create its directory if needed."
+    dirpath = os.path.dirname(os.path.abspath(filepath))
+    os.makedirs(dirpath, exist_ok=True)
+    with open(filepath, "w") as outfile:
+        json.dump(results, outfile, indent=2)
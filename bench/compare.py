@@ -0,0 +1,43 @@
+"""Compare two results files of 'bench/app.py', e.g. from two commits.
+Show the req/s and p95 latency of each scenario, and the change.
+"""
+
+import argparse
+import json
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("before", help="Results JSON file; the baseline.")
+    parser.add_argument("after", help="Results JSON file to compare.")
+    args = parser.parse_args()
+    with open(args.before) as infile:
+        before = json.load(infile)
+    with open(args.after) as infile:
+        after = json.load(infile)
+    print(f"before {before['environment']['commit']}")
+    print(f"after  {after['environment']['commit']}")
+    for mode, scenarios in after["results"].items():
+        print(mode)
+        for scenario, new in scenarios.items():
+            try:
+                old = before["results"][mode][scenario]
+            except KeyError:
+                continue
+            if "rps" not in old or "rps" not in new:
+                print(f"  {scenario:8} no requests")
+                continue
+            print(f"  {scenario:8}"
+                  f" {old['rps']:9.1f} -> {new['rps']:9.1f} req/s"
+                  f" ({change(old['rps'], new['rps'])})"
+                  f"  p95 {old['p95_ms']:8.2f} -> {new['p95_ms']:8.2f} ms"
+                  f" ({change(old['p95_ms'], new['p95_ms'])})")
+
+def change(old, new):
+    "Return the relative change as a percentage string."
+    if not old: return "n/a"
+    return f"{100 * (new - old) / old:+.1f}%"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Benchmark: JSON output of log entries, by decode and re-encode of the
+stored diffs, versus inserting the stored diff text as-is (RawJSON).
+For each available JSON backend.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webapp import constants
+from webapp import jsoncodec
+
+
+def get_rows(count):
+    "Return rows of log entries as stored in the database."
+    rows = []
+    for n in range(count):
+        diff = {"updated": {"email": {"new_value": f"user{n}@new.org",
+                                      "old_value": f"user{n}@old.org"},
+                            "status": {"new_value": "enabled",
+                                       "old_value": "pending"}},
+                "added": {"apikey": "0123456789abcdef" * 2,
+                          "tags": [f"tag{i}" for i in range(10)]}}
+        rows.append(dict(diff=jsoncodec.dumps(diff),
+                         username="admin",
+                         remote_addr="127.0.0.1",
+                         user_agent="Mozilla/5.0 (X11; Linux x86_64)",
+                         timestamp="2021-01-01T00:00:00.000Z"))
+    return rows
+
+def decoded(rows):
+    "Decode each diff, then encode the whole."
+    logs = []
+    for row in rows:
+        item = dict(row)
+        item["diff"] = jsoncodec.loads(item["diff"])
+        logs.append(item)
+    return jsoncodec.dumps_bytes({"logs": logs})
+
+def passthrough(rows):
+    "Insert each diff text as-is."
+    logs = []
+    for row in rows:
+        item = dict(row)
+        item["diff"] = jsoncodec.RawJSON(item["diff"])
+        logs.append(item)
+    return jsoncodec.dumps_bytes({"logs": logs})
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--entries", type=int, default=1000,
+                        help="Number of log entries per response.")
+    parser.add_argument("-r", "--repeat", type=int, default=20,
+                        help="Number of responses to time.")
+    args = parser.parse_args()
+    rows = get_rows(args.entries)
+    backends = [constants.JSON_STDLIB]
+    if jsoncodec.orjson is not None:
+        backends.append(constants.JSON_ORJSON)
+    for backend in backends:
+        jsoncodec.set_backend(backend)
+        assert jsoncodec.loads(decoded(rows)) == jsoncodec.loads(passthrough(rows))
+        for func in [decoded, passthrough]:
+            seconds = min(timeit.repeat(lambda: func(rows),
+                                        number=args.repeat, repeat=3))
+            print(f"{backend:8} {func.__name__:12}"
+                  f" {1000 * seconds / args.repeat:8.3f} ms per response"
+                  f" of {args.entries} entries")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Benchmark: the diff of a large, deep document when a single field
+is changed. The previous approach, a deep copy of the whole document
+and a walk of the whole tree, versus the change-tracking BaseSaver.
+"""
+
+import argparse
+import copy
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webapp.saver import BaseSaver
+
+
+class Saver(BaseSaver):
+    EXCLUDE_PATHS = [["modified"], ["meta", "etag"]]
+    HIDDEN_VALUE_PATHS = [["password"], ["meta", "secret"]]
+
+
+def get_doc(depth, fanout):
+    "Return a document of nested dictionaries, with lists at the leaves."
+    def node(level):
+        if level == depth:
+            return [f"item{n}" for n in range(fanout)]
+        return dict((f"key{n}", node(level + 1)) for n in range(fanout))
+    doc = node(0)
+    doc.update(iuid="0" * 32, password="x", meta=dict(etag="x", secret="y"))
+    return doc
+
+def legacy(doc):
+    "The previous approach: deep copy, change one field, walk all."
+    original = copy.deepcopy(doc)
+    doc["key0"]["key0"]["key0"] = "changed"
+    stack = []
+    result = legacy_diff(stack, original, doc)
+    doc["key0"]["key0"]["key0"] = original["key0"]["key0"]["key0"]
+    return result
+
+def legacy_diff(stack, old, new):
+    "The previous diff, with list-membership checks of paths at each node."
+    added = {}
+    removed = {}
+    updated = {}
+    new_keys = set(new.keys())
+    old_keys = set(old.keys())
+    for key in new_keys.difference(old_keys):
+        stack.append(key)
+        if stack not in Saver.EXCLUDE_PATHS:
+            if stack in Saver.HIDDEN_VALUE_PATHS:
+                added[key] = "<hidden>"
+            else:
+                added[key] = new[key]
+        stack.pop()
+    for key in old_keys.difference(new_keys):
+        stack.append(key)
+        if stack not in Saver.EXCLUDE_PATHS:
+            if stack in Saver.HIDDEN_VALUE_PATHS:
+                removed[key] = "<hidden>"
+            else:
+                removed[key] = old[key]
+        stack.pop()
+    for key in new_keys.intersection(old_keys):
+        stack.append(key)
+        if stack not in Saver.EXCLUDE_PATHS:
+            new_value = new[key]
+            old_value = old[key]
+            if isinstance(new_value, dict) and isinstance(old_value, dict):
+                changes = legacy_diff(stack, old_value, new_value)
+                if changes:
+                    if stack in Saver.HIDDEN_VALUE_PATHS:
+                        updated[key] = "<hidden>"
+                    else:
+                        updated[key] = changes
+            elif new_value != old_value:
+                if stack in Saver.HIDDEN_VALUE_PATHS:
+                    updated[key] = dict(new_value="<hidden>",
+                                        old_value="<hidden>")
+                else:
+                    updated[key] = dict(new_value=new_value,
+                                        old_value=old_value)
+        stack.pop()
+    result = {}
+    if added:
+        result["added"] = added
+    if removed:
+        result["removed"] = removed
+    if updated:
+        result["updated"] = updated
+    return result
+
+def tracked(doc):
+    "The change-tracking saver: only the touched key is copied and compared."
+    saver = Saver(doc)
+    previous = saver["key0"]["key0"]["key0"]
+    saver["key0"]["key0"]["key0"] = "changed"
+    result = saver.get_diff()
+    doc["key0"]["key0"]["key0"] = previous
+    return result
+
+def tracked_list(doc):
+    "The change-tracking saver: one item inserted into a list."
+    saver = Saver(doc)
+    items = saver["key1"]
+    while isinstance(items, dict):
+        items = items["key1"]
+    items.insert(1, "inserted")
+    result = saver.get_diff()
+    items.pop(1)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-d", "--depth", type=int, default=5,
+                        help="Depth of the nested dictionaries.")
+    parser.add_argument("-f", "--fanout", type=int, default=6,
+                        help="Number of keys per dictionary.")
+    parser.add_argument("-r", "--repeat", type=int, default=10,
+                        help="Number of diffs to time.")
+    args = parser.parse_args()
+    doc = get_doc(args.depth, args.fanout)
+    print(f"document of {args.fanout ** (args.depth + 1)} leaf items,"
+          f" depth {args.depth}")
+    assert legacy(doc) == tracked(doc)
+    for func in [legacy, tracked, tracked_list]:
+        seconds = min(timeit.repeat(lambda: func(doc),
+                                    number=args.repeat, repeat=3))
+        print(f"{func.__name__:14} {1000 * seconds / args.repeat:10.3f} ms"
+              " per diff")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Benchmark of the startup of the app, as for each server worker
+and command-line invocation: each run is a new Python process.
+Times the import of 'webapp.main', and the creation of the app on
+a new database (tables created) and on an existing one (skipped).
+Fails if the median of import and creation on an existing database
+exceeds the budget.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import base
+
+# Budget in milliseconds for import and creation of the app.
+BUDGET_MS = 250
+
+def child():
+    "Run in the child process: import and create the app; print timings."
+    start = time.perf_counter()
+    import webapp.main
+    imported = time.perf_counter()
+    webapp.main.create_app()
+    created = time.perf_counter()
+    print(json.dumps(dict(import_ms=1000 * (imported - start),
+                          create_ms=1000 * (created - imported))))
+
+def run(dirpath, args=()):
+    """Run a child process. Return the timings, with the wall time
+    of the whole process.
+    """
+    env = dict(os.environ, SETTINGS_FILEPATH=os.path.join(dirpath,
+                                                          "settings.json"))
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, *args, __file__, "--child"],
+                             env=env, cwd=base.ROOT_DIRPATH,
+                             capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    result = json.loads(process.stdout.splitlines()[-1])
+    result["process_ms"] = 1000 * wall
+    return result, process.stderr
+
+def write_settings(dirpath):
+    "Write the settings file for a new database in the directory."
+    with open(os.path.join(dirpath, "settings.json"), "w") as outfile:
+        json.dump(base.get_settings(dirpath), outfile, indent=2)
+
+def get_imports(stderr, count):
+    """Return the slowest modules imported directly by 'webapp.main',
+    from the output of '-X importtime'. A module is listed after
+    those it imports, indented one level deeper.
+    """
+    result = []
+    pending = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"): continue
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit(): continue
+        name = parts[2].rstrip()
+        level = (len(name) - len(name.lstrip())) // 2
+        children = pending.pop(level + 1, [])
+        if name.strip() == "webapp.main":
+            result = children
+        pending.setdefault(level, []).append((int(parts[1]), name.strip()))
+    result.sort(reverse=True)
+    return result[:count]
+
+def summary(values):
+    "Return the median and max of the values, in milliseconds."
+    return dict(median_ms=round(statistics.median(values), 1),
+                max_ms=round(max(values), 1))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--child", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("-r", "--repeat", type=int, default=10,
+                        help="Number of processes for each case.")
+    parser.add_argument("-b", "--budget", type=float, default=BUDGET_MS,
+                        help="Budget in ms for import and creation of"
+                        " the app on an existing database.")
+    parser.add_argument("-i", "--imports", type=int, default=0,
+                        metavar="N", help="Show the N slowest imports.")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="JSON file for the results.")
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+    new = []
+    existing = []
+    for n in range(args.repeat):
+        with tempfile.TemporaryDirectory(prefix="webapp-startup-") as dirpath:
+            write_settings(dirpath)
+            new.append(run(dirpath)[0])
+            existing.append(run(dirpath)[0])
+    results = dict(environment=base.get_environment(),
+                   parameters=dict(repeat=args.repeat, budget_ms=args.budget),
+                   results={})
+    for case, timings in [("new", new), ("existing", existing)]:
+        results["results"][case] = dict(
+            (key[:-3], summary([t[key] for t in timings]))
+            for key in ["import_ms", "create_ms", "process_ms"])
+        results["results"][case]["startup"] = summary(
+            [t["import_ms"] + t["create_ms"] for t in timings])
+        print(f"{case:8}", "  ".join(f"{key} {value['median_ms']:7.1f} ms"
+                                     for key, value in
+                                     results["results"][case].items()))
+    if args.imports:
+        with tempfile.TemporaryDirectory(prefix="webapp-startup-") as dirpath:
+            write_settings(dirpath)
+            stderr = run(dirpath, ["-X", "importtime"])[1]
+        print("slowest imports")
+        for cumulative, name in get_imports(stderr, args.imports):
+            print(f"  {cumulative / 1000:7.1f} ms  {name}")
+    if args.output:
+        base.write_results(args.output, results)
+        print(f"results written to {args.output}")
+    startup = results["results"]["existing"]["startup"]["median_ms"]
+    if startup > args.budget:
+        sys.exit(f"startup {startup:.1f} ms exceeds budget {args.budget} ms")
+    print(f"startup {startup:.1f} ms within budget {args.budget} ms")
+
+
+if __name__ == "__main__":
+    main()
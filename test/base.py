@@ -24,6 +24,9 @@ DEFAULT_SETTINGS = {
 # The actual settings to use.
 SETTINGS = {}
 
+# Cache of the schemas fetched, for all tests; key is the URL.
+SCHEMAS = {}
+
 def process_args(filepath=None):
     """Process command-line arguments for this test suite.
     Reset the settings and read the given settings file.
@@ -55,7 +58,6 @@ class Base(unittest.TestCase):
     "Base class for Symbasis test cases."
 
     def setUp(self):
-        self.schemas = {}
         self.session = requests.Session()
         self.session.headers.update({'x-apikey': SETTINGS['APIKEY']})
         self.addCleanup(self.close_session)
@@ -95,12 +97,12 @@ class Base(unittest.TestCase):
         result = response.json()
         url = response.links['schema']['url']
         try:
-            schema = self.schemas[url]
+            schema = SCHEMAS[url]
         except KeyError:
             r = self.GET(url)
             self.assertEqual(r.status_code, http.client.OK)
             schema = r.json()
-            self.schemas[url] = schema
+            SCHEMAS[url] = schema
         self.validate_schema(result, schema)
         return result
 
@@ -0,0 +1,101 @@
+"""Test the bulk import of users from NDJSON.
+Runs in-process on a database of its own; no web server is needed.
+"""
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIRPATH)
+
+import flask
+
+import webapp.main
+import webapp.user
+from webapp import bulk
+from webapp import utils
+
+IUID = "0123456789abcdef0123456789abcdef"
+
+
+class Bulk(unittest.TestCase):
+    "Test the bulk import of users."
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dirpath = tempfile.mkdtemp()
+        filepath = os.path.join(cls.dirpath, "settings.json")
+        with open(filepath, "w") as outfile:
+            json.dump(dict(SECRET_KEY="test",
+                           SQLITE3_FILEPATH=os.path.join(cls.dirpath,
+                                                         "test.sqlite3"),
+                           JOBS_WORKERS=0),
+                      outfile)
+        os.environ["SETTINGS_FILEPATH"] = filepath
+        cls.app = webapp.main.create_app()
+
+    @classmethod
+    def tearDownClass(cls):
+        utils.get_pool(cls.app).close_all()
+        shutil.rmtree(cls.dirpath)
+
+    def setUp(self):
+        self.context = self.app.app_context()
+        self.context.push()
+        flask.g.db = utils.get_db()
+        self.addCleanup(self.cleanup)
+
+    def cleanup(self):
+        with flask.g.db:
+            flask.g.db.execute("DELETE FROM users")
+        utils.release_db()
+        self.context.pop()
+
+    def run_import(self, lines):
+        "Import the NDJSON lines; return the importer."
+        infile = io.StringIO("\n".join(lines) + "\n")
+        importer = bulk.Importer(workers=1)
+        return importer.run(bulk.read_users(infile, bulk.NDJSON))
+
+    def test_malformed(self):
+        "Malformed lines are reported, and the valid ones imported."
+        importer = self.run_import([
+            '{"username": "alice", "email": "alice@example.com"}',
+            '{"username": 1, "email": "one@example.com"}',
+            '{"username": "bob", "email": 5}',
+            '{"username": "carl", "email": "carl@example.com", "iuid": 5}',
+            '{"username": "dave", "email": "dave@example.com", "role": []}',
+            '{"username": "erik", ',
+            '["not", "an", "object"]',
+            '{"username": "fred", "email": "fred@example.com"}'])
+        self.assertEqual(importer.read, 8)
+        self.assertEqual(importer.imported, 2)
+        self.assertEqual([lineno for lineno, message in importer.errors],
+                         [2, 3, 4, 5, 6, 7])
+        self.assertIsNotNone(webapp.user.get_user(username="alice"))
+        self.assertIsNotNone(webapp.user.get_user(username="fred"))
+
+    def test_iuid_case(self):
+        "An iuid differing only in case is a duplicate."
+        importer = self.run_import([
+            f'{{"username": "alice", "email": "alice@example.com",'
+            f' "iuid": "{IUID.upper()}"}}',
+            f'{{"username": "bob", "email": "bob@example.com",'
+            f' "iuid": "{IUID}"}}'])
+        self.assertEqual(importer.imported, 1)
+        self.assertEqual(importer.errors[0][0], 2)
+        self.assertEqual(webapp.user.get_user(username="alice")["iuid"], IUID)
+        importer = self.run_import([
+            f'{{"username": "carl", "email": "carl@example.com",'
+            f' "iuid": "{IUID.upper()}"}}'])
+        self.assertEqual(importer.imported, 0)
+        self.assertEqual(importer.errors, [(1, "Iuid already in use.")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+"""Test the job queue sending mail, against the local SMTP stand-in.
+Runs in-process on a database of its own; no web server is needed.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIRPATH)
+
+import flask_mail
+
+import webapp.main
+from webapp import constants
+from webapp import jobs
+from webapp import smtpdebug
+from webapp import utils
+
+REFUSED = "refused@example.com"
+
+
+class Jobs(unittest.TestCase):
+    "Test the job queue sending mail."
+
+    @classmethod
+    def setUpClass(cls):
+        cls.smtp = smtpdebug.Server(("localhost", 0), refuse=[REFUSED]).start()
+        cls.dirpath = tempfile.mkdtemp()
+        filepath = os.path.join(cls.dirpath, "settings.json")
+        with open(filepath, "w") as outfile:
+            json.dump(dict(SECRET_KEY="test",
+                           SQLITE3_FILEPATH=os.path.join(cls.dirpath,
+                                                         "test.sqlite3"),
+                           MAIL_SERVER="localhost",
+                           MAIL_PORT=cls.smtp.port,
+                           MAIL_DEFAULT_SENDER="webapp@example.com",
+                           JOBS_WORKERS=0),
+                      outfile)
+        os.environ["SETTINGS_FILEPATH"] = filepath
+        cls.app = webapp.main.create_app()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.smtp.shutdown()
+        cls.smtp.server_close()
+        utils.get_pool(cls.app).close_all()
+        shutil.rmtree(cls.dirpath)
+
+    def setUp(self):
+        self.context = self.app.app_context()
+        self.context.push()
+        self.db = utils.get_db()
+        self.addCleanup(self.cleanup)
+
+    def cleanup(self):
+        with self.db:
+            self.db.execute("DELETE FROM jobs")
+        utils.get_pool().release(self.db)
+        self.context.pop()
+
+    def enqueue(self, recipient):
+        "Queue a mail message to the recipient; return the job id."
+        message = flask_mail.Message("Test", recipients=[recipient],
+                                     body="Test message.")
+        return jobs.enqueue(self.db, jobs.MAIL,
+                            dict(subject=message.subject,
+                                 recipients=message.recipients,
+                                 body=message.body,
+                                 sender=message.sender))
+
+    def get_job(self, id):
+        row = self.db.execute("SELECT * FROM jobs WHERE id=?",
+                              (id,)).fetchone()
+        return row and dict(row)
+
+    def test_send(self):
+        "Sent messages are removed from the queue."
+        count = len(self.smtp.messages)
+        ids = [self.enqueue(f"user{n}@example.com") for n in range(3)]
+        kind, sent, failed = jobs.run_once(self.db, "test", self.app.config)
+        self.assertEqual((kind, sent, failed), (jobs.MAIL, 3, 0))
+        self.assertEqual(len(self.smtp.messages), count + 3)
+        for id in ids:
+            self.assertIsNone(self.get_job(id))
+
+    def test_refused(self):
+        "A recipient refused by a 5xx reply fails at once; not retried."
+        ok = self.enqueue("user@example.com")
+        refused = self.enqueue(REFUSED)
+        kind, sent, failed = jobs.run_once(self.db, "test", self.app.config)
+        self.assertEqual((sent, failed), (2, 1))
+        self.assertIsNone(self.get_job(ok))
+        job = self.get_job(refused)
+        self.assertEqual(job["status"], constants.JOB_FAILED)
+        self.assertEqual(job["attempts"], 1)
+
+    def test_lock_lost(self):
+        "A worker does not record the outcome of jobs claimed by another."
+        id = self.enqueue("user@example.com")
+        kind, claimed = jobs.claim(self.db, "first", 10, 600)
+        self.assertEqual([job["id"] for job in claimed], [id])
+        # Lock timed out: the job is queued again and claimed by another.
+        kind, reclaimed = jobs.claim(self.db, "second", 10, -1)
+        self.assertEqual([job["id"] for job in reclaimed], [id])
+        jobs.finish(self.db, "first", claimed, [None], self.app.config)
+        job = self.get_job(id)
+        self.assertEqual(job["status"], constants.JOB_RUNNING)
+        self.assertEqual(job["locked_by"], "second")
+
+
+if __name__ == "__main__":
+    unittest.main()
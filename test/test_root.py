@@ -14,6 +14,16 @@ class Root(base.Base):
         response = self.GET(url)
         self.check_schema(response)
 
+    def test_schema_not_modified(self):
+        "Get the root schema, and then conditionally using its ETag."
+        response = self.GET(base.SETTINGS['ROOT_URL'])
+        url = response.links['schema']['url']
+        response = self.GET(url)
+        self.assertEqual(response.status_code, http.client.OK)
+        etag = response.headers['ETag']
+        response = self.session.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, http.client.NOT_MODIFIED)
+
 
 if __name__ == '__main__':
     base.run()
@@ -0,0 +1,95 @@
+"""Test the differences recorded by the entity saver for the log.
+Runs in-process; no web server or database is needed.
+"""
+
+import os
+import sys
+import unittest
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIRPATH)
+
+from webapp import saver
+
+
+class Saver(saver.BaseSaver):
+    "Saver with paths excluded and hidden, also inside lists."
+
+    EXCLUDE_PATHS = [["modified"], ["items", "1"], ["items", "0", "cache"]]
+    HIDDEN_VALUE_PATHS = [["secret"], ["items", "0", "token"],
+                          ["tokens", "0"]]
+
+
+class Diff(unittest.TestCase):
+    "Test the differences between old and new documents."
+
+    def setUp(self):
+        self.saver = Saver(dict(iuid="0"))
+
+    def test_dict(self):
+        "Added, removed and updated keys; excluded and hidden ones."
+        diff = self.saver.diff(dict(a=1, b=2, secret="x", modified="t0"),
+                               dict(a=1, b=3, c=4, secret="y", modified="t1"))
+        self.assertEqual(diff, dict(
+            added=dict(c=4),
+            updated=dict(b=dict(old_value=2, new_value=3),
+                         secret=dict(old_value="<hidden>",
+                                     new_value="<hidden>"))))
+        self.assertEqual(self.saver.diff(dict(a=1), dict()),
+                         dict(removed=dict(a=1)))
+
+    def test_list(self):
+        "Elements added, removed and updated, keyed by their index."
+        self.assertEqual(self.saver.diff(dict(l=[1, 2, 3]),
+                                         dict(l=[1, 3, 4])),
+                         dict(updated=dict(l=dict(added={"2": 4},
+                                                  removed={"1": 2}))))
+        self.assertEqual(
+            self.saver.diff(dict(l=[dict(a=1), dict(a=2)]),
+                            dict(l=[dict(a=1), dict(a=3, b=1)])),
+            dict(updated=dict(l=dict(updated={"1": dict(
+                added=dict(b=1),
+                updated=dict(a=dict(old_value=2, new_value=3)))}))))
+
+    def test_list_key_order(self):
+        "The order of keys in dicts in a list makes no difference."
+        self.assertEqual(self.saver.diff(dict(l=[dict(a=1, b=2)]),
+                                         dict(l=[dict(b=2, a=1)])),
+                         {})
+        self.assertEqual(
+            self.saver.diff(dict(l=[dict(a=1, b=2), dict(c=1)]),
+                            dict(l=[dict(b=2, a=1), dict(c=2)])),
+            dict(updated=dict(l=dict(updated={"1": dict(
+                updated=dict(c=dict(old_value=1, new_value=2)))}))))
+
+    def test_list_excluded(self):
+        "Excluded paths within list elements are not recorded."
+        self.assertEqual(
+            self.saver.diff(dict(items=[dict(a=1, cache=1), dict(a=1)]),
+                            dict(items=[dict(a=1, cache=2), dict(a=2)])),
+            {})
+        self.assertEqual(
+            self.saver.diff(dict(items=[dict(a=1)]),
+                            dict(items=[dict(a=1), dict(a=2)])),
+            {})
+
+    def test_list_hidden(self):
+        "Hidden paths within list elements have their values hidden."
+        self.assertEqual(
+            self.saver.diff(dict(items=[dict(token="x")]),
+                            dict(items=[dict(token="y")])),
+            dict(updated=dict(items=dict(updated={"0": dict(
+                updated=dict(token=dict(old_value="<hidden>",
+                                        new_value="<hidden>")))}))))
+        self.assertEqual(self.saver.diff(dict(tokens=[]),
+                                         dict(tokens=["x"])),
+                         dict(updated=dict(tokens=dict(
+                             added={"0": "<hidden>"}))))
+        self.assertEqual(self.saver.diff(dict(tokens=["x", "y"]),
+                                         dict(tokens=["y"])),
+                         dict(updated=dict(tokens=dict(
+                             removed={"0": "<hidden>"}))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,12 +14,51 @@ class User(base.Base):
         response = self.GET(url)
         user = self.check_schema(response)
 
+    def test_user_logs(self):
+        "Get user logs JSON, one entry per page."
+        url = f"{base.SETTINGS['ROOT_URL']}/user/{base.SETTINGS['USERNAME']}"
+        response = self.GET(f"{url}/logs?limit=1")
+        logs = self.check_schema(response)
+        self.assertLessEqual(len(logs["logs"]), 1)
+        if "next" in logs:
+            response = self.GET(logs["next"]["href"])
+            next_logs = self.check_schema(response)
+            self.assertEqual(len(next_logs["logs"]), 1)
+            self.assertLessEqual(next_logs["logs"][0]["timestamp"],
+                                 logs["logs"][0]["timestamp"])
+
     def test_users_data(self):
         "Get all users JSON."
         url = f"{base.SETTINGS['ROOT_URL']}/user"
         response = self.GET(url)
         user = self.check_schema(response)
 
+    def test_users_pages(self):
+        "Get all users JSON, one user per page."
+        url = f"{base.SETTINGS['ROOT_URL']}/user/?limit=1"
+        usernames = []
+        while url:
+            response = self.GET(url)
+            users = self.check_schema(response)
+            self.assertLessEqual(len(users["users"]), 1)
+            usernames.extend([u["username"] for u in users["users"]])
+            url = users.get("next", {}).get("href")
+        self.assertEqual(len(usernames), len(set(usernames)))
+        self.assertIn(base.SETTINGS['USERNAME'], usernames)
+
+    def test_users_search(self):
+        "Search users by the username."
+        url = f"{base.SETTINGS['ROOT_URL']}/user/search"
+        response = self.GET(f"{url}?q={base.SETTINGS['USERNAME']}")
+        users = self.check_schema(response)
+        usernames = [u["username"] for u in users["users"]]
+        self.assertIn(base.SETTINGS['USERNAME'], usernames)
+        response = self.GET(f"{url}/logs?q=updated&limit=1")
+        logs = self.check_schema(response)
+        self.assertLessEqual(len(logs["logs"]), 1)
+        response = self.GET(f"{url}?q=%20")
+        self.assertEqual(response.status_code, http.client.BAD_REQUEST)
+
 
 if __name__ == '__main__':
     base.run()
@@ -28,9 +28,44 @@ class Constants:
     DISABLED = "disabled"
     USER_STATUSES = [PENDING, ENABLED, DISABLED]
 
+    # How BaseSaver writes the log entry.
+    SAVER_LOG_SEPARATE = "separate" # Own transaction after the entity's.
+    SAVER_LOG_SINGLE   = "single"   # Same transaction as the entity.
+    SAVER_LOG_QUEUE    = "queue"    # Batched by a background thread.
+    SAVER_LOG_MODES = (SAVER_LOG_SEPARATE, SAVER_LOG_SINGLE, SAVER_LOG_QUEUE)
+
+    # Storage formats of log entries.
+    LOG_PLAIN   = "plain"       # JSON text; strings in every row.
+    LOG_COMPACT = "compact"     # Compressed; strings stored once.
+    LOG_STORAGES = (LOG_PLAIN, LOG_COMPACT)
+
+    # Statuses of background jobs; done jobs are deleted.
+    JOB_QUEUED  = "queued"
+    JOB_RUNNING = "running"
+    JOB_FAILED  = "failed"      # Max attempts reached; kept for inspection.
+    JOB_STATUSES = (JOB_QUEUED, JOB_RUNNING, JOB_FAILED)
+
+    # Formats of access log records.
+    LOG_ACCESS_TEXT = "text"    # Debug level; the previous format.
+    LOG_ACCESS_JSON = "json"    # Info level; with duration, size, agent.
+    LOG_ACCESS_FORMATS = (None, LOG_ACCESS_TEXT, LOG_ACCESS_JSON)
+
+    # Kinds of worker pools.
+    THREAD  = "thread"
+    PROCESS = "process"
+    POOL_KINDS = (None, THREAD, PROCESS)
+
+    # JSON backends.
+    JSON_AUTO   = "auto"
+    JSON_ORJSON = "orjson"
+    JSON_STDLIB = "json"
+    JSON_BACKENDS = (JSON_AUTO, JSON_ORJSON, JSON_STDLIB)
+
     # Content types
     HTML_MIMETYPE = "text/html"
     JSON_MIMETYPE = "application/json"
+    NDJSON_MIMETYPE = "application/x-ndjson"
+    PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4"
 
     # Misc
     JSON_SCHEMA_URL = "http://json-schema.org/draft-07/schema#"
@@ -1,13 +1,14 @@
 "About info HTMl endpoints."
 
+import importlib.metadata
 import sqlite3
 import sys
 
 import flask
-import jsonschema
 
 import webapp
 from webapp import constants
+from webapp import pool
 from webapp import utils
 
 
@@ -26,7 +27,8 @@ def get_software():
         ("Python", f"{v.major}.{v.minor}.{v.micro}", "https://www.python.org/"),
         ("Flask", flask.__version__, "http://flask.pocoo.org/"),
         ("Sqlite3", sqlite3.version, "https://www.sqlite.org/index.html"),
-        ("jsonschema", jsonschema.__version__, 
+        # From the package metadata; importing 'jsonschema' is slow.
+        ("jsonschema", importlib.metadata.version("jsonschema"),
          "https://pypi.org/project/jsonschema"),
         ("Bootstrap", constants.BOOTSTRAP_VERSION, "https://getbootstrap.com/"),
         ("jQuery", constants.JQUERY_VERSION, "https://jquery.com/"),
@@ -41,4 +43,5 @@ def settings():
         if config.get(key):
             config[key] = "<hidden>"
     return flask.render_template("about/settings.html",
-                                 items=sorted(config.items()))
+                                 items=sorted(config.items()),
+                                 pragmas=pool.get_pragmas(flask.g.db))
@@ -12,7 +12,17 @@ blueprint = flask.Blueprint("api_about", __name__)
 
 @blueprint.route("/software")
 def software():
-    result = [{"name": s[0], "version": s[1], "href": s[2]}
-              for s in webapp.about.get_software()]
-    return utils.jsonify(utils.get_json(software=result),
-                         schema_url=utils.url_for("api_schema.about_software"))
+    "Return the software versions."
+    software = webapp.about.get_software()
+    # Weak ETag; the representation includes the time of the response.
+    etag = utils.get_etag(*[v for s in software for v in s])
+    max_age = flask.current_app.config["HTTP_MAX_AGE"]
+    response = utils.not_modified(etag)
+    if response is None:
+        result = [{"name": s[0], "version": s[1], "href": s[2]}
+                  for s in software]
+        response = utils.jsonify(
+            utils.get_json(software=result),
+            schema_url=utils.url_for("api_schema.about_software"))
+    return utils.set_validators(response, etag, weak=True,
+                                max_age=max_age, private=False)
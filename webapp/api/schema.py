@@ -1,8 +1,11 @@
 "JSON schemas for the API."
 
+import json
+
 import flask
 
 from webapp import constants
+from webapp import utils
 
 
 _USERNAME = {"type": "string", "pattern": "^[a-zA-Z][a-zA-Z0-9_-]*$"}
@@ -29,14 +32,14 @@ LOGS = {
     "properties": {
         "$id": _URI,
         "timestamp": _DATETIME,
-        "doc": {
+        "user": {
             "type": "object",
             "properties": {
-                "iuid": _IUID,
+                "username": _USERNAME,
                 "href": _URI
             },
             "required": [
-                "iuid",
+                "username",
                 "href"
             ],
             "additionalProperties": False
@@ -46,27 +49,44 @@ LOGS = {
             "items": {
                 "type": "object",
                 "properties": {
-                    "added": {"type": "array"},
-                    "updated": {"type": "object"},
-                    "removed": {"type": "object"},
+                    "diff": {
+                        "type": "object",
+                        "properties": {
+                            "added": {"type": "object"},
+                            "updated": {"type": "object"},
+                            "removed": {"type": "object"}
+                        },
+                        "additionalProperties": False
+                    },
                     "timestamp": _DATETIME,
                     "username": {"type": ["string", "null"]},
                     "remote_addr": {"type": ["string", "null"]},
-                    "user_agentr": {"type": ["string", "null"]}
+                    "user_agent": {"type": ["string", "null"]}
                 },
                 "required": [
-                    "added",
-                    "updated",
-                    "removed",
+                    "diff",
                     "timestamp",
                     "username",
                     "remote_addr",
-                    "user_agentr"
+                    "user_agent"
                 ],
                 "additionalProperties": False
             }
+        },
+        "next": {
+            "type": "object",
+            "properties": {
+                "href": _URI
+            },
+            "required": ["href"],
+            "additionalProperties": False
         }
-    }
+    },
+    "required": [
+        "$id",
+        "timestamp",
+        "logs"
+    ]
 }
 
 ABOUT_SOFTWARE = {
@@ -149,6 +169,14 @@ USERS = {
                 "required": ["username", "href"],
                 "additionalProperties": False
             }
+        },
+        "next": {
+            "type": "object",
+            "properties": {
+                "href": _URI
+            },
+            "required": ["href"],
+            "additionalProperties": False
         }
     },
     "required": [
@@ -159,24 +187,125 @@ USERS = {
     "additionalProperties": False
 }
 
+_NEXT = {
+    "type": "object",
+    "properties": {
+        "href": _URI
+    },
+    "required": ["href"],
+    "additionalProperties": False
+}
+
+USERS_SEARCH = {
+    "$schema": constants.JSON_SCHEMA_URL,
+    "type": "object",
+    "properties": {
+        "$id": _URI,
+        "timestamp": _DATETIME,
+        "query": {"type": "string"},
+        "users": USERS["properties"]["users"],
+        "next": _NEXT
+    },
+    "required": [
+        "$id",
+        "timestamp",
+        "query",
+        "users"
+    ],
+    "additionalProperties": False
+}
+
+LOGS_SEARCH = {
+    "$schema": constants.JSON_SCHEMA_URL,
+    "type": "object",
+    "properties": {
+        "$id": _URI,
+        "timestamp": _DATETIME,
+        "query": {"type": "string"},
+        "logs": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "timestamp": _DATETIME,
+                    "username": {"type": ["string", "null"]},
+                    "snippet": {"type": "string"},
+                    "user": {
+                        "oneOf": [
+                            LOGS["properties"]["user"],
+                            {"type": "null"}
+                        ]
+                    }
+                },
+                "required": [
+                    "timestamp",
+                    "username",
+                    "snippet",
+                    "user"
+                ],
+                "additionalProperties": False
+            }
+        },
+        "next": _NEXT
+    },
+    "required": [
+        "$id",
+        "timestamp",
+        "query",
+        "logs"
+    ],
+    "additionalProperties": False
+}
+
+# The serialized schemas and their ETags; computed once.
+_SERIALIZED = {}
+for name, schema in [("root", ROOT),
+                     ("logs", LOGS),
+                     ("about_software", ABOUT_SOFTWARE),
+                     ("user", USER),
+                     ("users", USERS),
+                     ("users_search", USERS_SEARCH),
+                     ("logs_search", LOGS_SEARCH)]:
+    body = json.dumps(schema, ensure_ascii=False).encode("utf-8")
+    _SERIALIZED[name] = (body, utils.get_etag(body))
+
+def respond(name):
+    "Return the serialized schema, or 304 Not Modified if not changed."
+    body, etag = _SERIALIZED[name]
+    response = utils.not_modified(etag)
+    if response is None:
+        response = flask.Response(body, mimetype=constants.JSON_MIMETYPE)
+    return utils.set_validators(
+        response, etag,
+        max_age=flask.current_app.config["HTTP_SCHEMA_MAX_AGE"],
+        private=False)
+
 blueprint = flask.Blueprint("api_schema", __name__)
 
 @blueprint.route("/root")
 def root():
-    return flask.jsonify(ROOT)
+    return respond("root")
 
 @blueprint.route("/logs")
 def logs():
-    return flask.jsonify(LOGS)
+    return respond("logs")
 
 @blueprint.route("/about/software")
 def about_software():
-    return flask.jsonify(ABOUT_SOFTWARE)
+    return respond("about_software")
 
 @blueprint.route("/user")
 def user():
-    return flask.jsonify(USER)
+    return respond("user")
 
 @blueprint.route("/users")
 def users():
-    return flask.jsonify(USERS)
+    return respond("users")
+
+@blueprint.route("/users/search")
+def users_search():
+    return respond("users_search")
+
+@blueprint.route("/logs/search")
+def logs_search():
+    return respond("logs_search")
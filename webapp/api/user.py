@@ -5,6 +5,9 @@ import http.client
 import flask
 
 import webapp.user
+from webapp import constants
+from webapp import jsoncodec
+from webapp import search
 from webapp import utils
 
 
@@ -12,11 +15,73 @@ blueprint = flask.Blueprint("api_user", __name__)
 
 @blueprint.route("/")
 def all():
+    "Return a page of users sorted by username. Link to the next page."
     if not flask.g.am_admin:
         flask.abort(http.client.FORBIDDEN)
-    users = [get_user_basic(u) for u in webapp.user.get_users()]
-    return utils.jsonify(utils.get_json(users=users),
-                         schema_url=utils.url_for("api_schema.users"))
+    limit = utils.get_limit()
+    users, next = webapp.user.get_users_page(
+        limit, after=flask.request.args.get("after"))
+    result = utils.get_json(users=[get_user_basic(u) for u in users])
+    if next:
+        result["next"] = {"href": utils.url_for(".all",
+                                                limit=limit,
+                                                after=next)}
+    return utils.jsonify(result, schema_url=utils.url_for("api_schema.users"))
+
+@blueprint.route("/search")
+def search_users():
+    "Return a page of the users matching the query 'q'; best first."
+    if not flask.g.am_admin:
+        flask.abort(http.client.FORBIDDEN)
+    query, limit, offset = get_search_args()
+    users, more = search.search_users(query, limit, offset)
+    result = utils.get_json(query=query,
+                            users=[get_user_basic(u) for u in users])
+    if more:
+        result["next"] = {"href": utils.url_for(".search_users",
+                                                q=query,
+                                                limit=limit,
+                                                offset=offset + limit)}
+    return utils.jsonify(result,
+                         schema_url=utils.url_for("api_schema.users_search"))
+
+@blueprint.route("/search/logs")
+def search_logs():
+    """Return a page of the current log entries matching the query 'q';
+    best first.
+    """
+    if not flask.g.am_admin:
+        flask.abort(http.client.FORBIDDEN)
+    query, limit, offset = get_search_args()
+    logs, more = search.search_logs(query, limit, offset)
+    usernames = webapp.user.get_usernames(set(l["docid"] for l in logs))
+    for log in logs:
+        username = usernames.get(log.pop("docid"))
+        if username:
+            log["user"] = get_user_basic({"username": username})
+        else:
+            log["user"] = None
+    result = utils.get_json(query=query, logs=logs)
+    if more:
+        result["next"] = {"href": utils.url_for(".search_logs",
+                                                q=query,
+                                                limit=limit,
+                                                offset=offset + limit)}
+    return utils.jsonify(result,
+                         schema_url=utils.url_for("api_schema.logs_search"))
+
+def get_search_args():
+    """Return the query, limit and offset from the request arguments.
+    Abort with 400 Bad Request if invalid.
+    """
+    query = flask.request.args.get("q") or ""
+    try:
+        search.get_match(query)
+        offset = int(flask.request.args.get("offset") or 0)
+        if offset < 0: raise ValueError
+    except ValueError:
+        flask.abort(http.client.BAD_REQUEST)
+    return query, utils.get_limit(), offset
 
 @blueprint.route("/<identifier:username>")
 def display(username):
@@ -25,22 +90,61 @@ def display(username):
         flask.abort(http.client.NOT_FOUND)
     if not webapp.user.am_admin_or_self(user):
         flask.abort(http.client.FORBIDDEN)
-    user.pop("password", None)
-    user.pop("apikey", None)
-    user["logs"] = {"href": utils.url_for(".logs", username=user["username"])}
-    return utils.jsonify(utils.get_json(**user),
-                         schema_url=utils.url_for("api_schema.user"))
+    # Weak ETag; the representation includes the time of the response.
+    etag = utils.get_etag(user["iuid"], user["modified"])
+    response = utils.not_modified(etag, last_modified=user["modified"])
+    if response is None:
+        user.pop("password", None)
+        user.pop("apikey", None)
+        user["logs"] = {"href": utils.url_for(".logs",
+                                              username=user["username"])}
+        response = utils.jsonify(utils.get_json(**user),
+                                 schema_url=utils.url_for("api_schema.user"))
+    return utils.set_validators(response, etag, weak=True,
+                                last_modified=user["modified"])
 
 @blueprint.route("/<identifier:username>/logs")
 def logs(username):
+    "Return a page of log entries; newest first. Link to the next page."
+    user = webapp.user.get_user(username=username)
+    if not user:
+        flask.abort(http.client.NOT_FOUND)
+    if not webapp.user.am_admin_or_self(user):
+        flask.abort(http.client.FORBIDDEN)
+    limit = utils.get_limit()
+    archived = utils.to_bool(flask.request.args.get("archived"))
+    logs, next = utils.get_logs_page(user["iuid"], limit,
+                                     before=flask.request.args.get("before"),
+                                     raw=True,
+                                     archived=archived)
+    result = utils.get_json(user=get_user_basic(user), logs=logs)
+    if next:
+        result["next"] = {"href": utils.url_for(".logs",
+                                                username=user["username"],
+                                                limit=limit,
+                                                before=next,
+                                                archived=archived or None)}
+    return utils.jsonify(result, schema_url=utils.url_for("api_schema.logs"))
+
+@blueprint.route("/<identifier:username>/logs/export")
+def logs_export(username):
+    "Stream all log entries as newline-delimited JSON; newest first."
     user = webapp.user.get_user(username=username)
     if not user:
         flask.abort(http.client.NOT_FOUND)
     if not webapp.user.am_admin_or_self(user):
         flask.abort(http.client.FORBIDDEN)
-    return utils.jsonify(utils.get_json(user=get_user_basic(user),
-                                        logs=utils.get_logs(user["iuid"])),
-                         schema_url=utils.url_for("api_schema.logs"))
+    archived = utils.to_bool(flask.request.args.get("archived"))
+    def generate():
+        with utils.connection() as db:
+            for log in utils.iter_logs(user["iuid"], raw=True, db=db,
+                                       archived=archived):
+                yield jsoncodec.dumps_bytes(log) + b"\n"
+    # The stream has a connection of its own, held while it lasts;
+    # release that of the request now, not when the context is torn down.
+    utils.release_db()
+    return flask.Response(flask.stream_with_context(generate()),
+                          mimetype=constants.NDJSON_MIMETYPE)
 
 def get_user_basic(user):
     "Return the basic JSON data for a user."
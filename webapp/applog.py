@@ -0,0 +1,231 @@
+"""Logging of the app, and of access to it.
+If LOG_QUEUE_SIZE is set, a record is put on a bounded queue, and
+is formatted and written by a background thread; the request thread
+never waits for disk I/O. If the queue is full, the record is dropped
+and counted. Access records are text, or JSON with the duration,
+and those of successful requests may be sampled.
+"""
+
+import atexit
+import datetime
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+
+import flask
+
+from webapp import constants
+from webapp import jsoncodec
+
+# The logger, once set up from the configuration of the app.
+_logger = None
+
+# Lock for setting up the logger.
+_lock = threading.Lock()
+
+def init(app):
+    """Set up the logger of the app, and the logging of access.
+    The request start time is recorded for the access records.
+    """
+    get_logger(app)
+    app.before_request(start_request)
+    app.after_request(log_access)
+
+def get_logger(app=None):
+    "Return the logger; set it up on first call."
+    global _logger
+    if _logger is None:
+        with _lock:
+            if _logger is None:
+                _logger = setup(app or flask.current_app)
+    return _logger
+
+def setup(app):
+    "Set up and return the logger according to the configuration."
+    config = app.config
+    logger = logging.getLogger(config["LOG_NAME"])
+    if config["LOG_DEBUG"]:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.WARNING)
+    handlers = [get_handler(config["LOG_FILEPATH"], config)]
+    handlers[0].setFormatter(Formatter(config["LOG_FORMAT"]))
+    # The access records go to their own file, if given, without prefix.
+    # Text access records are debug, as before; JSON records always written.
+    access_logger = logger.getChild("access")
+    if config["LOG_ACCESS"] == constants.LOG_ACCESS_JSON:
+        access_logger.setLevel(logging.INFO)
+    if config["LOG_ACCESS_FILEPATH"]:
+        handler = get_handler(config["LOG_ACCESS_FILEPATH"], config)
+        handler.setFormatter(Formatter("%(message)s"))
+        access_logger.propagate = False
+        handlers.append(handler)
+    if config["LOG_QUEUE_SIZE"]:
+        handler = QueueHandler(handlers[0], config["LOG_QUEUE_SIZE"])
+        logger.addHandler(handler)
+        if len(handlers) > 1:
+            access_logger.addHandler(QueueHandler(handlers[1],
+                                                  config["LOG_QUEUE_SIZE"]))
+        app.extensions["log_queue"] = handler
+    else:
+        logger.addHandler(handlers[0])
+        if len(handlers) > 1:
+            access_logger.addHandler(handlers[1])
+    return logger
+
+def stop():
+    """Stop the listener threads of the queues, writing the queued records.
+    Done at exit; explicitly by a server worker process, which does not
+    run the exit handlers.
+    """
+    if _logger is None: return
+    for logger in [_logger, _logger.getChild("access")]:
+        for handler in logger.handlers:
+            if isinstance(handler, QueueHandler):
+                handler.stop()
+
+def reset():
+    """Stop and remove the handlers, so that the logger is set up again,
+    from the configuration of the app, on next call of 'get_logger'.
+    Done by the server when reloading the app.
+    """
+    global _logger
+    with _lock:
+        if _logger is None: return
+        stop()
+        for logger in [_logger, _logger.getChild("access")]:
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                if isinstance(handler, QueueHandler):
+                    handler.handler.close()
+                handler.close()
+            logger.setLevel(logging.NOTSET)
+            logger.propagate = True
+        _logger = None
+
+def get_handler(filepath, config):
+    "Return the handler writing to the file, if given, else to stderr."
+    if not filepath:
+        return logging.StreamHandler()
+    if config["LOG_ROTATING"]:
+        return logging.handlers.TimedRotatingFileHandler(
+            filepath,
+            when="midnight",
+            backupCount=config["LOG_ROTATING"])
+    return logging.FileHandler(filepath)
+
+def start_request():
+    "Record the start of the request, for its duration."
+    flask.g.request_start = time.perf_counter()
+
+def log_access(response):
+    """Record the access; as text, or as JSON with the duration.
+    Successful requests are sampled according to the settings.
+    Nothing is computed unless the record is to be logged.
+    """
+    config = flask.current_app.config
+    access = config["LOG_ACCESS"]
+    if not access: return response
+    logger = get_logger().getChild("access")
+    if not logger.isEnabledFor(logging.DEBUG if access ==
+                               constants.LOG_ACCESS_TEXT else logging.INFO):
+        return response
+    if response.status_code < 400 and config["LOG_ACCESS_SAMPLE"] < 1.0:
+        if random.random() >= config["LOG_ACCESS_SAMPLE"]: return response
+    if access == constants.LOG_ACCESS_TEXT:
+        logger.debug("%s %s %s %s %s",
+                     flask.request.remote_addr, get_username(),
+                     flask.request.method, flask.request.path,
+                     response.status_code)
+    else:
+        start = flask.g.get("request_start")
+        duration = time.perf_counter() - start if start else None
+        logger.info(dict(timestamp=datetime.datetime.utcnow().isoformat(
+                             timespec="milliseconds") + "Z",
+                         remote_addr=flask.request.remote_addr,
+                         username=get_username(),
+                         method=flask.request.method,
+                         path=flask.request.path,
+                         status=response.status_code,
+                         size=response.content_length,
+                         duration_ms=duration and round(1000 * duration, 3),
+                         user_agent=flask.request.user_agent.string or None))
+    return response
+
+def get_username():
+    "Return the username of the current user, if any."
+    current_user = flask.g.get("current_user")
+    return current_user and current_user["username"]
+
+
+class Formatter(logging.Formatter):
+    "A record whose message is a dictionary is formatted as JSON."
+
+    def formatMessage(self, record):
+        if isinstance(record.msg, dict):
+            record.message = jsoncodec.dumps(record.msg)
+        return super().formatMessage(record)
+
+
+class QueueListener(logging.handlers.QueueListener):
+    "Wait for room for the sentinel when stopping; the queue may be full."
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Put records on a bounded queue, for a listener thread to format
+    and write with the given handler. A record is dropped if the queue
+    is full. The listener is restarted if the process has been forked,
+    and is stopped, writing the remaining records, when the process exits.
+    """
+
+    def __init__(self, handler, size):
+        super().__init__(queue.Queue(maxsize=size))
+        self.handler = handler
+        self.size = size
+        self.dropped = 0
+        self.restart_lock = threading.Lock()
+        self.start()
+        atexit.register(self.stop)
+
+    def start(self):
+        "Start the listener thread for this process."
+        self.pid = os.getpid()
+        self.listener = QueueListener(self.queue, self.handler)
+        self.listener.start()
+        self.stopped = False
+
+    def stop(self):
+        "Stop the listener, after it has written the queued records."
+        if self.pid != os.getpid() or self.stopped: return
+        self.stopped = True
+        self.listener.stop()
+
+    def prepare(self, record):
+        """Return the record as is; it is formatted by the listener.
+        The record is only passed between threads, never pickled.
+        """
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            with self.restart_lock:
+                if self.pid != os.getpid():
+                    self.queue = queue.Queue(maxsize=self.size)
+                    self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        "Return a dictionary of statistics for the queue."
+        return dict(size=self.size,
+                    queued=self.queue.qsize(),
+                    dropped=self.dropped)
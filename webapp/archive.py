@@ -0,0 +1,276 @@
+"""Retention of log entries: entries older than the max age, or beyond the
+max number per document, are moved to archive database files, one per
+month of the entries' timestamps. The archives are attached when needed.
+"""
+
+import datetime
+import glob
+import os
+import os.path
+import threading
+
+import flask
+
+from webapp import constants
+from webapp import logstore
+from webapp import utils
+
+# Name of the attached archive database.
+SCHEMA = "archive"
+
+# Lock for creating the archiver instance.
+_lock = threading.Lock()
+
+def init(app):
+    "Start the background archiving on first request, if an interval is set."
+    if app.config["LOG_ARCHIVE_INTERVAL"]:
+        app.before_request(start_archiver)
+
+def start_archiver():
+    "Ensure that the archiver is running in this process."
+    get_archiver()
+
+def get_archiver():
+    "Get the log archiver for the current app; create and start if needed."
+    app = flask.current_app._get_current_object()
+    with _lock:
+        archiver = app.extensions.get("log_archiver")
+        if archiver is None or archiver.pid != os.getpid():
+            archiver = Archiver(app)
+            app.extensions["log_archiver"] = archiver
+    return archiver
+
+def get_dirpath(config):
+    "Return the directory of the archive files."
+    return config["LOG_ARCHIVE_DIRPATH"] or \
+        os.path.dirname(config["SQLITE3_FILEPATH"])
+
+def get_filepath(config, month):
+    "Return the path of the archive file for the month, 'YYYY-MM'."
+    name = os.path.splitext(os.path.basename(config["SQLITE3_FILEPATH"]))[0]
+    return os.path.join(get_dirpath(config), f"{name}-logs-{month}.sqlite3")
+
+def get_filepaths(config):
+    "Return the paths of the existing archive files, newest first."
+    return sorted(glob.glob(get_filepath(config, "[0-9]*-[0-9]*")),
+                  reverse=True)
+
+def attach(db, filepath):
+    "Attach the archive database file; create it if needed."
+    db.execute(f"ATTACH DATABASE ? AS {SCHEMA}", (filepath,))
+
+def detach(db):
+    "Detach the archive database."
+    db.execute(f"DETACH DATABASE {SCHEMA}")
+
+def select(db, docid, limit=None, before=None, storage=None):
+    """Yield the archived log entries for the document, sorted by reverse
+    timestamp, starting after the cursor 'before', if given.
+    Each archive is attached in turn, newest first.
+    """
+    config = flask.current_app.config
+    for filepath in get_filepaths(config):
+        if limit is not None and limit <= 0: return
+        attach(db, filepath)
+        try:
+            rows = logstore.select(db, docid, limit=limit, before=before,
+                                   storage=storage, schema=SCHEMA).fetchall()
+        finally:
+            detach(db)
+        yield from rows
+        if limit is not None:
+            limit -= len(rows)
+
+def delete(db, docid):
+    "Delete the archived log entries for the document, in every archive."
+    config = flask.current_app.config
+    for filepath in get_filepaths(config):
+        attach(db, filepath)
+        try:
+            with db:
+                db.execute(f"DELETE FROM {SCHEMA}.logs WHERE docid=?",
+                           (docid,))
+                db.execute(f"DELETE FROM {SCHEMA}.log_entries WHERE docid=?",
+                           (docid,))
+        finally:
+            detach(db)
+
+def migrate(db, storage, progress=None):
+    """Move the log entries in every archive into the given storage format.
+    Return the number of entries moved.
+    """
+    config = flask.current_app.config
+    count = 0
+    for filepath in get_filepaths(config):
+        attach(db, filepath)
+        try:
+            count += logstore.migrate(db, storage, progress=progress,
+                                      schema=SCHEMA)
+        finally:
+            detach(db)
+    return count
+
+def run(db, config, chunk_size=None, progress=None):
+    """Move the log entries beyond the retention limits to the archives,
+    in chunks, each in one transaction. Return the number moved.
+    The entries in the other storage format, if any, are included in the
+    limits; they are archived in the storage format of the app.
+    """
+    storages = logstore.get_storages(db, config["LOG_STORAGE"])
+    chunk_size = chunk_size or config["LOG_ARCHIVE_CHUNK_SIZE"]
+    count = 0
+    if config["LOG_RETENTION_DAYS"]:
+        cutoff = utils.get_time(offset=-86400 * config["LOG_RETENTION_DAYS"])
+        for source in storages:
+            timestamp_column = logstore.get_sql(source)[2]
+            while True:
+                moved = move_chunk(db, config, source,
+                                   f"{timestamp_column} < ?", [cutoff],
+                                   lambda: chunk_size)
+                if not moved: break
+                count += moved
+                if progress:
+                    progress(count)
+    if config["LOG_RETENTION_MAX"]:
+        max_count = config["LOG_RETENTION_MAX"]
+        entries = " UNION ALL ".join(f"SELECT docid FROM {table}"
+                                     for table, key in
+                                     [logstore.TABLES[s] for s in storages])
+        docids = [row[0] for row in
+                  db.execute(f"SELECT docid FROM ({entries}) GROUP BY docid"
+                             " HAVING COUNT(*) > ?", (max_count,))]
+        for docid in docids:
+            def get_limit():
+                cursor = db.execute(f"SELECT COUNT(*) FROM ({entries})"
+                                    " WHERE docid=?", (docid,))
+                return min(chunk_size, cursor.fetchone()[0] - max_count)
+            while True:
+                # The oldest entries are moved first, whatever the storage:
+                # from that with the oldest, up to the oldest in the others.
+                oldest = get_oldest(db, storages, docid)
+                if not oldest: break
+                source = oldest[0][1]
+                sql, docid_column, timestamp_column, key_column = \
+                    logstore.get_sql(source)
+                condition = f"{docid_column}=?"
+                params = [docid]
+                if len(oldest) > 1:
+                    condition += f" AND {timestamp_column} <= ?"
+                    params.append(oldest[1][0])
+                moved = move_chunk(db, config, source, condition, params,
+                                   get_limit)
+                if not moved: break
+                count += moved
+                if progress:
+                    progress(count)
+    return count
+
+def get_oldest(db, storages, docid):
+    """Return a sorted list of the timestamp of the oldest log entry for
+    the document, and the storage format, for those that have any.
+    """
+    result = []
+    for storage in storages:
+        table, key = logstore.TABLES[storage]
+        timestamp = db.execute(f"SELECT MIN(timestamp) FROM {table}"
+                               " WHERE docid=?", (docid,)).fetchone()[0]
+        if timestamp is not None:
+            result.append((timestamp, storage))
+    result.sort()
+    return result
+
+def move_chunk(db, config, source, condition, params, get_limit):
+    """Move the oldest log entries in the source storage format satisfying
+    the condition, at most as many as given by 'get_limit', to the archive
+    for the month of the oldest, in the storage format of the app.
+    The limit is obtained within the transaction, in which the entries
+    are selected again, so concurrent archivers do not move too many.
+    Return the number moved.
+    """
+    storage = config["LOG_STORAGE"]
+    sql, docid_column, timestamp_column, key_column = \
+        logstore.get_sql(source)
+    table, key = logstore.TABLES[source]
+    row = db.execute(f"{sql} WHERE {condition}"
+                     f" ORDER BY {timestamp_column} LIMIT 1", params).fetchone()
+    if row is None: return 0
+    start, end = get_month_range(row["timestamp"])
+    attach(db, get_filepath(config, start[:7]))
+    try:
+        with db:
+            logstore.create_tables(db, SCHEMA)
+        # Transaction started explicitly, to lock out other writers
+        # before the entries are selected.
+        db.execute("BEGIN IMMEDIATE")
+        with db:
+            limit = get_limit()
+            if limit <= 0: return 0
+            rows = db.execute(f"{sql} WHERE {condition}"
+                              f" AND {timestamp_column} >= ?"
+                              f" AND {timestamp_column} < ?"
+                              f" ORDER BY {timestamp_column}, {key_column}"
+                              " LIMIT ?",
+                              params + [start, end, limit]).fetchall()
+            # An iuid is needed for plain storage; the compact key is not.
+            logstore.add(db,
+                         [[row["key"] if source == constants.LOG_PLAIN
+                           else utils.get_iuid(),
+                           row["docid"],
+                           logstore.get_diff(row["diff"]),
+                           row["timestamp"],
+                           row["username"],
+                           row["remote_addr"],
+                           row["user_agent"]] for row in rows],
+                         storage=storage, schema=SCHEMA)
+            db.executemany(f"DELETE FROM {table} WHERE {key}=?",
+                           [(row["key"],) for row in rows])
+    finally:
+        detach(db)
+    return len(rows)
+
+def get_month_range(timestamp):
+    "Return the first instants of the month of the timestamp and the next."
+    year, month = int(timestamp[:4]), int(timestamp[5:7])
+    start = datetime.date(year, month, 1)
+    if month == 12:
+        end = datetime.date(year + 1, 1, 1)
+    else:
+        end = datetime.date(year, month + 1, 1)
+    return start.isoformat(), end.isoformat()
+
+
+class Archiver:
+    "Thread running the archiving at the interval given in the settings."
+
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self.interval = app.config["LOG_ARCHIVE_INTERVAL"]
+        self.stopped = threading.Event()
+        self.counts = dict(runs=0, moved=0, errors=0)
+        self.thread = threading.Thread(target=self.loop,
+                                       name="log-archiver",
+                                       daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        "Run the archiving, then wait for the interval; until stopped."
+        while not self.stopped.wait(self.interval):
+            try:
+                with utils.connection(self.app) as db:
+                    moved = run(db, self.app.config)
+            except Exception as error:
+                self.counts["errors"] += 1
+                with self.app.app_context():
+                    utils.get_logger().error(f"log archiver: {error}")
+            else:
+                self.counts["runs"] += 1
+                self.counts["moved"] += moved
+
+    def stop(self):
+        "Stop the thread after the current run, if any."
+        self.stopped.set()
+
+    def stats(self):
+        "Return a dictionary of statistics for the archiver."
+        return dict(interval=self.interval, **self.counts)
@@ -0,0 +1,227 @@
+"""Bulk import and export of users, as CSV or NDJSON.
+Import validates by the UserSaver rules, hashes passwords in a pool
+of processes, and inserts users and their log entries in batches.
+Password hashes are exported, and kept when imported, only if asked for;
+otherwise every password value is taken as plain text and hashed.
+"""
+
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import os
+import re
+import sqlite3
+
+import flask
+from werkzeug.security import generate_password_hash
+
+import webapp.user
+from webapp import constants
+from webapp import jsoncodec
+from webapp import logstore
+from webapp import utils
+
+CSV = "csv"
+NDJSON = "ndjson"
+FORMATS = (CSV, NDJSON)
+
+# A password hash made by werkzeug: method and parameters, salt, and hash.
+HASHED_RX = re.compile(r"^(pbkdf2:[a-z0-9]+(:[0-9]+)?|scrypt(:[0-9]+){0,3})"
+                       r"\$[^$]+\$[0-9a-f]+$")
+
+def get_format(filepath, format=None):
+    "Return the given format, or the format according to the file name."
+    if format:
+        if format not in FORMATS:
+            raise ValueError(f"Invalid format '{format}'.")
+        return format
+    if filepath.lower().endswith(".csv"):
+        return CSV
+    return NDJSON
+
+def export_users(outfile, format=NDJSON, hashed_passwords=False):
+    """Write all users to the open text file, one at a time directly from
+    the database cursor. The password hashes are written only if
+    'hashed_passwords'; never a one-time code. Return the number of users
+    written.
+    """
+    keys = webapp.user.KEYS
+    if not hashed_passwords:
+        keys = [k for k in keys if k != "password"]
+    cursor = flask.g.db.execute(f"SELECT {','.join(keys)} FROM users"
+                                " ORDER BY username COLLATE NOCASE")
+    count = 0
+    if format == CSV:
+        writer = csv.writer(outfile)
+        writer.writerow(keys)
+        for row in cursor:
+            values = [get_export_value(k, v) for k, v in zip(keys, row)]
+            writer.writerow(["" if v is None else v for v in values])
+            count += 1
+    else:
+        for row in cursor:
+            outfile.write(jsoncodec.dumps(dict((k, get_export_value(k, v))
+                                               for k, v in zip(keys, row))))
+            outfile.write("\n")
+            count += 1
+    return count
+
+def get_export_value(key, value):
+    "Return the value to export; a one-time code is not a password."
+    if key == "password" and value and not HASHED_RX.match(value): return None
+    return value
+
+def read_users(infile, format=NDJSON):
+    """Yield tuples (line number, record) from the open text file.
+    Empty values are omitted from the record. If a line cannot be parsed,
+    the record is the ValueError.
+    """
+    if format == CSV:
+        reader = csv.DictReader(infile)
+        for record in reader:
+            yield reader.line_num, dict((k, v) for k, v in record.items()
+                                        if k and v)
+    else:
+        for lineno, line in enumerate(infile, start=1):
+            if not line.strip(): continue
+            try:
+                record = jsoncodec.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("Not a JSON object.")
+            except ValueError as error:
+                yield lineno, ValueError(f"Invalid JSON: {error}")
+            else:
+                yield lineno, dict((k, v) for k, v in record.items()
+                                   if v not in (None, ""))
+
+
+class Importer:
+    """Import users in batches; each batch in one transaction.
+    Invalid records are skipped and recorded in 'errors'.
+    If 'dry_run', only validate; do not hash passwords or insert.
+    If 'hashed_passwords', password values that are werkzeug password
+    hashes, as exported, are kept; otherwise all values are hashed.
+    """
+
+    def __init__(self, batch_size=500, workers=None, dry_run=False,
+                 hashed_passwords=False, progress=None):
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count()
+        self.dry_run = dry_run
+        self.hashed_passwords = hashed_passwords
+        self.progress = progress
+        self.read = 0
+        self.imported = 0
+        self.errors = []
+        # Lowercased values already in the import; must be unique.
+        self.seen = dict(iuid=set(), username=set(), email=set(),
+                         apikey=set())
+
+    def run(self, records):
+        "Import the records; tuples (line number, record). Return self."
+        config = flask.current_app.config
+        kwargs = dict(salt_length=config["SALT_LENGTH"])
+        if config["PASSWORD_HASH_METHOD"]:
+            kwargs["method"] = config["PASSWORD_HASH_METHOD"]
+        hash_password = functools.partial(generate_password_hash, **kwargs)
+        # No processes needed when only validating.
+        if self.dry_run:
+            executor = contextlib.nullcontext()
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        with executor as executor:
+            batch = []
+            for lineno, record in records:
+                self.read += 1
+                try:
+                    if isinstance(record, ValueError):
+                        raise record
+                    batch.append((lineno, *self.validate(record)))
+                except ValueError as error:
+                    self.errors.append((lineno, str(error)))
+                if len(batch) >= self.batch_size:
+                    self.load(batch, executor, hash_password)
+                    batch = []
+            if batch:
+                self.load(batch, executor, hash_password)
+        return self
+
+    def validate(self, record):
+        """Check the record by the UserSaver rules.
+        Return the saver and the password to hash, if any.
+        Raise ValueError if invalid.
+        """
+        for key in webapp.user.KEYS:
+            if key in record and not isinstance(record[key], str):
+                raise ValueError(f"Invalid {key}; not a string.")
+        saver = webapp.user.UserSaver()
+        if record.get("iuid"):
+            iuid = record["iuid"].lower()
+            if not constants.IUID_RX.match(iuid):
+                raise ValueError("Invalid iuid.")
+            cursor = flask.g.db.execute("SELECT COUNT(*) FROM users"
+                                        " WHERE iuid=?", (iuid,))
+            if cursor.fetchone()[0]:
+                raise ValueError("Iuid already in use.")
+            saver["iuid"] = iuid
+        if record.get("created"):
+            saver["created"] = record["created"]
+        saver.set_username(record.get("username"))
+        saver.set_email(record.get("email") or "")
+        saver.set_role(record.get("role") or constants.USER)
+        if record.get("status"):
+            saver.set_status(record["status"])
+        password = record.get("password")
+        if password is None:
+            saver.set_password()
+        elif self.hashed_passwords and HASHED_RX.match(password):
+            saver["password"] = password
+            password = None
+        else:
+            saver.check_password(password)
+        if record.get("apikey"):
+            saver["apikey"] = record["apikey"]
+        saver.finalize()
+        saver.check_unique()
+        for key in self.seen:
+            value = saver.doc.get(key)
+            if not value: continue
+            if value.lower() in self.seen[key]:
+                raise ValueError(f"Duplicate {key} in the import.")
+        for key in self.seen:
+            value = saver.doc.get(key)
+            if value:
+                self.seen[key].add(value.lower())
+        saver["modified"] = record.get("modified") or utils.get_time()
+        return saver, password
+
+    def load(self, batch, executor, hash_password):
+        """Hash the passwords, then insert the users and their log entries.
+        If the insert fails, e.g. a user added meanwhile by another process,
+        none of the batch is inserted, and each record gets the error.
+        """
+        if not self.dry_run:
+            pending = [saver for lineno, saver, password in batch if password]
+            hashes = executor.map(hash_password,
+                                  [p for lineno, saver, p in batch if p],
+                                  chunksize=max(1, len(pending)//self.workers))
+            for saver, pwhash in zip(pending, hashes):
+                saver["password"] = pwhash
+            keys = webapp.user.KEYS
+            sql = webapp.user.UserSaver.get_sql()["insert"]
+            savers = [saver for lineno, saver, password in batch]
+            try:
+                with flask.g.db:
+                    flask.g.db.executemany(sql,
+                                           [[saver.doc.get(k) for k in keys]
+                                            for saver in savers])
+                    logstore.add(flask.g.db, [saver.get_log_values()
+                                              for saver in savers])
+            except sqlite3.IntegrityError as error:
+                for lineno, saver, password in batch:
+                    self.errors.append((lineno, f"Not imported: {error}"))
+                batch = []
+        self.imported += len(batch)
+        if self.progress:
+            self.progress(self)
@@ -0,0 +1,80 @@
+"In-process least-recently-used cache with time-to-live for entries."
+
+import collections
+import threading
+import time
+
+
+class LRUCache:
+    """Thread-safe LRU cache where each entry expires after 'ttl' seconds.
+    A 'size' of zero disables the cache.
+    """
+
+    def __init__(self, size=1024, ttl=60.0):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key: (expires, value)
+        self.generation = None
+        self.counts = dict(hits=0, misses=0, expired=0, evicted=0,
+                           invalidated=0)
+
+    def get(self, key):
+        "Return the value for the key, or None if not present or expired."
+        with self.lock:
+            try:
+                expires, value = self.entries[key]
+            except KeyError:
+                self.counts["misses"] += 1
+                return None
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.counts["expired"] += 1
+                self.counts["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counts["hits"] += 1
+            return value
+
+    def put(self, key, value):
+        "Set the value for the key, evicting the least recently used."
+        if self.size <= 0: return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.counts["evicted"] += 1
+
+    def remove_if(self, predicate):
+        "Remove all entries for which the predicate of the value is true."
+        with self.lock:
+            keys = [k for k, (e, v) in self.entries.items() if predicate(v)]
+            for key in keys:
+                del self.entries[key]
+            self.counts["invalidated"] += len(keys)
+
+    def clear(self):
+        "Remove all entries."
+        with self.lock:
+            self.counts["invalidated"] += len(self.entries)
+            self.entries.clear()
+
+    def set_generation(self, generation):
+        """Clear the cache if the generation differs from the one
+        previously set. Used for invalidation across processes.
+        """
+        with self.lock:
+            if generation == self.generation: return
+            if self.generation is not None:
+                self.counts["invalidated"] += len(self.entries)
+                self.entries.clear()
+            self.generation = generation
+
+    def stats(self):
+        "Return a dictionary of statistics for the cache."
+        with self.lock:
+            result = dict(size=self.size, ttl=self.ttl,
+                          entries=len(self.entries))
+            result.update(self.counts)
+            return result
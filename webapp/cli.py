@@ -3,13 +3,22 @@
 import argparse
 import getpass
 import sys
+import time
 
 import flask
 
 import webapp.main
 import webapp.user
 
+from webapp import archive
+from webapp import bulk
+from webapp import compress
 from webapp import constants
+from webapp import jobs
+from webapp import logstore
+from webapp import migrations
+from webapp import search
+from webapp import serve
 from webapp import utils
 
 
@@ -25,6 +34,54 @@ def get_parser():
                     help="Create an admin user.")
     x0.add_argument("-U", "--create_user", action="store_true",
                     help="Create a user.")
+    x0.add_argument("--precompress", action="store_true",
+                    help="Write compressed copies of the static files.")
+    x0.add_argument("--import", dest="import_users", metavar="FILE",
+                    help="Import users from a CSV or NDJSON file; '-' stdin.")
+    x0.add_argument("--export", dest="export_users", metavar="FILE",
+                    help="Export users to a CSV or NDJSON file; '-' stdout.")
+    x0.add_argument("--migrate", action="store_true",
+                    help="Apply the steps to bring the database schema up"
+                    " to the version of the code; while the app is running.")
+    x0.add_argument("--migrate-logs", action="store_true",
+                    help="Move log entries into the storage format given"
+                    " by LOG_STORAGE.")
+    x0.add_argument("--search-index", action="store_true",
+                    help="Index the existing rows for search, if not done.")
+    x0.add_argument("--search-rebuild", action="store_true",
+                    help="Rebuild the search indexes; needed after VACUUM.")
+    x0.add_argument("--worker", action="store_true",
+                    help="Run the background jobs, e.g. sending mail,"
+                    " until interrupted.")
+    x0.add_argument("--retry-jobs", action="store_true",
+                    help="Queue the failed background jobs again.")
+    x0.add_argument("--archive-logs", action="store_true",
+                    help="Move log entries beyond LOG_RETENTION_DAYS or"
+                    " LOG_RETENTION_MAX into the monthly archive files.")
+    x0.add_argument("--serve", action="store_true",
+                    help="Run the production server, in preforked worker"
+                    " processes, until stopped; SIGHUP reloads.")
+    p.add_argument("--format", choices=bulk.FORMATS,
+                   help="Format of import/export file; default by extension,"
+                   " else NDJSON.")
+    p.add_argument("--dry-run", action="store_true",
+                   help="Import: only validate, do not hash or insert.")
+    p.add_argument("--batch-size", type=int, default=500,
+                   help="Import: number of users per transaction.")
+    p.add_argument("--hashed-passwords", action="store_true",
+                   help="Export: write the password hashes. Import: keep"
+                   " password values that are hashes; else hash all.")
+    p.add_argument("--bind", metavar="ADDRESS",
+                   help="Serve: 'host:port' or 'unix:/path/to/socket';"
+                   " default SERVE_BIND.")
+    p.add_argument("--workers", type=int,
+                   help="Serve: number of processes; default SERVE_WORKERS.")
+    p.add_argument("--threads", type=int,
+                   help="Serve: max concurrent requests per process;"
+                   " default SERVE_THREADS.")
+    p.add_argument("--max-requests", type=int,
+                   help="Serve: replace a process after this many requests;"
+                   " default SERVE_MAX_REQUESTS.")
     return p
 
 def execute(pargs):
@@ -48,6 +105,107 @@ def execute(pargs):
             saver.set_role(constants.USER)
             saver.set_status(constants.ENABLED)
             saver["apikey"] = None
+    elif pargs.precompress:
+        config = flask.current_app.config
+        for dirpath in [flask.current_app.static_folder,
+                        config["SITE_STATIC_DIRPATH"]]:
+            if not dirpath: continue
+            for filepath in compress.precompress(
+                    dirpath, min_size=config["COMPRESS_MIN_SIZE"] or 0):
+                print(filepath)
+    elif pargs.import_users:
+        import_users(pargs)
+    elif pargs.export_users:
+        format = bulk.get_format(pargs.export_users, pargs.format)
+        if pargs.export_users == "-":
+            count = bulk.export_users(sys.stdout, format,
+                                      pargs.hashed_passwords)
+        else:
+            with open(pargs.export_users, "w", newline="") as outfile:
+                count = bulk.export_users(outfile, format,
+                                          pargs.hashed_passwords)
+        print(f"exported {count} users", file=sys.stderr)
+    elif pargs.migrate:
+        pending = migrations.get_pending(flask.g.db)
+        if pending:
+            print(f"applying {', '.join(pending)}", file=sys.stderr)
+            migrations.migrate(
+                flask.g.db, flask.current_app.config,
+                progress=lambda count: print(f"copied {count} rows",
+                                             file=sys.stderr))
+        print(f"schema version {migrations.get_version(flask.g.db)}",
+              file=sys.stderr)
+    elif pargs.migrate_logs:
+        storage = flask.current_app.config["LOG_STORAGE"]
+        progress = lambda count: print(f"moved {count} log entries",
+                                       file=sys.stderr)
+        count = logstore.migrate(flask.g.db, storage, progress=progress)
+        count += archive.migrate(flask.g.db, storage, progress=progress)
+        print(f"moved {count} log entries into {storage} storage;"
+              " run VACUUM to reclaim space, then --search-rebuild",
+              file=sys.stderr)
+    elif pargs.search_index:
+        chunk_size = flask.current_app.config["SEARCH_BACKFILL_CHUNK_SIZE"]
+        for name in search.INDEXES:
+            total = 0
+            while True:
+                count = search.backfill(flask.g.db, name, chunk_size)
+                if not count: break
+                total += count
+                print(f"indexed {total} rows for {name}", file=sys.stderr)
+    elif pargs.search_rebuild:
+        search.rebuild(flask.g.db)
+        print("rebuilt the search indexes", file=sys.stderr)
+    elif pargs.worker:
+        app = flask.current_app._get_current_object()
+        worker = jobs.Worker(app, threads=max(1, app.config["JOBS_WORKERS"]))
+        print(f"running jobs in {len(worker.threads)} threads;"
+              " Ctrl-C to stop", file=sys.stderr)
+        try:
+            while True:
+                time.sleep(60)
+                print(worker.stats(), file=sys.stderr)
+        except KeyboardInterrupt:
+            worker.stop()
+        print(worker.stats(), file=sys.stderr)
+    elif pargs.retry_jobs:
+        count = jobs.retry_failed(flask.g.db)
+        print(f"queued {count} failed jobs again", file=sys.stderr)
+    elif pargs.archive_logs:
+        config = flask.current_app.config
+        if not (config["LOG_RETENTION_DAYS"] or config["LOG_RETENTION_MAX"]):
+            sys.exit("Error: neither LOG_RETENTION_DAYS nor"
+                     " LOG_RETENTION_MAX is set.")
+        count = archive.run(
+            flask.g.db, config,
+            progress=lambda count: print(f"archived {count} log entries",
+                                         file=sys.stderr))
+        print(f"archived {count} log entries in {archive.get_dirpath(config)}",
+              file=sys.stderr)
+
+def import_users(pargs):
+    "Import users from the file given in the arguments; report progress."
+    format = bulk.get_format(pargs.import_users, pargs.format)
+    def progress(importer):
+        print(f"{'validated' if importer.dry_run else 'imported'}"
+              f" {importer.imported} users, {len(importer.errors)} errors",
+              file=sys.stderr)
+    importer = bulk.Importer(batch_size=pargs.batch_size,
+                             dry_run=pargs.dry_run,
+                             hashed_passwords=pargs.hashed_passwords,
+                             progress=progress)
+    if pargs.import_users == "-":
+        importer.run(bulk.read_users(sys.stdin, format))
+    else:
+        with open(pargs.import_users, newline="") as infile:
+            importer.run(bulk.read_users(infile, format))
+    for lineno, message in importer.errors:
+        print(f"line {lineno}: {message}", file=sys.stderr)
+    print(f"read {importer.read}, {'valid' if importer.dry_run else 'imported'}"
+          f" {importer.imported}, errors {len(importer.errors)}",
+          file=sys.stderr)
+    if importer.errors:
+        sys.exit(1)
 
 def main():
     "Entry point for command line interface."
@@ -55,6 +213,13 @@ def main():
     pargs = parser.parse_args()
     if len(sys.argv) == 1:
         parser.print_usage()
+    # The server creates the app itself, before forking the workers.
+    if pargs.serve:
+        serve.Master(bind=pargs.bind,
+                     workers=pargs.workers,
+                     threads=pargs.threads,
+                     max_requests=pargs.max_requests).run()
+        return
     with webapp.main.app.app_context():
         flask.g.db = utils.get_db()
         execute(pargs)
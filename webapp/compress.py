@@ -0,0 +1,132 @@
+"""Negotiated compression of responses, and precompressed static files.
+Brotli and Zstandard are used only if their modules are installed.
+"""
+
+import gzip
+import mimetypes
+import os
+import os.path
+
+import flask
+import werkzeug.security
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content types worth compressing.
+COMPRESSIBLE_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/javascript",
+    "text/xml", "application/javascript", "application/json",
+    "application/schema+json", "application/xml", "image/svg+xml"}
+
+# Compression functions for dynamic responses, and for precompression.
+COMPRESSORS = {"gzip": lambda data: gzip.compress(data, compresslevel=6)}
+PRECOMPRESSORS = {"gzip": lambda data: gzip.compress(data, compresslevel=9)}
+if brotli:
+    COMPRESSORS["br"] = lambda data: brotli.compress(data, quality=4)
+    PRECOMPRESSORS["br"] = lambda data: brotli.compress(data, quality=11)
+if zstandard:
+    COMPRESSORS["zstd"] = zstandard.ZstdCompressor(level=3).compress
+
+# File name extensions of precompressed files.
+EXTENSIONS = {"br": ".br", "gzip": ".gz"}
+
+def init(app):
+    """Compress responses, if enabled.
+    Serve precompressed files for the app's static folder.
+    """
+    if app.config["COMPRESS_MIN_SIZE"] is not None:
+        app.after_request(compress_response)
+    app.view_functions["static"] = \
+        lambda filename: send_static(app.static_folder, filename)
+
+def get_encoding(encodings):
+    "Return the best of the given encodings accepted by the client, or None."
+    accept = flask.request.accept_encodings
+    best = None
+    best_quality = 0
+    for encoding in encodings:
+        quality = accept.quality(encoding)
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+def compress_response(response):
+    "Compress the response if large enough and accepted by the client."
+    config = flask.current_app.config
+    if response.direct_passthrough or response.is_streamed: return response
+    if response.status_code != 200: return response
+    if "Content-Encoding" in response.headers: return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES: return response
+    data = response.get_data()
+    if len(data) < config["COMPRESS_MIN_SIZE"]: return response
+    response.vary.add("Accept-Encoding")
+    encoding = get_encoding([e for e in config["COMPRESS_ENCODINGS"]
+                             if e in COMPRESSORS])
+    if encoding is None: return response
+    response.set_data(COMPRESSORS[encoding](data))
+    response.headers["Content-Encoding"] = encoding
+    # The compressed body is not byte-identical; as nginx does.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+def send_static(dirpath, filename):
+    """Send the static file from the directory. Send a precompressed sibling
+    file (.br or .gz) instead if it exists and is accepted by the client.
+    """
+    encodings = [e for e in flask.current_app.config["COMPRESS_ENCODINGS"]
+                 if e in EXTENSIONS]
+    encoding = get_encoding(encodings)
+    while encoding:
+        filepath = werkzeug.security.safe_join(dirpath,
+                                               filename + EXTENSIONS[encoding])
+        if filepath and os.path.isfile(filepath):
+            mimetype = mimetypes.guess_type(filename)[0] or \
+                       "application/octet-stream"
+            response = flask.send_from_directory(
+                dirpath, filename + EXTENSIONS[encoding], mimetype=mimetype)
+            response.headers["Content-Encoding"] = encoding
+            break
+        encodings.remove(encoding)
+        encoding = get_encoding(encodings)
+    else:
+        response = flask.send_from_directory(dirpath, filename)
+    response.vary.add("Accept-Encoding")
+    return response
+
+def precompress(dirpath, min_size=0):
+    """Write precompressed siblings (.gz, and .br if available) of the
+    compressible files in the directory tree. Skip those up to date.
+    Return the list of files written.
+    """
+    result = []
+    for root, dirnames, filenames in os.walk(dirpath):
+        for filename in filenames:
+            if os.path.splitext(filename)[1] in EXTENSIONS.values(): continue
+            mimetype = mimetypes.guess_type(filename)[0]
+            if mimetype not in COMPRESSIBLE_MIMETYPES: continue
+            filepath = os.path.join(root, filename)
+            if os.path.getsize(filepath) < min_size: continue
+            mtime = os.path.getmtime(filepath)
+            data = None
+            for encoding, compressor in PRECOMPRESSORS.items():
+                outpath = filepath + EXTENSIONS[encoding]
+                if os.path.exists(outpath) and \
+                   os.path.getmtime(outpath) >= mtime:
+                    continue
+                if data is None:
+                    with open(filepath, "rb") as infile:
+                        data = infile.read()
+                with open(outpath, "wb") as outfile:
+                    outfile.write(compressor(data))
+                result.append(outpath)
+    return result
@@ -20,15 +20,49 @@ DEFAULT_SETTINGS = dict(
     LOG_FILEPATH = None,
     LOG_ROTATING = 0,           # Number of backup rotated log files, if any.
     LOG_FORMAT = "%(levelname)-10s %(asctime)s %(message)s",
+    LOG_QUEUE_SIZE = 10000,     # Records written by a thread; 0: in request.
+    LOG_ACCESS = constants.LOG_ACCESS_TEXT, # Or 'json'; None: no access log.
+    LOG_ACCESS_FILEPATH = None, # Access records only; else with the others.
+    LOG_ACCESS_SAMPLE = 1.0,    # Fraction of successful requests logged.
+    METRICS = True,             # Request and query timing histograms.
     HOST_LOGO = None,           # Filename, must be in 'SITE_STATIC_DIRPATH'
     HOST_NAME = None,
     HOST_URL = None,
     SECRET_KEY = None,          # Must be set in 'settings.json'
     SALT_LENGTH = 12,
+    PASSWORD_HASH_METHOD = None,    # None: werkzeug default. Rehash on login.
+    PASSWORD_HASH_EXECUTOR = constants.THREAD, # Or 'process'; None: inline.
+    PASSWORD_HASH_WORKERS = 2,
+    PASSWORD_HASH_MAX_PENDING = 16, # Max admitted hash operations; else 429.
+    PASSWORD_HASH_ADMIT_TIMEOUT = 0.5, # Seconds to wait for admission.
     SQLITE3_FILEPATH = '../site/webapp-data.sqlite3',
+    SQLITE3_PROFILER = False,   # Record statistics for each statement.
+    SQLITE3_SLOW_QUERY_MS = 100, # Log, and explain, statements this slow.
+    SQLITE3_EXPLAIN_ALL = False, # Explain every statement once; find scans.
+    SQLITE3_POOL_SIZE = 8,      # Max number of connections per process.
+    SQLITE3_POOL_TIMEOUT = 10.0, # Seconds to wait for a free connection.
+    SQLITE3_POOL_CHECK_INTERVAL = 60.0, # Seconds idle before health check.
+    # PRAGMAs applied to every new connection; None means Sqlite3 default.
+    # Keys given in 'settings.json' override only those keys.
+    SQLITE3_PROFILE = dict(
+        journal_mode = "WAL",   # Readers do not block the writer.
+        synchronous = "NORMAL", # Safe with WAL; fsync only at checkpoint.
+        cache_size = -16000,    # Negative: KiB, i.e. 16 MB page cache.
+        mmap_size = 268435456,  # 256 MB of memory-mapped I/O.
+        temp_store = "MEMORY",
+        busy_timeout = 5000,    # Milliseconds to wait for a lock.
+        checkpoint_interval = 300, # Seconds between passive WAL checkpoints.
+    ),
+    JSON_BACKEND = constants.JSON_AUTO, # 'orjson' if installed, else 'json'.
     JSON_AS_ASCII = False,
     JSON_SORT_KEYS = False,
     JSONIFY_PRETTYPRINT_REGULAR = False,
+    HTTP_MAX_AGE = 60 * 60,     # Seconds for Cache-Control of static data.
+    HTTP_SCHEMA_MAX_AGE = 24 * 60 * 60, # Seconds for Cache-Control of schemas.
+    COMPRESS_MIN_SIZE = 1024,   # Bytes; smaller not compressed. None: off.
+    COMPRESS_ENCODINGS = ["br", "zstd", "gzip"], # If available; preference.
+    PAGE_SIZE = 100,            # Default number of items per page.
+    PAGE_MAX_SIZE = 1000,       # Max number of items per page.
     MIN_PASSWORD_LENGTH = 6,
     PERMANENT_SESSION_LIFETIME = 7 * 24 * 60 * 60, # seconds; 1 week
     MAIL_SERVER = "localhost",
@@ -37,8 +71,42 @@ DEFAULT_SETTINGS = dict(
     MAIL_USERNAME = None,
     MAIL_PASSWORD = None,
     MAIL_DEFAULT_SENDER = None,
+    MAIL_TIMEOUT = 30.0,        # Seconds for SMTP connect and commands.
+    MAIL_QUEUE = True,          # Send via the job queue; else in the request.
+    JOBS_WORKERS = 1,           # Threads per web process; 0: 'cli.py --worker'.
+    JOBS_BATCH_SIZE = 50,       # Max jobs claimed at once; one SMTP session.
+    JOBS_POLL_INTERVAL = 5.0,   # Seconds between checks when idle.
+    JOBS_MAX_ATTEMPTS = 5,      # Then the job is kept as failed.
+    JOBS_BACKOFF = 30.0,        # Seconds before the first retry; doubled.
+    JOBS_BACKOFF_MAX = 3600.0,  # Max seconds between retries.
+    JOBS_LOCK_TIMEOUT = 600.0,  # Seconds before a claimed job is requeued.
     USER_ENABLE_IMMEDIATELY = False,
     USER_ENABLE_EMAIL_WHITELIST = [], # List of fnmatch expressions
+    LOG_STORAGE = constants.LOG_PLAIN, # Or 'compact'; then 'cli.py --migrate-logs'.
+    LOG_RETENTION_DAYS = None,  # Archive log entries older than this.
+    LOG_RETENTION_MAX = None,   # Archive the oldest beyond this per document.
+    LOG_ARCHIVE_DIRPATH = None, # Monthly archive files; None: the database dir.
+    LOG_ARCHIVE_INTERVAL = None, # Seconds between runs; None: 'cli.py' only.
+    LOG_ARCHIVE_CHUNK_SIZE = 1000, # Max entries moved per transaction.
+    SEARCH_BACKFILL = True,     # Index existing rows in a background thread.
+    SEARCH_BACKFILL_CHUNK_SIZE = 1000, # Max rows indexed per transaction.
+    SEARCH_BACKFILL_PAUSE = 0.05, # Seconds between chunks; lets writers in.
+    MIGRATE_CHUNK_SIZE = 1000,  # Max rows copied per transaction in a rebuild.
+    MIGRATE_PAUSE = 0.01,       # Seconds between chunks; lets writers in.
+    SERVE_BIND = "127.0.0.1:5000", # 'host:port', or 'unix:/path/to/socket'.
+    SERVE_WORKERS = None,       # Processes; None: the number of CPUs.
+    SERVE_THREADS = 4,          # Max concurrent requests per process.
+    SERVE_MAX_REQUESTS = None,  # Then the process is replaced; None: never.
+    SERVE_KEEPALIVE = 5.0,      # Seconds an idle connection is kept open.
+    SERVE_TIMEOUT = 30.0,       # Seconds for requests to finish at stop.
+    SAVER_LOG_MODE = constants.SAVER_LOG_SEPARATE,
+    SAVER_LOG_QUEUE_SIZE = 1000,    # Max entries waiting in mode 'queue'.
+    SAVER_LOG_BATCH_SIZE = 100,     # Max entries written per transaction.
+    SAVER_LOG_FLUSH_INTERVAL = 1.0, # Max seconds before writing a batch.
+    SAVER_LOG_QUEUE_TIMEOUT = 5.0,  # Seconds to wait when full; then direct.
+    USER_CACHE_SIZE = 1024,     # Max number of cached users; 0 disables.
+    USER_CACHE_TTL = 60.0,      # Seconds before a cached user is re-read.
+    USER_CACHE_SHARED = False,  # Invalidate across processes via database.
 )
 
 def init(app):
@@ -77,8 +145,14 @@ def init(app):
         except (KeyError, TypeError, ValueError):
             pass
 
+    # Partial Sqlite3 profile in settings overrides only the keys given.
+    profile = DEFAULT_SETTINGS["SQLITE3_PROFILE"].copy()
+    profile.update(app.config["SQLITE3_PROFILE"] or {})
+    app.config["SQLITE3_PROFILE"] = profile
+
     # Clean up filepaths.
-    for key in ["SITE_STATIC_DIRPATH", "LOG_FILEPATH", "SQLITE3_FILEPATH"]:
+    for key in ["SITE_STATIC_DIRPATH", "LOG_FILEPATH", "SQLITE3_FILEPATH",
+                "LOG_ARCHIVE_DIRPATH", "LOG_ACCESS_FILEPATH"]:
         path = app.config[key]
         if not path: continue
         path = os.path.expanduser(path)
@@ -92,3 +166,18 @@ def init(app):
     assert app.config["SALT_LENGTH"] > 6
     assert app.config["MIN_PASSWORD_LENGTH"] > 4
     assert app.config["SQLITE3_FILEPATH"]
+    assert app.config["SQLITE3_POOL_SIZE"] > 0
+    assert app.config["LOG_STORAGE"] in constants.LOG_STORAGES
+    assert app.config["LOG_ACCESS"] in constants.LOG_ACCESS_FORMATS
+    assert 0.0 <= app.config["LOG_ACCESS_SAMPLE"] <= 1.0
+    assert app.config["LOG_ARCHIVE_CHUNK_SIZE"] > 0
+    assert app.config["SEARCH_BACKFILL_CHUNK_SIZE"] > 0
+    assert app.config["MIGRATE_CHUNK_SIZE"] > 0
+    assert not app.config["SERVE_WORKERS"] or app.config["SERVE_WORKERS"] > 0
+    assert app.config["SERVE_THREADS"] > 0
+    assert app.config["JOBS_WORKERS"] >= 0
+    assert app.config["JOBS_BATCH_SIZE"] > 0
+    assert app.config["JOBS_MAX_ATTEMPTS"] > 0
+    assert app.config["SAVER_LOG_MODE"] in constants.SAVER_LOG_MODES
+    assert app.config["PASSWORD_HASH_EXECUTOR"] in constants.POOL_KINDS
+    assert app.config["JSON_BACKEND"] in constants.JSON_BACKENDS
@@ -0,0 +1,131 @@
+"Password hashing and checking in a bounded pool of workers."
+
+import concurrent.futures
+import os
+import threading
+import time
+
+import flask
+import werkzeug.exceptions
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from webapp import constants
+
+
+class Overloaded(werkzeug.exceptions.TooManyRequests):
+    "Too many password hash operations waiting; status 429."
+
+
+# Lock for creating the hasher instance.
+_lock = threading.Lock()
+
+def get_hasher():
+    "Get the password hasher for the current app; create if needed."
+    app = flask.current_app._get_current_object()
+    with _lock:
+        hasher = app.extensions.get("password_hasher")
+        if hasher is None or hasher.pid != os.getpid():
+            config = app.config
+            hasher = Hasher(kind=config["PASSWORD_HASH_EXECUTOR"],
+                            workers=config["PASSWORD_HASH_WORKERS"],
+                            max_pending=config["PASSWORD_HASH_MAX_PENDING"],
+                            timeout=config["PASSWORD_HASH_ADMIT_TIMEOUT"])
+            app.extensions["password_hasher"] = hasher
+    return hasher
+
+def generate(password):
+    "Return the hash of the password, using the configured method."
+    config = flask.current_app.config
+    kwargs = dict(salt_length=config["SALT_LENGTH"])
+    if config["PASSWORD_HASH_METHOD"]:
+        kwargs["method"] = config["PASSWORD_HASH_METHOD"]
+    return get_hasher().run(generate_password_hash, password, **kwargs)
+
+def check(pwhash, password):
+    "Does the password match the hash?"
+    if not pwhash: return False
+    return get_hasher().run(check_password_hash, pwhash, password)
+
+def needs_rehash(pwhash):
+    """Was the hash made by another method than the configured one?
+    False if no method is configured.
+    """
+    method = flask.current_app.config["PASSWORD_HASH_METHOD"]
+    if not method: return False
+    return pwhash.split("$", 1)[0] != get_hasher().get_prefix(method)
+
+
+class Hasher:
+    """Run hash operations in a pool of threads or processes, or inline
+    if 'kind' is None. At most 'max_pending' operations are admitted;
+    wait at most 'timeout' seconds for admission, then raise Overloaded.
+    """
+
+    def __init__(self, kind=constants.THREAD, workers=2, max_pending=16,
+                 timeout=0.5):
+        self.pid = os.getpid()
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        if kind == constants.THREAD:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="password-hash")
+        elif kind == constants.PROCESS:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers)
+        else:
+            self.executor = None
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.prefixes = {}
+        self.pending = 0
+        self.counts = dict(completed=0, rejected=0)
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def run(self, func, *args, **kwargs):
+        "Run the function in the pool, and return its result."
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.counts["rejected"] += 1
+            raise Overloaded("Too many logins in progress; try again.",
+                             retry_after=1)
+        with self.lock:
+            self.pending += 1
+        start = time.monotonic()
+        try:
+            if self.executor is None:
+                return func(*args, **kwargs)
+            else:
+                return self.executor.submit(func, *args, **kwargs).result()
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.pending -= 1
+                self.counts["completed"] += 1
+                self.total_time += elapsed
+                self.max_time = max(self.max_time, elapsed)
+            self.slots.release()
+
+    def get_prefix(self, method):
+        "Return the prefix of a hash made by the method, e.g. its rounds."
+        try:
+            return self.prefixes[method]
+        except KeyError:
+            pwhash = self.run(generate_password_hash, "x", method=method)
+            self.prefixes[method] = pwhash.split("$", 1)[0]
+            return self.prefixes[method]
+
+    def stats(self):
+        "Return a dictionary of statistics for the hasher."
+        with self.lock:
+            result = dict(workers=self.workers,
+                          max_pending=self.max_pending,
+                          pending=self.pending,
+                          queued=max(0, self.pending - self.workers))
+            result.update(self.counts)
+            if self.counts["completed"]:
+                result["mean_ms"] = round(1000 * self.total_time /
+                                          self.counts["completed"], 1)
+            result["max_ms"] = round(1000 * self.max_time, 1)
+            return result
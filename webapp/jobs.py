@@ -0,0 +1,368 @@
+"""Durable queue of background jobs, in the Sqlite3 database.
+A job is a kind and a JSON payload. Workers claim the due jobs of one
+kind in a batch and call the handler for the kind. A failed job is
+retried with exponential backoff, until the max number of attempts;
+then it is kept as failed. A job refused for good, e.g. by an SMTP 5xx
+reply, fails at once. The lock of a batch is extended after each job;
+a job claimed by a worker that died is queued again after the lock
+timeout. A worker records the outcome only of the jobs it still holds.
+Mail is sent through the queue, so a request never waits for SMTP.
+"""
+
+import os
+import random
+import smtplib
+import threading
+
+import flask
+import flask_mail
+
+from webapp import constants
+from webapp import jsoncodec
+from webapp import utils
+
+# The handlers: kind -> function called with the list of payloads,
+# yielding an error message, or None for success, for each payload
+# in order. An error that is a 'Refused' is not retried.
+HANDLERS = {}
+
+# Kind of job sending a mail message.
+MAIL = "mail"
+
+# Set when a job is queued, to wake up the workers of this process.
+_wakeup = threading.Event()
+
+# Lock for creating the worker instance.
+_lock = threading.Lock()
+
+def init(app):
+    "Start the worker threads on first request, if any."
+    if app.config["JOBS_WORKERS"]:
+        app.before_request(start_worker)
+
+def create_tables(db):
+    "Create the table of jobs, if not done; see 'migrations'."
+    db.execute("CREATE TABLE IF NOT EXISTS jobs"
+               "(id INTEGER PRIMARY KEY,"
+               " kind TEXT NOT NULL,"
+               " payload TEXT NOT NULL,"
+               " status TEXT NOT NULL,"
+               " attempts INTEGER NOT NULL,"
+               " run_after TEXT NOT NULL,"
+               " locked_by TEXT,"
+               " locked_at TEXT,"
+               " error TEXT,"
+               " created TEXT NOT NULL,"
+               " modified TEXT NOT NULL)")
+    db.execute("CREATE INDEX IF NOT EXISTS jobs_status_index"
+               " ON jobs (status, run_after)")
+
+def register(kind):
+    "Decorator registering the function as the handler for the kind of job."
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+def enqueue(db, kind, payload, delay=None):
+    """Add a job to the queue, in its own transaction.
+    It will be run no earlier than 'delay' seconds from now, if given.
+    Return the job id.
+    """
+    assert kind in HANDLERS
+    now = utils.get_time()
+    with db:
+        cursor = db.execute("INSERT INTO jobs (kind, payload, status,"
+                            " attempts, run_after, created, modified)"
+                            " VALUES (?,?,?,0,?,?,?)",
+                            (kind, jsoncodec.dumps(payload),
+                             constants.JOB_QUEUED,
+                             utils.get_time(offset=delay) if delay else now,
+                             now, now))
+    _wakeup.set()
+    return cursor.lastrowid
+
+def claim(db, worker_id, batch_size, lock_timeout):
+    """Claim the due jobs of the kind of the oldest due job, at most
+    'batch_size' of them. Jobs locked longer than 'lock_timeout' seconds
+    are queued again first. Return the kind and the list of jobs;
+    None and an empty list if there are no due jobs.
+    """
+    now = utils.get_time()
+    # Transaction started explicitly, so that concurrent workers
+    # do not claim the same jobs.
+    db.execute("BEGIN IMMEDIATE")
+    with db:
+        db.execute("UPDATE jobs SET status=?, locked_by=NULL, locked_at=NULL"
+                   " WHERE status=? AND locked_at < ?",
+                   (constants.JOB_QUEUED, constants.JOB_RUNNING,
+                    utils.get_time(offset=-lock_timeout)))
+        row = db.execute("SELECT kind FROM jobs WHERE status=?"
+                         " AND run_after <= ? ORDER BY run_after, id LIMIT 1",
+                         (constants.JOB_QUEUED, now)).fetchone()
+        if row is None:
+            return None, []
+        kind = row[0]
+        jobs = [dict(row) for row in
+                db.execute("SELECT id, payload, attempts FROM jobs"
+                           " WHERE status=? AND kind=? AND run_after <= ?"
+                           " ORDER BY run_after, id LIMIT ?",
+                           (constants.JOB_QUEUED, kind, now, batch_size))]
+        db.executemany("UPDATE jobs SET status=?, locked_by=?, locked_at=?,"
+                       " attempts=attempts+1, modified=? WHERE id=?",
+                       [(constants.JOB_RUNNING, worker_id, now, now, job["id"])
+                        for job in jobs])
+    return kind, jobs
+
+def extend(db, worker_id):
+    "Extend the lock of the jobs claimed by the worker."
+    with db:
+        db.execute("UPDATE jobs SET locked_at=?"
+                   " WHERE status=? AND locked_by=?",
+                   (utils.get_time(), constants.JOB_RUNNING, worker_id))
+
+def finish(db, worker_id, jobs, errors, config):
+    """Delete the jobs that succeeded. Queue again those that failed,
+    after the backoff, or mark them as failed at the max attempts,
+    or at once if refused. Jobs no longer locked by the worker, i.e.
+    queued again after the lock timeout, are left as they are.
+    """
+    now = utils.get_time()
+    done = []
+    retries = []
+    failures = []
+    for job, error in zip(jobs, errors):
+        attempts = job["attempts"] + 1
+        if error is None:
+            done.append((job["id"], worker_id))
+        elif attempts >= config["JOBS_MAX_ATTEMPTS"] or \
+             isinstance(error, Refused):
+            failures.append((constants.JOB_FAILED, error, now,
+                             job["id"], worker_id))
+        else:
+            delay = min(config["JOBS_BACKOFF"] * 2 ** (attempts - 1),
+                        config["JOBS_BACKOFF_MAX"])
+            # Jitter, so that retries of a batch are spread out.
+            delay *= random.uniform(0.8, 1.2)
+            retries.append((constants.JOB_QUEUED, error,
+                            utils.get_time(offset=delay), now,
+                            job["id"], worker_id))
+    with db:
+        db.executemany("DELETE FROM jobs WHERE id=? AND locked_by=?", done)
+        db.executemany("UPDATE jobs SET status=?, error=?, run_after=?,"
+                       " locked_by=NULL, locked_at=NULL, modified=?"
+                       " WHERE id=? AND locked_by=?", retries)
+        db.executemany("UPDATE jobs SET status=?, error=?,"
+                       " locked_by=NULL, locked_at=NULL, modified=?"
+                       " WHERE id=? AND locked_by=?", failures)
+
+def run_once(db, worker_id, config):
+    """Claim a batch of due jobs, run the handler, and record the outcome.
+    Return the kind, the number of jobs run and the number failed;
+    None, 0 and 0 if there were no due jobs.
+    """
+    kind, jobs = claim(db, worker_id, config["JOBS_BATCH_SIZE"],
+                       config["JOBS_LOCK_TIMEOUT"])
+    if not jobs:
+        return None, 0, 0
+    errors = []
+    try:
+        handler = HANDLERS[kind]
+        for error in handler([jsoncodec.loads(job["payload"])
+                              for job in jobs]):
+            errors.append(error)
+            # The remaining jobs must not be queued again meanwhile.
+            if len(errors) < len(jobs):
+                extend(db, worker_id)
+    except Exception as error:
+        errors.extend([f"{error.__class__.__name__}: {error}"] *
+                      (len(jobs) - len(errors)))
+    finish(db, worker_id, jobs, errors, config)
+    return kind, len(jobs), len([e for e in errors if e is not None])
+
+def get_counts(db):
+    """Return the number of jobs per status, and the age in seconds
+    of the oldest due queued job.
+    """
+    result = dict((status, 0) for status in constants.JOB_STATUSES)
+    for row in db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+        result[row[0]] = row[1]
+    row = db.execute("SELECT MIN(run_after) FROM jobs"
+                     " WHERE status=? AND run_after <= ?",
+                     (constants.JOB_QUEUED, utils.get_time())).fetchone()
+    if row[0]:
+        age = utils.to_datetime(utils.get_time()) - utils.to_datetime(row[0])
+        result["oldest_due_seconds"] = round(age.total_seconds(), 3)
+    else:
+        result["oldest_due_seconds"] = 0
+    return result
+
+def retry_failed(db):
+    "Queue the failed jobs again, with attempts reset. Return the number."
+    now = utils.get_time()
+    with db:
+        cursor = db.execute("UPDATE jobs SET status=?, attempts=0,"
+                            " run_after=?, modified=? WHERE status=?",
+                            (constants.JOB_QUEUED, now, now,
+                             constants.JOB_FAILED))
+    _wakeup.set()
+    return cursor.rowcount
+
+def start_worker():
+    "Ensure that the worker has been started in this process."
+    get_worker()
+
+def get_worker():
+    "Get the worker for the current app; create and start if needed."
+    app = flask.current_app._get_current_object()
+    with _lock:
+        worker = app.extensions.get("job_worker")
+        if worker is None or worker.pid != os.getpid():
+            worker = Worker(app, threads=app.config["JOBS_WORKERS"])
+            app.extensions["job_worker"] = worker
+    return worker
+
+
+class Worker:
+    """Threads running the due jobs, each thread a batch at a time.
+    When there are no due jobs, a thread waits for the poll interval,
+    or until a job is queued in this process.
+    """
+
+    def __init__(self, app, threads=1):
+        self.app = app
+        self.pid = os.getpid()
+        self.stopped = threading.Event()
+        self.counts = dict(batches=0, jobs=0, failed=0, errors=0)
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.run,
+                                         args=(f"{os.getpid()}-{n}",),
+                                         name=f"job-worker-{n}",
+                                         daemon=True)
+                        for n in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self, worker_id):
+        "Run batches of due jobs until stopped."
+        config = self.app.config
+        while not self.stopped.is_set():
+            try:
+                with self.app.app_context():
+                    with utils.connection(self.app) as db:
+                        kind, count, failed = run_once(db, worker_id, config)
+            except Exception as error:
+                with self.lock:
+                    self.counts["errors"] += 1
+                with self.app.app_context():
+                    utils.get_logger().error(f"job worker: {error}")
+                count = 0
+            else:
+                if count:
+                    with self.lock:
+                        self.counts["batches"] += 1
+                        self.counts["jobs"] += count
+                        self.counts["failed"] += failed
+            if not count:
+                _wakeup.wait(config["JOBS_POLL_INTERVAL"])
+                _wakeup.clear()
+
+    def stop(self, timeout=None):
+        "Stop the threads after their current batch, and wait for them."
+        self.stopped.set()
+        _wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def stats(self):
+        "Return a dictionary of statistics for the worker."
+        with self.lock:
+            return dict(threads=len(self.threads), **self.counts)
+
+
+def send_mail(message):
+    """Send the mail message via the queue, if enabled in the settings;
+    else directly.
+    """
+    if not flask.current_app.config["MAIL_QUEUE"]:
+        utils.mail.send(message)
+        return
+    enqueue(flask.g.db, MAIL,
+            dict(subject=message.subject,
+                 recipients=message.recipients,
+                 body=message.body,
+                 html=message.html,
+                 sender=message.sender,
+                 cc=message.cc,
+                 bcc=message.bcc,
+                 reply_to=message.reply_to))
+
+@register(MAIL)
+def send_mails(payloads):
+    """Send the mail messages over one SMTP connection.
+    A message refused by the server fails alone; for good if the reply
+    is 5xx. If the connection is lost, the message and those remaining
+    fail.
+    """
+    lost = None
+    with Connection(flask.current_app.extensions["mail"]) as connection:
+        for payload in payloads:
+            if lost:
+                yield lost
+                continue
+            try:
+                connection.send(flask_mail.Message(**payload))
+            except (smtplib.SMTPRecipientsRefused,
+                    smtplib.SMTPSenderRefused,
+                    smtplib.SMTPDataError) as error:
+                message = f"{error.__class__.__name__}: {error}"
+                if is_permanent(error):
+                    yield Refused(message)
+                else:
+                    yield message
+            except OSError as error:
+                lost = f"{error.__class__.__name__}: {error}"
+                yield lost
+            else:
+                yield None
+
+def is_permanent(error):
+    "Is the SMTP error a permanent refusal; a 5xx reply for all recipients?"
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, message in error.recipients.values()]
+    else:
+        codes = [error.smtp_code]
+    return bool(codes) and all(500 <= code < 600 for code in codes)
+
+
+class Refused(str):
+    "Error message of a job refused for good; it is not retried."
+
+
+class Connection(flask_mail.Connection):
+    """SMTP connection with the timeout given in the settings;
+    the connection of 'flask_mail' has none, and may hang.
+    A failure when closing the connection is ignored.
+    """
+
+    def configure_host(self):
+        timeout = flask.current_app.config["MAIL_TIMEOUT"]
+        if self.mail.use_ssl:
+            host = smtplib.SMTP_SSL(self.mail.server, self.mail.port,
+                                    timeout=timeout)
+        else:
+            host = smtplib.SMTP(self.mail.server, self.mail.port,
+                                timeout=timeout)
+        host.set_debuglevel(int(self.mail.debug))
+        if self.mail.use_tls:
+            host.starttls()
+        if self.mail.username and self.mail.password:
+            host.login(self.mail.username, self.mail.password)
+        return host
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.host is None: return
+        try:
+            self.host.quit()
+        except OSError:
+            self.host.close()
@@ -0,0 +1,98 @@
+"""JSON encoding and decoding; uses orjson if installed, else the stdlib.
+Values wrapped in RawJSON are inserted as-is, without decode/encode.
+"""
+
+import json
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from webapp import constants
+
+# The backend in use; set by 'init'.
+backend = constants.JSON_STDLIB
+
+def init(app):
+    "Select the backend according to the settings."
+    set_backend(app.config["JSON_BACKEND"])
+
+def set_backend(name):
+    "Set the backend: 'orjson' or 'json'. Any other: orjson if installed."
+    global backend
+    if name == constants.JSON_STDLIB:
+        backend = constants.JSON_STDLIB
+    elif name == constants.JSON_ORJSON:
+        if orjson is None:
+            raise ValueError("orjson is not installed")
+        backend = constants.JSON_ORJSON
+    elif orjson is None:
+        backend = constants.JSON_STDLIB
+    else:
+        backend = constants.JSON_ORJSON
+
+
+class RawJSON:
+    "Text which is known to be valid JSON; inserted as-is when encoding."
+
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def decode(self):
+        "Return the decoded value."
+        return loads(self.text)
+
+
+def raw_is_faster():
+    """Is inserting RawJSON faster than decoding and re-encoding?
+    Not for orjson without Fragment (before v3.10), since each RawJSON
+    then requires a call into Python; see 'bench/json_logs.py'.
+    """
+    return backend == constants.JSON_STDLIB or hasattr(orjson, "Fragment")
+
+def loads(text):
+    "Decode the JSON text, given as str or bytes."
+    if backend == constants.JSON_ORJSON:
+        return orjson.loads(text)
+    else:
+        return json.loads(text)
+
+def dumps(value):
+    "Encode the value into JSON text (str)."
+    return dumps_bytes(value).decode("utf-8")
+
+def dumps_bytes(value):
+    "Encode the value into JSON text as UTF-8 bytes."
+    raws = []
+    token = None
+    def default(obj):
+        nonlocal token
+        if isinstance(obj, RawJSON):
+            if orjson is not None and hasattr(orjson, "Fragment") and \
+               backend == constants.JSON_ORJSON:
+                return orjson.Fragment(obj.text)
+            if token is None:
+                token = uuid.uuid4().hex
+            raws.append(obj.text.encode("utf-8"))
+            return f"{token}{len(raws)-1}"
+        raise TypeError(f"Object of type {type(obj).__name__}"
+                        " is not JSON serializable")
+    if backend == constants.JSON_ORJSON:
+        result = orjson.dumps(value, default=default)
+    else:
+        result = json.dumps(value, default=default,
+                            ensure_ascii=False).encode("utf-8")
+    if raws:
+        # Replace the placeholder strings '"<token><index>"' by the texts.
+        parts = result.split(f'"{token}'.encode("ascii"))
+        chunks = [parts[0]]
+        for part in parts[1:]:
+            end = part.index(b'"')
+            chunks.append(raws[int(part[:end])])
+            chunks.append(part[end+1:])
+        result = b"".join(chunks)
+    return result
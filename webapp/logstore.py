@@ -0,0 +1,275 @@
+"""Storage of log entries; plain or compact, according to the settings.
+Plain: table 'logs', with the diff as JSON text, and the strings of
+username, remote address and user agent repeated in every row.
+Compact: table 'log_entries', with INTEGER keys, the diff compressed,
+and the strings stored once in table 'log_strings'.
+Entries are read from both tables while the one not in use still has
+entries, i.e. until 'cli.py --migrate-logs' has been run after a change
+of the storage format.
+"""
+
+import zlib
+
+import flask
+
+from webapp import constants
+from webapp import utils
+
+# Statements are templates for the schema: 'main', or an attached archive.
+PLAIN_INSERT_SQL = ("INSERT INTO {schema}.logs"
+                    " (iuid, docid, diff, timestamp, username,"
+                    "  remote_addr, user_agent)"
+                    " VALUES (?,?,?,?,?,?,?)")
+
+COMPACT_INSERT_SQL = ("INSERT INTO {schema}.log_entries"
+                      " (docid, diff, timestamp, username,"
+                      "  remote_addr, user_agent)"
+                      " VALUES (?,?,?,?,?,?)")
+
+# The index of the compact log entries stores the text; see 'search'.
+COMPACT_INDEX_SQL = ("INSERT OR REPLACE INTO log_entries_fts"
+                     " (rowid, diff, username) VALUES (?,?,?)")
+
+PLAIN_SELECT_SQL = ("SELECT iuid AS key, docid, diff, timestamp, username,"
+                    " remote_addr, user_agent FROM {schema}.logs")
+
+COMPACT_SELECT_SQL = ("SELECT e.id AS key, e.docid, e.diff, e.timestamp,"
+                      " u.value AS username, a.value AS remote_addr,"
+                      " g.value AS user_agent FROM {schema}.log_entries e"
+                      " LEFT JOIN {schema}.log_strings u ON u.id=e.username"
+                      " LEFT JOIN {schema}.log_strings a ON a.id=e.remote_addr"
+                      " LEFT JOIN {schema}.log_strings g ON g.id=e.user_agent")
+
+# First byte of a compact diff: the encoding of the rest.
+JSON_PREFIX = b"j"
+ZLIB_PREFIX = b"z"
+
+# The table, and its key column, for each storage format.
+TABLES = {constants.LOG_PLAIN: ("logs", "iuid"),
+          constants.LOG_COMPACT: ("log_entries", "id")}
+
+# Diffs shorter than this (bytes) are not worth compressing.
+COMPRESS_MIN_SIZE = 64
+
+# Max number of strings per statement; below the Sqlite3 variable limit.
+CHUNK_SIZE = 500
+
+def create_tables(db, schema="main"):
+    """Create the tables for log entries in the schema, if not done;
+    in both storage formats. See 'migrations' for the main schema.
+    """
+    db.execute(f"CREATE TABLE IF NOT EXISTS {schema}.logs"
+               "(iuid TEXT PRIMARY KEY,"
+               " docid TEXT NOT NULL,"
+               " diff TEXT NOT NULL,"
+               " username TEXT,"
+               " remote_addr TEXT,"
+               " user_agent TEXT,"
+               " timestamp TEXT NOT NULL)")
+    # For keyset pagination; also covers lookup by docid.
+    db.execute("CREATE INDEX IF NOT EXISTS"
+               f" {schema}.logs_docid_timestamp_index"
+               " ON logs (docid, timestamp, iuid)")
+    db.execute(f"CREATE TABLE IF NOT EXISTS {schema}.log_strings"
+               "(id INTEGER PRIMARY KEY,"
+               " value TEXT NOT NULL UNIQUE)")
+    db.execute(f"CREATE TABLE IF NOT EXISTS {schema}.log_entries"
+               "(id INTEGER PRIMARY KEY,"
+               " docid TEXT NOT NULL,"
+               " diff BLOB NOT NULL,"
+               " timestamp TEXT NOT NULL,"
+               " username INTEGER,"
+               " remote_addr INTEGER,"
+               " user_agent INTEGER)")
+    db.execute(f"CREATE INDEX IF NOT EXISTS {schema}.log_entries_docid_index"
+               " ON log_entries (docid, timestamp, id)")
+
+def get_storage():
+    "Return the log storage format of the current app."
+    return flask.current_app.config["LOG_STORAGE"]
+
+def get_storages(db, storage=None, schema="main"):
+    """Return the storage formats to read log entries from: the given,
+    or that of the app, and the other, if its table has any entries.
+    """
+    storage = storage or get_storage()
+    result = [storage]
+    for other, (table, key) in TABLES.items():
+        if other == storage: continue
+        if db.execute(f"SELECT 1 FROM {schema}.{table} LIMIT 1").fetchone():
+            result.append(other)
+    return result
+
+def encode_diff(text):
+    "Return the diff JSON text encoded for compact storage."
+    data = text.encode("utf-8")
+    if len(data) >= COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            return ZLIB_PREFIX + compressed
+    return JSON_PREFIX + data
+
+def decode_diff(blob):
+    "Return the diff JSON text from its compact encoding."
+    prefix = blob[:1]
+    if prefix == ZLIB_PREFIX:
+        return zlib.decompress(blob[1:]).decode("utf-8")
+    elif prefix == JSON_PREFIX:
+        return bytes(blob[1:]).decode("utf-8")
+    raise ValueError(f"Unknown log diff encoding {prefix!r}.")
+
+def add(db, rows, storage=None, schema="main"):
+    """Insert the log entries; lists of values in the order of
+    'PLAIN_INSERT_SQL'. In compact storage, the iuid is not used.
+    The caller handles the transaction.
+    """
+    storage = storage or get_storage()
+    if storage == constants.LOG_PLAIN:
+        db.executemany(PLAIN_INSERT_SQL.format(schema=schema), rows)
+        return
+    ids = intern(db, set(v for row in rows for v in row[4:7] if v), schema)
+    db.executemany(COMPACT_INSERT_SQL.format(schema=schema),
+                   [(row[1], encode_diff(row[2]), row[3], ids.get(row[4]),
+                     ids.get(row[5]), ids.get(row[6]))
+                    for row in rows])
+    if schema == "main" and rows and has_stored_index(db):
+        # The write lock is held, so the rows just inserted are those
+        # with the highest ids, in order.
+        cursor = db.execute("SELECT id FROM log_entries"
+                            " ORDER BY id DESC LIMIT ?", (len(rows),))
+        keys = reversed([row[0] for row in cursor])
+        db.executemany(COMPACT_INDEX_SQL,
+                       [(key, row[2], row[4]) for key, row in zip(keys, rows)])
+
+def has_stored_index(db):
+    """Does the index of the compact log entries store the text? If not,
+    the schema has not yet been migrated; its triggers do the indexing.
+    """
+    cursor = db.execute("SELECT name FROM sqlite_master WHERE name IN"
+                        " ('log_entries_fts', 'log_entries_fts_insert')")
+    return set(row[0] for row in cursor) == {"log_entries_fts"}
+
+def intern(db, values, schema="main"):
+    """Return a dictionary of the ids of the strings, adding those not
+    already stored. Not cached, since the transaction may be rolled back.
+    """
+    values = list(values)
+    result = {}
+    for pos in range(0, len(values), CHUNK_SIZE):
+        chunk = values[pos:pos+CHUNK_SIZE]
+        db.execute(f"INSERT OR IGNORE INTO {schema}.log_strings (value)"
+                   f" VALUES {','.join(['(?)'] * len(chunk))}", chunk)
+        cursor = db.execute(f"SELECT id, value FROM {schema}.log_strings"
+                            f" WHERE value IN ({','.join('?' * len(chunk))})",
+                            chunk)
+        for row in cursor:
+            result[row[1]] = row[0]
+    return result
+
+def get_sql(storage=None, schema="main"):
+    """Return the SELECT statement for log entries in the storage format
+    and schema, and its qualified names of the columns docid, timestamp
+    and key.
+    """
+    storage = storage or get_storage()
+    if storage == constants.LOG_PLAIN:
+        return (PLAIN_SELECT_SQL.format(schema=schema),
+                "docid", "timestamp", "iuid")
+    else:
+        return (COMPACT_SELECT_SQL.format(schema=schema),
+                "e.docid", "e.timestamp", "e.id")
+
+def select(db, docid, limit=None, before=None, storage=None, schema="main"):
+    """Return the cursor for the log entries for the document, sorted by
+    reverse timestamp, starting after the cursor 'before', if given;
+    a string 'timestamp,key'. The diff is as stored; see 'get_diff'.
+    The entries in the other storage format, if any, are merged in;
+    the integer keys sort before the iuids, as in Sqlite3.
+    """
+    if before:
+        timestamp, sep, key = before.partition(",")
+        if not sep:
+            key = "~"           # Sorts after all iuids and integers.
+        elif key.isdigit() and len(key) < 20:
+            key = int(key)      # Not an iuid; those have 32 characters.
+    parts = []
+    params = []
+    for storage in get_storages(db, storage, schema):
+        sql, docid_column, timestamp_column, key_column = \
+            get_sql(storage, schema)
+        sql = [sql, f"WHERE {docid_column}=?"]
+        params.append(docid)
+        if before:
+            sql.append(f"AND ({timestamp_column}, {key_column}) < (?, ?)")
+            params.extend([timestamp, key])
+        sql.append(f"ORDER BY {timestamp_column} DESC, {key_column} DESC")
+        if limit is not None:
+            sql.append("LIMIT ?")
+            params.append(limit)
+        parts.append(" ".join(sql))
+    if len(parts) == 1:
+        return db.execute(parts[0], params)
+    sql = [" UNION ALL ".join(f"SELECT * FROM ({part})" for part in parts),
+           "ORDER BY timestamp DESC, key DESC"]
+    if limit is not None:
+        sql.append("LIMIT ?")
+        params.append(limit)
+    return db.execute(" ".join(sql), params)
+
+def get_diff(value):
+    "Return the diff JSON text of a stored diff, plain or compact."
+    if isinstance(value, str):
+        return value
+    return decode_diff(value)
+
+def delete(db, docid):
+    """Delete the log entries for the document, in both storage formats.
+    The caller handles the transaction.
+    """
+    db.execute("DELETE FROM logs WHERE docid=?", (docid,))
+    db.execute("DELETE FROM log_entries WHERE docid=?", (docid,))
+
+def migrate(db, storage, batch_size=1000, progress=None, schema="main"):
+    """Move all log entries from the other storage format into the given.
+    Each batch is moved in one transaction; the migration may be
+    interrupted and resumed. Return the number of entries moved.
+    """
+    if storage == constants.LOG_COMPACT:
+        source = ("SELECT rowid, iuid, docid, diff, timestamp, username,"
+                  " remote_addr, user_agent FROM {schema}.logs"
+                  " ORDER BY rowid LIMIT ?")
+        remove = "DELETE FROM {schema}.logs WHERE rowid <= ?"
+    else:
+        source = ("SELECT e.id, NULL, e.docid, e.diff, e.timestamp,"
+                  " u.value, a.value, g.value FROM {schema}.log_entries e"
+                  " LEFT JOIN {schema}.log_strings u ON u.id=e.username"
+                  " LEFT JOIN {schema}.log_strings a ON a.id=e.remote_addr"
+                  " LEFT JOIN {schema}.log_strings g ON g.id=e.user_agent"
+                  " ORDER BY e.id LIMIT ?")
+        remove = "DELETE FROM {schema}.log_entries WHERE id <= ?"
+    source = source.format(schema=schema)
+    remove = remove.format(schema=schema)
+    count = 0
+    while True:
+        rows = db.execute(source, (batch_size,)).fetchall()
+        if not rows: break
+        entries = []
+        for row in rows:
+            entries.append([row[1] or utils.get_iuid(),
+                            row[2],
+                            get_diff(row[3]),
+                            row[4],
+                            row[5],
+                            row[6],
+                            row[7]])
+        with db:
+            add(db, entries, storage=storage, schema=schema)
+            db.execute(remove, (rows[-1][0],))
+        count += len(rows)
+        if progress:
+            progress(count)
+    if storage == constants.LOG_PLAIN:
+        with db:
+            db.execute(f"DELETE FROM {schema}.log_strings WHERE NOT EXISTS"
+                       f" (SELECT 1 FROM {schema}.log_entries)")
+    return count
@@ -0,0 +1,120 @@
+"Background writer of log entries, in batches from a bounded queue."
+
+import atexit
+import os
+import queue
+import threading
+import time
+
+import flask
+
+from webapp import logstore
+from webapp import utils
+
+# Lock for creating the writer instance.
+_lock = threading.Lock()
+
+def get_writer():
+    "Get the log writer for the current app; create and start if needed."
+    app = flask.current_app._get_current_object()
+    with _lock:
+        writer = app.extensions.get("log_writer")
+        if writer is None or writer.pid != os.getpid():
+            config = app.config
+            writer = LogWriter(app,
+                               size=config["SAVER_LOG_QUEUE_SIZE"],
+                               batch_size=config["SAVER_LOG_BATCH_SIZE"],
+                               interval=config["SAVER_LOG_FLUSH_INTERVAL"],
+                               timeout=config["SAVER_LOG_QUEUE_TIMEOUT"])
+            app.extensions["log_writer"] = writer
+    return writer
+
+
+class LogWriter:
+    """Log entries are put on a bounded queue, and written by a thread
+    in one transaction per batch, or when the interval has passed.
+    If the queue is full for longer than the timeout, the entry is
+    written directly instead; it is never dropped.
+    The queue is flushed when the process exits.
+    """
+
+    def __init__(self, app, size=1000, batch_size=100, interval=1.0,
+                 timeout=5.0):
+        self.app = app
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=size)
+        # The counts are incremented by the request threads and the writer.
+        self.lock = threading.Lock()
+        self.counts = dict(queued=0, written=0, batches=0,
+                           overflows=0, errors=0)
+        self.thread = threading.Thread(target=self.run,
+                                       name="log-writer",
+                                       daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def put(self, values):
+        "Queue the values for a log entry. Write directly if full."
+        try:
+            self.queue.put(values, timeout=self.timeout)
+            self.count("queued")
+        except queue.Full:
+            self.count("overflows")
+            self.write([values])
+
+    def run(self):
+        """Write queued entries until the stop sentinel None is received.
+        A batch is written when full, or when the interval has passed
+        since its first entry was received.
+        """
+        while True:
+            values = self.queue.get()
+            if values is None: return
+            batch = [values]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    values = self.queue.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if values is None:
+                    self.write(batch)
+                    return
+                batch.append(values)
+            self.write(batch)
+
+    def write(self, batch):
+        "Write the batch of entries in a single transaction."
+        try:
+            with utils.connection(self.app) as db, db:
+                logstore.add(db, batch,
+                             storage=self.app.config["LOG_STORAGE"])
+        except Exception as error:
+            self.count("errors")
+            with self.app.app_context():
+                utils.get_logger().error(f"log writer: {error}")
+        else:
+            self.count("written", len(batch))
+            self.count("batches")
+
+    def count(self, key, number=1):
+        "Increment the count."
+        with self.lock:
+            self.counts[key] += number
+
+    def stop(self):
+        "Write all queued entries and stop the thread."
+        if self.pid != os.getpid() or not self.thread.is_alive(): return
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        "Return a dictionary of statistics for the writer."
+        result = dict(pending=self.queue.qsize())
+        with self.lock:
+            result.update(self.counts)
+        return result
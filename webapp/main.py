@@ -1,51 +1,116 @@
-"Web app template; main."
+"""Web app template; main.
+The app is created by 'create_app'. The module attribute 'app' is
+created on first access, for the WSGI server and the command-line
+interface. The modules initialized by 'create_app', and 'webapp.user',
+which is needed for the current user, are imported with this module;
+the other blueprints only when the app is created.
+"""
+
+import http.client
+import importlib
+import threading
 
 import flask
 import jinja2.utils
 
-import webapp.about
 import webapp.config
 import webapp.user
-import webapp.site
-# To be developed.
-# import webapp.entity
-
-import webapp.api.about
-import webapp.api.root
-import webapp.api.schema
-import webapp.api.user
+from webapp import applog
+from webapp import archive
+from webapp import compress
 from webapp import constants
+from webapp import jobs
+from webapp import metrics
+from webapp import migrations
+from webapp import profiler
+from webapp import search
 from webapp import utils
 
-app = flask.Flask(__name__)
+# The blueprints: module name and URL prefix.
+BLUEPRINTS = [("webapp.about", "/about"),
+              ("webapp.user", "/user"),
+              ("webapp.site", "/site"),
+              # To be developed.
+              # ("webapp.entity", "/entity"),
+              ("webapp.api.root", "/api"),
+              ("webapp.api.about", "/api/about"),
+              ("webapp.api.schema", "/api/schema"),
+              ("webapp.api.user", "/api/user"),
+              # To be developed.
+              # ("webapp.api.entity", "/api/entity"),
+              ]
+
+# The app created on first access of 'app'.
+_app = None
+
+# Lock for creating the app.
+_lock = threading.Lock()
+
+def __getattr__(name):
+    "Create the app on first access of the module attribute 'app'."
+    global _app
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if _app is None:
+        with _lock:
+            if _app is None:
+                _app = create_app()
+    return _app
+
+def create_app():
+    """Create the app: get the configuration, initialize modules
+    (database), and set up the URL map.
+    The schema of the database is migrated, if not current.
+    """
+    app = flask.Flask(__name__)
+
+    # Add URL map converters.
+    app.url_map.converters["identifier"] = utils.IdentifierConverter
+    app.url_map.converters["iuid"] = utils.IuidConverter
+
+    # Get the configuration, and initialize modules (database).
+    webapp.config.init(app)
+    applog.init(app)
+    utils.init(app)
+    migrations.init(app)
+    webapp.user.init(app)
+    search.init(app)
+    jobs.init(app)
+    utils.mail.init_app(app)
+    if app.config["METRICS"]:
+        metrics.init(app)
+    compress.init(app)
+    archive.init(app)
+
+    app.context_processor(setup_template_context)
+    app.before_request(prepare)
+    # Return the database connection to the pool; also outside of requests.
+    app.teardown_appcontext(utils.release_db)
+
+    # Set up the URL map.
+    app.add_url_rule("/", view_func=home)
+    app.add_url_rule("/debug", view_func=debug)
+    app.add_url_rule("/metrics", view_func=metrics_histograms)
+    app.add_url_rule("/profiler", view_func=profiler_statements,
+                     methods=["GET", "POST"])
+    app.add_url_rule("/status", view_func=status)
+    for name, url_prefix in BLUEPRINTS:
+        module = importlib.import_module(name)
+        app.register_blueprint(module.blueprint, url_prefix=url_prefix)
+    return app
 
-# Add URL map converters.
-app.url_map.converters["identifier"] = utils.IdentifierConverter
-app.url_map.converters["iuid"] = utils.IuidConverter
-
-# Get the configuration, and initialize modules (database).
-webapp.config.init(app)
-utils.init(app)
-webapp.user.init(app)
-utils.mail.init_app(app)
-
-@app.context_processor
 def setup_template_context():
     "Add useful stuff to the global context of Jinja2 templates."
     return dict(constants=constants,
                 csrf_token=utils.csrf_token)
 
-@app.before_request
 def prepare():
-    "Open the database connection; get the current user."
+    "Get a database connection from the pool; get the current user."
     flask.g.db = utils.get_db()
     flask.g.current_user = webapp.user.get_current_user()
     flask.g.am_admin = flask.g.current_user and \
                        flask.g.current_user["role"] == constants.ADMIN
 
-app.after_request(utils.log_access)
-
-@app.route("/")
 def home():
     "Home page. Redirect to API root if JSON is accepted."
     if utils.accept_json():
@@ -53,7 +118,6 @@ def home():
     else:
         return flask.render_template("home.html")
 
-@app.route("/debug")
 @utils.admin_required
 def debug():
     "Return some debug info for admin."
@@ -70,27 +134,45 @@ def debug():
     result.append("</table>")
     return jinja2.utils.Markup("\n".join(result))
 
-@app.route("/status")
-def status():
-    "Return JSON for the current status."
-    return dict(status="ok")
-
+@utils.admin_required
+def metrics_histograms():
+    """Return JSON for the request timing histograms per endpoint.
+    In Prometheus text format if the argument 'format' is 'prometheus'.
+    """
+    registry = flask.current_app.extensions.get("metrics")
+    if registry is None:
+        flask.abort(http.client.NOT_FOUND)
+    if flask.request.args.get("format") == "prometheus":
+        return flask.Response(registry.prometheus(),
+                              mimetype=constants.PROMETHEUS_MIMETYPE)
+    return utils.jsonify(utils.get_json(endpoints=registry.summary()))
 
-# Set up the URL map.
-app.register_blueprint(webapp.about.blueprint, url_prefix="/about")
-app.register_blueprint(webapp.user.blueprint, url_prefix="/user")
-app.register_blueprint(webapp.site.blueprint, url_prefix="/site")
-# To be developed.
-# app.register_blueprint(webapp.entity.blueprint, url_prefix="/entity")
+@utils.admin_required
+def profiler_statements():
+    "Display the Sqlite3 statement statistics and slow statements. Or reset."
+    if not flask.current_app.config["SQLITE3_PROFILER"]:
+        return utils.error("The Sqlite3 profiler is not enabled.")
+    if utils.http_POST():
+        profiler.registry.reset()
+        return flask.redirect(flask.url_for("profiler_statements"))
+    return flask.render_template("profiler.html",
+                                 statements=profiler.registry.summary(),
+                                 slow=list(profiler.registry.slow))
 
-app.register_blueprint(webapp.api.root.blueprint, url_prefix="/api")
-app.register_blueprint(webapp.api.about.blueprint, url_prefix="/api/about")
-app.register_blueprint(webapp.api.schema.blueprint, url_prefix="/api/schema")
-app.register_blueprint(webapp.api.user.blueprint, url_prefix="/api/user")
-# To be developed
-# app.register_blueprint(webapp.api.entity.blueprint, url_prefix="/api/entity")
+def status():
+    "Return JSON for the current status."
+    extensions = flask.current_app.extensions
+    result = dict(status="ok",
+                  sqlite3_pool=utils.get_pool().stats(),
+                  user_cache=extensions["user_cache"].stats(),
+                  jobs=jobs.get_counts(flask.g.db))
+    for key in ["log_writer", "password_hasher", "log_archiver",
+                "search_indexer", "job_worker", "log_queue"]:
+        if key in extensions:
+            result[key] = extensions[key].stats()
+    return result
 
 
 # This code is used only during development.
 if __name__ == "__main__":
-    app.run()
+    create_app().run()
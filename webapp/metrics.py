@@ -0,0 +1,199 @@
+"Request timing, Sqlite3 query timing and per-endpoint histograms."
+
+import sqlite3
+import threading
+import time
+
+import flask
+
+# Upper bounds of histogram buckets.
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, float("inf"))
+
+# The histograms recorded for each endpoint.
+HISTOGRAMS = [("wall", "request_duration_seconds", SECONDS_BUCKETS,
+               "Wall-clock time of request."),
+              ("cpu", "request_cpu_seconds", SECONDS_BUCKETS,
+               "CPU time of request thread."),
+              ("sql", "request_sql_seconds", SECONDS_BUCKETS,
+               "Time spent executing Sqlite3 statements."),
+              ("queries", "request_sql_queries", COUNT_BUCKETS,
+               "Number of Sqlite3 statements executed.")]
+
+def init(app):
+    "Add the request hooks for timing, and the histograms registry."
+    app.extensions["metrics"] = Registry()
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+
+class Cursor(sqlite3.Cursor):
+    "Cursor that records the time spent executing statements."
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(time.perf_counter() - start)
+
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record_query(time.perf_counter() - start)
+
+
+class Connection(sqlite3.Connection):
+    """Connection whose cursors record the time spent executing statements.
+    The shortcut methods must be redefined to use these cursors.
+    """
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or Cursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+def record_query(duration):
+    "Add the duration of a statement to the current request's counters."
+    if not flask.has_request_context(): return
+    g = flask.g
+    g.sql_queries = g.get("sql_queries", 0) + 1
+    g.sql_seconds = g.get("sql_seconds", 0.0) + duration
+
+def start_request():
+    "Record the start of the request."
+    flask.g.request_wall = time.perf_counter()
+    flask.g.request_cpu = time.thread_time()
+
+def finish_request(response):
+    """Record the timings of the request in the histograms of the endpoint.
+    Add the header Server-Timing to the response.
+    """
+    g = flask.g
+    if "request_wall" not in g: return response
+    timings = dict(wall=time.perf_counter() - g.request_wall,
+                   cpu=time.thread_time() - g.request_cpu,
+                   sql=g.get("sql_seconds", 0.0),
+                   queries=g.get("sql_queries", 0))
+    endpoint = flask.request.endpoint or "<unmatched>"
+    flask.current_app.extensions["metrics"].add(endpoint, timings)
+    response.headers.add("Server-Timing",
+                         f"app;dur={1000*timings['wall']:.1f},"
+                         f" cpu;dur={1000*timings['cpu']:.1f},"
+                         f" db;dur={1000*timings['sql']:.1f}"
+                         f";desc=\"{timings['queries']} queries\"")
+    return response
+
+
+class Histogram:
+    "Counts of observations in buckets given by their upper bounds."
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        for pos, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[pos] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        "Estimate of the quantile; the upper bound of its bucket."
+        if not self.count: return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self, scale=1):
+        "Return a dictionary summarizing the histogram."
+        if not self.count:
+            return dict(count=0)
+        return dict(count=self.count,
+                    mean=round(scale * self.sum / self.count, 3),
+                    p50=round(scale * self.quantile(0.5), 3),
+                    p95=round(scale * self.quantile(0.95), 3),
+                    p99=round(scale * self.quantile(0.99), 3),
+                    max=round(scale * self.max, 3))
+
+
+class Registry:
+    "Histograms per endpoint."
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def add(self, endpoint, timings):
+        with self.lock:
+            try:
+                histograms = self.endpoints[endpoint]
+            except KeyError:
+                histograms = dict((key, Histogram(buckets))
+                                  for key, name, buckets, text in HISTOGRAMS)
+                self.endpoints[endpoint] = histograms
+            for key, value in timings.items():
+                histograms[key].add(value)
+
+    def summary(self):
+        "Return a dictionary of summaries; times in milliseconds."
+        with self.lock:
+            result = {}
+            for endpoint, histograms in sorted(self.endpoints.items()):
+                result[endpoint] = dict(
+                    wall_ms=histograms["wall"].summary(1000),
+                    cpu_ms=histograms["cpu"].summary(1000),
+                    sql_ms=histograms["sql"].summary(1000),
+                    queries=histograms["queries"].summary())
+            return result
+
+    def prometheus(self, prefix="webapp"):
+        "Return the histograms in the Prometheus text exposition format."
+        lines = []
+        with self.lock:
+            for key, name, buckets, text in HISTOGRAMS:
+                lines.append(f"# HELP {prefix}_{name} {text}")
+                lines.append(f"# TYPE {prefix}_{name} histogram")
+                for endpoint, histograms in sorted(self.endpoints.items()):
+                    histogram = histograms[key]
+                    cumulative = 0
+                    for bound, count in zip(buckets, histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else bound
+                        lines.append(f'{prefix}_{name}_bucket'
+                                     f'{{endpoint="{endpoint}",le="{le}"}}'
+                                     f' {cumulative}')
+                    lines.append(f'{prefix}_{name}_sum'
+                                 f'{{endpoint="{endpoint}"}} {histogram.sum}')
+                    lines.append(f'{prefix}_{name}_count'
+                                 f'{{endpoint="{endpoint}"}} {histogram.count}')
+        lines.append("")
+        return "\n".join(lines)
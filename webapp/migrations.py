@@ -0,0 +1,254 @@
+"""Versioned migrations of the schema of the database.
+The steps are applied in order; the version of the schema, stored in
+'PRAGMA user_version', is the number of steps applied. At startup,
+only the version is read, unless there are steps to apply.
+A step that rebuilds a large table is 'online': on an existing database,
+it is applied only by 'cli.py --migrate', while the app is running;
+the rows are copied in chunks, so other writers are not locked out.
+"""
+
+import time
+
+import webapp.user
+from webapp import jobs
+from webapp import logstore
+from webapp import search
+from webapp import utils
+
+# The steps: name, function, and whether online.
+STEPS = []
+
+def step(online=False):
+    """Decorator adding the function as the next step. It is called with
+    the connection, the configuration and a progress function, or None.
+    A step that is not online is applied in one transaction.
+    """
+    def decorator(func):
+        STEPS.append((func.__name__, func, online))
+        return func
+    return decorator
+
+def init(app):
+    """Apply the steps needed to bring the schema up to the version of
+    the code. On an existing database, online steps are not applied;
+    a warning is logged, and the remaining steps are left for 'cli.py'.
+    """
+    with utils.connection(app) as db:
+        if get_version(db) == get_latest(): return
+        pending = migrate(db, app.config, startup=True)
+    if pending:
+        utils.get_logger().warning(
+            f"database schema version {get_latest() - len(pending)},"
+            f" code {get_latest()}; run 'cli.py --migrate' for the steps"
+            f" {', '.join(pending)}")
+
+def get_latest():
+    "Return the version of the schema of the code."
+    return len(STEPS)
+
+def get_version(db):
+    "Return the version of the schema of the database."
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+def get_pending(db):
+    "Return the names of the steps not yet applied."
+    return [name for name, func, online in STEPS[get_version(db):]]
+
+def migrate(db, config, progress=None, startup=False):
+    """Apply the steps not yet applied, in order. If 'startup', stop
+    at the first online step, unless the database is new. Online steps
+    must not be applied by more than one process at a time.
+    Return the names of the steps not applied.
+    """
+    version = get_version(db)
+    if version > get_latest():
+        raise ValueError(f"database schema version {version} is newer"
+                         f" than that of the code, {get_latest()}")
+    new = version == 0 and not db.execute("SELECT COUNT(*) FROM sqlite_master"
+                                          " WHERE type='table'").fetchone()[0]
+    for number, (name, func, online) in enumerate(STEPS, start=1):
+        if number <= version: continue
+        if online and not new:
+            if startup:
+                return [name for name, func, online in STEPS[number-1:]]
+            func(db, config, progress)
+            with utils.immediate(db):
+                set_version(db, number)
+        else:
+            with utils.immediate(db):
+                # Another process may have applied the step meanwhile.
+                if get_version(db) >= number: continue
+                func(db, config, progress)
+                set_version(db, number)
+    return []
+
+def set_version(db, version):
+    "Set the version of the schema of the database."
+    db.execute(f"PRAGMA user_version={int(version)}")
+
+def rebuild(db, table, create, indexes=(), chunk_size=1000, pause=0.0,
+            progress=None):
+    """Rebuild the table according to the new definition 'create',
+    a CREATE TABLE statement with '{table}' for the name of the table,
+    and the 'indexes', tuples of name and columns. The names of the
+    indexes must not be in use; the current indexes are dropped.
+    The columns present in both definitions are copied, keeping the rowids.
+    The triggers on the table are recreated.
+    Within a transaction, the rows are copied all at once. Otherwise,
+    in chunks, each in a transaction of its own; meanwhile, changes to
+    the table are mirrored into the new table by triggers. If interrupted,
+    a rebuild is started over.
+    Return the number of rows copied.
+    """
+    new = f"{table}_rebuild"
+    chunked = not db.in_transaction
+    mirrors = [f"{new}_{op}" for op in ("insert", "update", "delete")]
+    triggers = [row[1] for row in
+                db.execute("SELECT name, sql FROM sqlite_master"
+                           " WHERE type='trigger' AND tbl_name=?"
+                           " ORDER BY rowid", (table,))
+                if row[0] not in mirrors]
+    with utils.immediate(db):
+        for name in mirrors:
+            db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        db.execute(f"DROP TABLE IF EXISTS {new}")
+        db.execute(create.format(table=new))
+        for name, columns in indexes:
+            db.execute(f"CREATE INDEX {name} ON {new} ({columns})")
+        targets, sources = get_copy_columns(db, table, new)
+        if chunked:
+            def values(r):
+                return ", ".join(f"{r}.{s}" for s in sources)
+            db.execute(f"CREATE TRIGGER {mirrors[0]} AFTER INSERT ON {table}"
+                       f" BEGIN INSERT OR REPLACE INTO {new} ({targets})"
+                       f" VALUES ({values('new')}); END")
+            db.execute(f"CREATE TRIGGER {mirrors[1]} AFTER UPDATE ON {table}"
+                       f" BEGIN DELETE FROM {new} WHERE rowid=old.rowid;"
+                       f" INSERT OR REPLACE INTO {new} ({targets})"
+                       f" VALUES ({values('new')}); END")
+            db.execute(f"CREATE TRIGGER {mirrors[2]} AFTER DELETE ON {table}"
+                       f" BEGIN DELETE FROM {new} WHERE rowid=old.rowid; END")
+    sources = ", ".join(sources)
+    if chunked:
+        count = 0
+        position = -2**63
+        while True:
+            # Rows changed after being copied are mirrored by the triggers;
+            # rows mirrored before being reached are not copied again.
+            with utils.immediate(db):
+                last, n = db.execute(
+                    "SELECT MAX(k), COUNT(*) FROM"
+                    f" (SELECT rowid AS k FROM {table}"
+                    "  WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                    (position, chunk_size)).fetchone()
+                if not n: break
+                db.execute(f"INSERT OR IGNORE INTO {new} ({targets})"
+                           f" SELECT {sources} FROM {table}"
+                           " WHERE rowid > ? AND rowid <= ?", (position, last))
+            position = last
+            count += n
+            if progress:
+                progress(count)
+            time.sleep(pause)
+    else:
+        count = db.execute(f"INSERT INTO {new} ({targets})"
+                           f" SELECT {sources} FROM {table}").rowcount
+    with utils.immediate(db):
+        for name in mirrors:
+            db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        db.execute(f"DROP TABLE {table}")
+        # Views and triggers referring to the table are not to be checked
+        # or changed by the rename; they refer to the rebuilt table.
+        db.execute("PRAGMA legacy_alter_table=ON")
+        try:
+            db.execute(f"ALTER TABLE {new} RENAME TO {table}")
+        finally:
+            db.execute("PRAGMA legacy_alter_table=OFF")
+        for sql in triggers:
+            db.execute(sql)
+    return count
+
+def get_copy_columns(db, table, new):
+    """Return the columns of the new table to copy into, and the columns
+    of the table to copy from; the rowid first, unless it is a column
+    of both. An INTEGER PRIMARY KEY of the new table gets the rowid.
+    """
+    old_columns = [row[1] for row in db.execute(f"PRAGMA table_info({table})")]
+    new_info = list(db.execute(f"PRAGMA table_info({new})"))
+    primary = [row for row in new_info if row[5]]
+    if len(primary) == 1 and primary[0][2].upper() == "INTEGER":
+        rowid = primary[0][1]
+    else:
+        rowid = "rowid"
+    columns = [row[1] for row in new_info
+               if row[1] in old_columns and row[1] != rowid]
+    targets = [rowid] + columns
+    sources = [rowid if rowid in old_columns else "rowid"] + columns
+    return ", ".join(targets), sources
+
+
+@step()
+def baseline(db, config, progress):
+    """The schema before migrations: users, log entries in both storage
+    formats, search indexes and jobs. The functions called create the
+    schema of this version; later changes are made by new steps.
+    """
+    webapp.user.create_tables(db)
+    logstore.create_tables(db)
+    db.execute("DROP INDEX IF EXISTS logs_docid_index")
+    search.create_tables(db)
+    jobs.create_tables(db)
+
+@step(online=True)
+def logs_id(db, config, progress):
+    """Give the plain log entries an integer primary key, so that their
+    rowids, used by the search index, are not changed by VACUUM.
+    Index them by timestamp, for archiving by age.
+    """
+    rebuild(db, "logs",
+            "CREATE TABLE {table}"
+            "(id INTEGER PRIMARY KEY,"
+            " iuid TEXT NOT NULL UNIQUE,"
+            " docid TEXT NOT NULL,"
+            " diff TEXT NOT NULL,"
+            " username TEXT,"
+            " remote_addr TEXT,"
+            " user_agent TEXT,"
+            " timestamp TEXT NOT NULL)",
+            indexes=[("logs_docid_timestamp_iuid_index",
+                      "docid, timestamp, iuid"),
+                     ("logs_timestamp_index", "timestamp")],
+            chunk_size=config["MIGRATE_CHUNK_SIZE"],
+            pause=config["MIGRATE_PAUSE"],
+            progress=progress)
+
+@step(online=True)
+def log_entries_timestamp(db, config, progress):
+    "Index the compact log entries by timestamp, for archiving by age."
+    rebuild(db, "log_entries",
+            "CREATE TABLE {table}"
+            "(id INTEGER PRIMARY KEY,"
+            " docid TEXT NOT NULL,"
+            " diff BLOB NOT NULL,"
+            " timestamp TEXT NOT NULL,"
+            " username INTEGER,"
+            " remote_addr INTEGER,"
+            " user_agent INTEGER)",
+            indexes=[("log_entries_docid_timestamp_id_index",
+                      "docid, timestamp, id"),
+                     ("log_entries_timestamp_index", "timestamp")],
+            chunk_size=config["MIGRATE_CHUNK_SIZE"],
+            pause=config["MIGRATE_PAUSE"],
+            progress=progress)
+
+@step()
+def log_entries_fts_stored(db, config, progress):
+    """Index the compact log entries in an FTS5 table storing the text.
+    The triggers and the view used before decoded the diffs by a function
+    that only the connections of the app have, so that no other connection
+    could delete compact log entries. The existing rows are indexed anew
+    by the search indexer; see 'search.backfill'.
+    """
+    search.drop_index(db, "log_entries")
+    db.execute("DROP VIEW IF EXISTS log_entries_text")
+    search.create_index(db, "log_entries")
@@ -0,0 +1,203 @@
+"Pool of Sqlite3 database connections, reused within the worker process."
+
+import os
+import sqlite3
+import threading
+import time
+
+
+# The PRAGMAs that may be set in a profile, in the order they are applied.
+PROFILE_PRAGMAS = ["busy_timeout", "journal_mode", "synchronous",
+                   "cache_size", "mmap_size", "temp_store"]
+
+def apply_profile(db, profile):
+    "Set the PRAGMAs given in the profile; skip those given as None."
+    for key in PROFILE_PRAGMAS:
+        value = profile.get(key)
+        if value is None: continue
+        if not isinstance(value, int):
+            value = str(value).upper()
+            if not value.isalpha():
+                raise ValueError(f"invalid value for PRAGMA {key}: {value}")
+        db.execute(f"PRAGMA {key}={value}").fetchall()
+
+def get_pragmas(db):
+    "Return the current values of the profile PRAGMAs for the connection."
+    result = {}
+    for key in PROFILE_PRAGMAS:
+        result[key] = db.execute(f"PRAGMA {key}").fetchone()[0]
+    return result
+
+
+class PoolTimeout(Exception):
+    "No connection became available within the timeout."
+
+
+class ConnectionPool:
+    """Bounded pool of Sqlite3 connections.
+    A connection is handed out to one thread at a time, and is returned
+    to the pool when the request (application context) is torn down.
+    The pool is reset if the process has been forked, since a Sqlite3
+    connection must not be carried over into a child process.
+    The SQL functions, given as name: (number of args, callable),
+    are registered on every new connection.
+    """
+
+    def __init__(self, filepath, size=8, timeout=10.0, check_interval=60.0,
+                 profile=None, factory=sqlite3.Connection, functions=None):
+        self.filepath = filepath
+        self.factory = factory
+        self.functions = functions or {}
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.profile = profile or {}
+        self.lock = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        "Forget all connections; used initially and after a fork."
+        self.pid = os.getpid()
+        self.idle = []          # List of (connection, time released).
+        self.in_use = 0
+        self.last_checkpoint = time.monotonic()
+        self.counts = dict(created=0, reused=0, closed=0,
+                           waits=0, timeouts=0, health_failures=0,
+                           checkpoints=0)
+
+    def connect(self):
+        "Create a new connection, and apply the PRAGMAs of the profile."
+        db = sqlite3.connect(self.filepath, check_same_thread=False,
+                             factory=self.factory)
+        db.row_factory = sqlite3.Row
+        for name, (narg, func) in self.functions.items():
+            db.create_function(name, narg, func, deterministic=True)
+        try:
+            apply_profile(db, self.profile)
+        except Exception:
+            db.close()
+            raise
+        self.count("created")
+        return db
+
+    def acquire(self):
+        """Get a connection from the pool, or create a new one.
+        Wait for a connection to be released if the pool is exhausted.
+        Raise PoolTimeout if none became available within the timeout.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            deadline = None
+            while not self.idle and self.in_use >= self.size:
+                if deadline is None:
+                    self.counts["waits"] += 1
+                    deadline = time.monotonic() + self.timeout
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.lock.wait(remaining):
+                    self.counts["timeouts"] += 1
+                    raise PoolTimeout("no Sqlite3 connection available")
+            self.in_use += 1
+            if self.idle:
+                db, released = self.idle.pop() # Most recently used.
+            else:
+                db = None
+        try:
+            if db is None:
+                return self.connect()
+            if time.monotonic() - released > self.check_interval and \
+               not self.healthy(db):
+                self.discard(db)
+                return self.connect()
+            self.count("reused")
+            return db
+        except Exception:
+            with self.lock:
+                self.in_use -= 1
+                self.lock.notify()
+            raise
+
+    def release(self, db):
+        """Return the connection to the pool.
+        Any transaction left open is rolled back.
+        Run a WAL checkpoint using the connection first, if one is due.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                return          # Belongs to the parent process; forget it.
+            checkpoint = self.checkpoint_due()
+        if checkpoint:
+            self.checkpoint(db)
+        with self.lock:
+            self.in_use -= 1
+            try:
+                if db.in_transaction:
+                    db.rollback()
+            except sqlite3.Error:
+                self.discard(db)
+            else:
+                self.idle.append((db, time.monotonic()))
+            self.lock.notify()
+
+    def count(self, key):
+        """Increment the count. The lock is reentrant, so this may also
+        be called with it held.
+        """
+        with self.lock:
+            self.counts[key] += 1
+
+    def checkpoint_due(self):
+        """Is it time for a WAL checkpoint? Only one thread gets True.
+        Must be called with the lock held.
+        """
+        interval = self.profile.get("checkpoint_interval")
+        if not interval: return False
+        if str(self.profile.get("journal_mode")).upper() != "WAL": return False
+        now = time.monotonic()
+        if now - self.last_checkpoint < interval: return False
+        self.last_checkpoint = now
+        return True
+
+    def checkpoint(self, db):
+        """Copy the WAL contents back into the database file,
+        without waiting for readers or writers.
+        """
+        try:
+            if db.in_transaction:
+                db.rollback()
+            db.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+            self.count("checkpoints")
+        except sqlite3.Error:
+            pass
+
+    def healthy(self, db):
+        "Is the connection usable?"
+        try:
+            db.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            self.count("health_failures")
+            return False
+
+    def discard(self, db):
+        "Close the connection without returning it to the pool."
+        try:
+            db.close()
+        except sqlite3.Error:
+            pass
+        self.count("closed")
+
+    def close_all(self):
+        "Close all idle connections."
+        with self.lock:
+            while self.idle:
+                self.discard(self.idle.pop()[0])
+
+    def stats(self):
+        "Return a dictionary of statistics for the pool."
+        with self.lock:
+            result = dict(size=self.size,
+                          in_use=self.in_use,
+                          idle=len(self.idle))
+            result.update(self.counts)
+            return result
@@ -0,0 +1,198 @@
+"Profiler for Sqlite3 statements; slow-query log and query plans."
+
+import collections
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from webapp import metrics
+
+# Query plan detail for a scan of a whole table, possibly in index order.
+# A scan in index order may stop early, as for ORDER BY with LIMIT.
+FULL_SCAN_RX = re.compile(r"^SCAN (?!CONSTANT ROW)")
+
+def init(app):
+    "Configure the profiler from the settings."
+    config = app.config
+    registry.slow_seconds = config["SQLITE3_SLOW_QUERY_MS"] / 1000.0
+    registry.explain_all = config["SQLITE3_EXPLAIN_ALL"]
+    registry.log_name = config["LOG_NAME"]
+
+
+class Statement:
+    "Accumulated statistics for a statement text."
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.shapes = set()
+        self.plan = None
+        self.full_scan = False
+
+    @property
+    def mean_ms(self):
+        return round(1000 * self.seconds / self.count, 3) if self.count else 0
+
+
+class Registry:
+    """Statistics per statement, and the most recent slow statements.
+    Each distinct statement is explained at most once, when first slow,
+    or when first seen if 'explain_all' is set.
+    """
+
+    def __init__(self, slow_seconds=0.1, explain_all=False, size=100):
+        self.slow_seconds = slow_seconds
+        self.explain_all = explain_all
+        self.log_name = None
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.slow = collections.deque(maxlen=size)
+
+    def record(self, db, sql, parameters, shape, seconds):
+        """Record an execution of the statement. Return its statistics.
+        The parameters are used only when explaining the statement.
+        """
+        sql = " ".join(sql.split())
+        with self.lock:
+            try:
+                statement = self.statements[sql]
+            except KeyError:
+                statement = self.statements[sql] = Statement(sql)
+            statement.count += 1
+            statement.seconds += seconds
+            statement.max_seconds = max(statement.max_seconds, seconds)
+            statement.shapes.add(shape)
+        slow = seconds >= self.slow_seconds
+        if statement.plan is None and (slow or self.explain_all):
+            self.explain(db, statement, parameters)
+        if slow:
+            self.slow.appendleft(dict(sql=sql,
+                                      shape=shape,
+                                      ms=round(1000 * seconds, 3),
+                                      full_scan=statement.full_scan,
+                                      time=time.time()))
+            if self.log_name:
+                logging.getLogger(self.log_name).warning(
+                    "slow query %.1f ms%s: %s", 1000 * seconds,
+                    " (full scan)" if statement.full_scan else "", sql)
+        return statement
+
+    def explain(self, db, statement, parameters):
+        "Get the query plan for the statement, and look for full scans."
+        if not statement.sql.split(" ", 1)[0].upper() in \
+           ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+            statement.plan = []
+            return
+        try:
+            cursor = sqlite3.Cursor(db)
+            cursor.execute(f"EXPLAIN QUERY PLAN {statement.sql}", parameters)
+            statement.plan = [row[3] for row in cursor]
+        except sqlite3.Error as error:
+            statement.plan = [f"error: {error}"]
+        statement.full_scan = any(FULL_SCAN_RX.match(d)
+                                  for d in statement.plan)
+
+    def summary(self):
+        "Return the statement statistics, sorted by total time."
+        with self.lock:
+            statements = sorted(self.statements.values(),
+                                key=lambda s: s.seconds, reverse=True)
+            return [dict(sql=s.sql,
+                         count=s.count,
+                         total_ms=round(1000 * s.seconds, 3),
+                         mean_ms=s.mean_ms,
+                         max_ms=round(1000 * s.max_seconds, 3),
+                         rows=s.rows,
+                         shapes=sorted(s.shapes),
+                         plan=s.plan,
+                         full_scan=s.full_scan)
+                    for s in statements]
+
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+            self.slow.clear()
+
+# The registry for the process.
+registry = Registry()
+
+def get_shape(parameters):
+    "Return the shape of the parameters: types only, never the values."
+    if isinstance(parameters, dict):
+        items = [f"{k}:{type(v).__name__}" for k, v in parameters.items()]
+    else:
+        items = [type(v).__name__ for v in parameters]
+    return f"({','.join(items)},)" if items else "()"
+
+
+class Cursor(metrics.Cursor):
+    "Cursor that records statement statistics, including rows returned."
+
+    statement = None
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.statement = registry.record(self.connection, sql,
+                                             parameters,
+                                             get_shape(parameters),
+                                             time.perf_counter() - start)
+            if self.rowcount > 0:
+                self.statement.rows += self.rowcount
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        if seq_of_parameters:
+            first = seq_of_parameters[0]
+        else:
+            first = ()
+        shape = f"{len(seq_of_parameters)}*{get_shape(first)}"
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.statement = registry.record(self.connection, sql,
+                                             first, shape,
+                                             time.perf_counter() - start)
+            if self.rowcount > 0:
+                self.statement.rows += self.rowcount
+
+    def __next__(self):
+        row = super().__next__()
+        if self.statement:
+            self.statement.rows += 1
+        return row
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None and self.statement:
+            self.statement.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        rows = super().fetchmany(size)
+        if self.statement:
+            self.statement.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if self.statement:
+            self.statement.rows += len(rows)
+        return rows
+
+
+class Connection(metrics.Connection):
+    "Connection whose cursors are profiled."
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or Cursor)
@@ -1,30 +1,88 @@
 "Base entity saver context class."
 
 import copy
+import difflib
 import json
 import os.path
+import sqlite3
 import sys
 
 import flask
 
 from webapp import constants
+from webapp import jsoncodec
+from webapp import logstore
+from webapp import logwriter
 from webapp import utils
 
 
+# Marker for a key not in the original document.
+MISSING = object()
+
+
 class BaseSaver:
-    "Base entity saver context."
+    """Base entity saver context.
+    Changes must be made via item assignment on the saver, or its setters,
+    to be tracked. Only the keys so touched are copied and compared.
+    """
 
+    TABLE = None                # Name of the table for the entity.
+    KEYS = []                   # Columns of the table; 'iuid' is the key.
     EXCLUDE_PATHS = [["modified"]]
     HIDDEN_VALUE_PATHS = []
+    UNIQUE_ERRORS = {}          # Message for violation of 'table.column'.
+
+    # Native UPSERT with RETURNING requires Sqlite3 3.35.0.
+    NATIVE_UPSERT = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+    @classmethod
+    def get_sql(cls):
+        """Return the statements for inserting and updating the entity.
+        Created once for each class; kept in the class.
+        """
+        try:
+            return cls.__dict__["_sql"]
+        except KeyError:
+            pass
+        keys = cls.KEYS
+        columns = ",".join(keys)
+        marks = ",".join("?" * len(keys))
+        # The key 'iuid' and the time of creation are never updated.
+        updated = [k for k in keys if k not in ("iuid", "created")]
+        cls._sql = dict(
+            upsert=f"INSERT INTO {cls.TABLE} ({columns}) VALUES ({marks})"
+                   " ON CONFLICT (iuid) DO UPDATE SET"
+                   f" {','.join(f'{k}=excluded.{k}' for k in updated)}"
+                   " RETURNING created",
+            exists=f"SELECT COUNT(*) FROM {cls.TABLE} WHERE iuid=?",
+            insert=f"INSERT INTO {cls.TABLE} ({columns}) VALUES ({marks})",
+            update=f"UPDATE {cls.TABLE} SET"
+                   f" {','.join(f'{k}=?' for k in updated)} WHERE iuid=?")
+        return cls._sql
+
+    @classmethod
+    def get_paths(cls):
+        """Return the excluded and the hidden value paths as sets of tuples.
+        Created once for each class; kept in the class.
+        """
+        try:
+            return cls.__dict__["_paths"]
+        except KeyError:
+            pass
+        cls._paths = (frozenset(tuple(p) for p in cls.EXCLUDE_PATHS),
+                      frozenset(tuple(p) for p in cls.HIDDEN_VALUE_PATHS))
+        return cls._paths
 
     def __init__(self, doc=None):
+        # Copies of the original values of the keys touched; all if new.
+        self.original = {}
         if doc is None:
-            self.original = {}
+            self.is_new = True
             self.doc = {"iuid": utils.get_iuid(),
                         "created": utils.get_time()}
             self.initialize()
         else:
-            self.original = copy.deepcopy(doc)
+            self.is_new = False
             self.doc = doc
         self.prepare()
 
@@ -34,16 +92,42 @@ class BaseSaver:
     def __exit__(self, etyp, einst, etb):
         if etyp is not None: return False
         self.finalize()
-        self.doc["modified"] = utils.get_time()
-        self.upsert()
-        self.add_log()
+        self["modified"] = utils.get_time()
+        mode = flask.current_app.config["SAVER_LOG_MODE"]
+        try:
+            with flask.g.db:
+                self.upsert()
+                if mode == constants.SAVER_LOG_SINGLE:
+                    self.add_log()
+        except sqlite3.IntegrityError as error:
+            self.raise_unique_error(error)
+            raise
+        self.committed()
+        if mode == constants.SAVER_LOG_SEPARATE:
+            with flask.g.db:
+                self.add_log()
+        elif mode == constants.SAVER_LOG_QUEUE:
+            logwriter.get_writer().put(self.get_log_values())
 
     def __getitem__(self, key):
-        return self.doc[key]
+        "A dict or list value may be modified in place; track it."
+        value = self.doc[key]
+        if isinstance(value, (dict, list)):
+            self.touch(key)
+        return value
 
     def __setitem__(self, key, value):
+        self.touch(key)
         self.doc[key] = value
 
+    def touch(self, key):
+        "Keep a copy of the original value of the key, unless done already."
+        if self.is_new or key in self.original: return
+        try:
+            self.original[key] = copy.deepcopy(self.doc[key])
+        except KeyError:
+            self.original[key] = MISSING
+
     def initialize(self):
         "Initialize the new entity."
         pass
@@ -57,20 +141,62 @@ class BaseSaver:
         pass
 
     def upsert(self):
-        "Actually insert or update the entity in the database."
-        raise NotImplementedError
+        """Actually insert or update the entity in the database.
+        Called within a transaction. Uses the native UPSERT if available.
+        """
+        sql = self.get_sql()
+        if self.NATIVE_UPSERT:
+            rows = flask.g.db.execute(sql["upsert"],
+                                      [self.doc.get(k) for k in self.KEYS])
+            self.doc["created"] = rows.fetchall()[0][0]
+        else:
+            rows = flask.g.db.execute(sql["exists"], (self.doc["iuid"],))
+            if rows.fetchone()[0] == 0:
+                flask.g.db.execute(sql["insert"],
+                                   [self.doc.get(k) for k in self.KEYS])
+            else:
+                values = [self.doc.get(k) for k in self.KEYS
+                          if k not in ("iuid", "created")]
+                values.append(self.doc["iuid"])
+                flask.g.db.execute(sql["update"], values)
+        self.upserted()
+
+    def raise_unique_error(self, error):
+        """Raise ValueError with the message for the unique constraint
+        violated, if any is given in UNIQUE_ERRORS.
+        """
+        message = str(error)
+        prefix = "UNIQUE constraint failed: "
+        if not message.startswith(prefix): return
+        for column in message[len(prefix):].split(", "):
+            try:
+                raise ValueError(self.UNIQUE_ERRORS[column]) from error
+            except KeyError:
+                pass
+
+    def upserted(self):
+        """Operations after the entity has been inserted or updated.
+        Called within the same transaction.
+        """
+        pass
+
+    def committed(self):
+        """Operations after the transaction inserting or updating the entity
+        has been committed.
+        """
+        pass
 
     def add_log(self):
         """Add a log entry recording the the difference betweens the current
-        and the original entity.
+        and the original entity. The caller handles the transaction.
         """
-        self.stack = []
-        diff = self.diff(self.original, self.doc)
-        entry = {"diff": diff,
-                 "timestamp": utils.get_time()}
+        logstore.add(flask.g.db, [self.get_log_values()])
+
+    def get_log_values(self):
+        "Return the row values for the log entry."
         values = [utils.get_iuid(),
                   self.doc["iuid"],
-                  json.dumps(diff),
+                  jsoncodec.dumps(self.get_diff()),
                   utils.get_time()]
         if hasattr(flask.g, "current_user") and flask.g.current_user:
             values.append(flask.g.current_user["username"])
@@ -82,58 +208,38 @@ class BaseSaver:
         else:
             values.append(None)
             values.append(os.path.basename(sys.argv[0]))
-        with flask.g.db:
-            flask.g.db.execute("INSERT INTO logs "
-                               " ('iuid', 'docid', 'diff',"
-                               "  'timestamp', 'username',"
-                               " 'remote_addr', 'user_agent')"
-                               " VALUES (?,?,?,?,?,?,?)", values)
-
-    def diff(self, old, new):
-        """Find the differences between the old and the new documents.
-        Uses a fairly simple algorithm which is OK for shallow hierarchies.
+        return values
+
+    def get_diff(self):
+        "Return the differences between the original and the current entity."
+        if self.is_new:
+            return self.diff({}, self.doc)
+        old = dict((k, v) for k, v in self.original.items() if v is not MISSING)
+        new = dict((k, self.doc[k]) for k in self.original if k in self.doc)
+        return self.diff(old, new)
+
+    def diff(self, old, new, path=()):
+        """Find the differences between the old and the new dictionaries.
+        Values are compared recursively only where not equal.
         """
+        exclude, hidden = self.get_paths()
         added = {}
         removed = {}
         updated = {}
-        new_keys = set(new.keys())
-        old_keys = set(old.keys())
-        for key in new_keys.difference(old_keys):
-            self.stack.append(key)
-            if self.stack not in self.EXCLUDE_PATHS:
-                if self.stack in self.HIDDEN_VALUE_PATHS:
-                    added[key] = "<hidden>"
-                else:
-                    added[key] = new[key]
-            self.stack.pop()
-        for key in old_keys.difference(new_keys):
-            self.stack.append(key)
-            if self.stack not in self.EXCLUDE_PATHS:
-                if self.stack in self.HIDDEN_VALUE_PATHS:
-                    removed[key] = "<hidden>"
-                else:
-                    removed[key] = old[key]
-            self.stack.pop()
-        for key in new_keys.intersection(old_keys):
-            self.stack.append(key)
-            if self.stack not in self.EXCLUDE_PATHS:
-                new_value = new[key]
-                old_value = old[key]
-                if isinstance(new_value, dict) and isinstance(old_value, dict):
-                    changes = self.diff(old_value, new_value)
-                    if changes:
-                        if self.stack in self.HIDDEN_VALUE_PATHS:
-                            updated[key] = "<hidden>"
-                        else:
-                            updated[key] = changes
-                elif new_value != old_value:
-                    if self.stack in self.HIDDEN_VALUE_PATHS:
-                        updated[key]= dict(new_value="<hidden>",
-                                           old_value="<hidden>")
-                    else:
-                        updated[key]= dict(new_value= new_value,
-                                           old_value=old_value)
-            self.stack.pop()
+        for key, new_value in new.items():
+            key_path = path + (key,)
+            if key_path in exclude: continue
+            if key not in old:
+                added[key] = "<hidden>" if key_path in hidden else new_value
+                continue
+            update = self.get_update(old[key], new_value, key_path)
+            if update is not None:
+                updated[key] = update
+        for key, old_value in old.items():
+            if key in new: continue
+            key_path = path + (key,)
+            if key_path in exclude: continue
+            removed[key] = "<hidden>" if key_path in hidden else old_value
         result = {}
         if added:
             result['added'] = added
@@ -142,3 +248,69 @@ class BaseSaver:
         if updated:
             result['updated'] = updated
         return result
+
+    def diff_list(self, old, new, path):
+        """Find the differences between the old and the new lists.
+        Keys are the indexes, as strings, also in the paths; of the new
+        list for those added or updated, of the old list for those removed.
+        Elements are matched regardless of the order of keys in dicts.
+        """
+        exclude, hidden = self.get_paths()
+        matcher = difflib.SequenceMatcher(None,
+                                          [get_match_key(v) for v in old],
+                                          [get_match_key(v) for v in new],
+                                          autojunk=False)
+        added = {}
+        removed = {}
+        updated = {}
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal": continue
+            if tag == "replace" and i2 - i1 == j2 - j1:
+                for i, j in zip(range(i1, i2), range(j1, j2)):
+                    update = self.get_update(old[i], new[j], path + (str(j),))
+                    if update is not None:
+                        updated[str(j)] = update
+            else:
+                for i in range(i1, i2):
+                    key_path = path + (str(i),)
+                    if key_path in exclude: continue
+                    removed[str(i)] = "<hidden>" if key_path in hidden \
+                                      else old[i]
+                for j in range(j1, j2):
+                    key_path = path + (str(j),)
+                    if key_path in exclude: continue
+                    added[str(j)] = "<hidden>" if key_path in hidden \
+                                    else new[j]
+        result = {}
+        if added:
+            result['added'] = added
+        if removed:
+            result['removed'] = removed
+        if updated:
+            result['updated'] = updated
+        return result
+
+    def get_update(self, old_value, new_value, path):
+        """Return the record of the update of the value at the path;
+        None if it is excluded, or there are no changes.
+        """
+        exclude, hidden = self.get_paths()
+        if path in exclude or new_value == old_value: return None
+        if path in hidden:
+            if isinstance(new_value, dict) and isinstance(old_value, dict):
+                return "<hidden>"
+            return dict(new_value="<hidden>", old_value="<hidden>")
+        return self.get_changes(old_value, new_value, path) or None
+
+    def get_changes(self, old_value, new_value, path):
+        "Return the changes between the differing values."
+        if isinstance(new_value, dict) and isinstance(old_value, dict):
+            return self.diff(old_value, new_value, path)
+        if isinstance(new_value, list) and isinstance(old_value, list):
+            return self.diff_list(old_value, new_value, path)
+        return dict(new_value=new_value, old_value=old_value)
+
+
+def get_match_key(value):
+    "Return the key for matching list elements; JSON with sorted keys."
+    return json.dumps(value, sort_keys=True, default=str)
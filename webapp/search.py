@@ -0,0 +1,321 @@
+"""Full-text search of users and log entries, by Sqlite3 FTS5 indexes.
+The indexes of users and plain log entries are external-content FTS5
+tables kept in sync by triggers. Rows existing when an index is created
+are indexed in chunks by a background thread; the triggers handle only
+the rows already indexed, and those added after, so no row is indexed
+twice. The diffs of compact log entries are decoded by a function that
+only the connections of the app have, so their index stores the text
+itself: it is added by 'logstore.add', and removed by a trigger using
+only the rowid. Any connection may thus delete compact log entries.
+"""
+
+import os
+import re
+import threading
+import time
+
+import flask
+
+from webapp import constants
+from webapp import logstore
+from webapp import utils
+
+# The indexes: the table, its rowid column and the columns whose update
+# triggers reindexing, the FTS5 table, its content table, or None if
+# it stores the text, and the expressions for the indexed values;
+# '{r}' is the row reference.
+INDEXES = {
+    "users": dict(table="users",
+                  rowid="rowid",
+                  columns=["username", "email", "role", "status"],
+                  fts="users_fts",
+                  content="users",
+                  options="prefix='2 3'",
+                  values={"username": "{r}.username",
+                          "email": "{r}.email",
+                          "role": "{r}.role",
+                          "status": "{r}.status"}),
+    "logs": dict(table="logs",
+                 rowid="rowid",
+                 columns=["diff", "username"],
+                 fts="logs_fts",
+                 content="logs",
+                 options="",
+                 values={"diff": "{r}.diff",
+                         "username": "{r}.username"}),
+    "log_entries": dict(table="log_entries",
+                        rowid="id",
+                        columns=["diff", "username"],
+                        fts="log_entries_fts",
+                        content=None,
+                        options="",
+                        values={"diff": "log_decode({r}.diff)",
+                                "username": "(SELECT value FROM log_strings"
+                                            " WHERE id={r}.username)"}),
+}
+
+# The log index for each storage format.
+LOG_INDEXES = {constants.LOG_PLAIN: "logs",
+               constants.LOG_COMPACT: "log_entries"}
+
+# Lock for creating the indexer instance.
+_lock = threading.Lock()
+
+def init(app):
+    "Start the indexing of existing rows on first request, if enabled."
+    if app.config["SEARCH_BACKFILL"]:
+        app.before_request(start_indexer)
+
+def create_tables(db):
+    """Create the search indexes, their triggers and state, if not done;
+    see 'migrations'.
+    """
+    db.execute("CREATE TABLE IF NOT EXISTS search_state"
+               "(name TEXT PRIMARY KEY,"
+               " position INTEGER NOT NULL,"
+               " high INTEGER NOT NULL)")
+    for name in INDEXES:
+        create_index(db, name)
+
+def create_index(db, name):
+    """Create the FTS5 table and the triggers for the index, if not done.
+    When created, record the highest rowid of the existing rows;
+    those are indexed by 'backfill'.
+    """
+    index = INDEXES[name]
+    if index["content"] is None:
+        create_stored_index(db, name)
+        return
+    fts = index["fts"]
+    columns = ", ".join(index["values"])
+    options = f", {index['options']}" if index["options"] else ""
+    rowid = index["rowid"]
+    def values(r):
+        return ", ".join(v.format(r=r) for v in index["values"].values())
+    def indexed(r):
+        return (f"(SELECT {r}.{rowid} <= position OR {r}.{rowid} > high"
+                f" FROM search_state WHERE name='{name}')")
+    # Transaction started explicitly, so that only one process creates
+    # the index and records the rows to be indexed.
+    with utils.immediate(db):
+        cursor = db.execute("SELECT COUNT(*) FROM sqlite_master"
+                            " WHERE type='table' AND name=?", (fts,))
+        if not cursor.fetchone()[0]:
+            db.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5"
+                       f"({columns}, content='{index['content']}',"
+                       f" content_rowid='{rowid}'{options})")
+            cursor = db.execute(f"SELECT MAX({rowid}) FROM {index['table']}")
+            db.execute("INSERT OR REPLACE INTO search_state"
+                       " (name, position, high) VALUES (?, 0, ?)",
+                       (name, cursor.fetchone()[0] or 0))
+        db.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_insert"
+                   f" AFTER INSERT ON {index['table']}"
+                   f" WHEN {indexed('new')} BEGIN"
+                   f" INSERT INTO {fts} (rowid, {columns})"
+                   f" VALUES (new.{rowid}, {values('new')}); END")
+        db.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_delete"
+                   f" AFTER DELETE ON {index['table']}"
+                   f" WHEN {indexed('old')} BEGIN"
+                   f" INSERT INTO {fts} ({fts}, rowid, {columns})"
+                   f" VALUES ('delete', old.{rowid}, {values('old')}); END")
+        db.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_update"
+                   f" AFTER UPDATE OF {', '.join(index['columns'])}"
+                   f" ON {index['table']}"
+                   f" WHEN {indexed('old')} BEGIN"
+                   f" INSERT INTO {fts} ({fts}, rowid, {columns})"
+                   f" VALUES ('delete', old.{rowid}, {values('old')});"
+                   f" INSERT INTO {fts} (rowid, {columns})"
+                   f" VALUES (new.{rowid}, {values('new')}); END")
+
+def create_stored_index(db, name):
+    """Create the FTS5 table storing the text, and the trigger removing
+    a deleted row, if not done. The rows are added by 'logstore.add';
+    the rows existing when created are indexed by 'backfill'.
+    """
+    index = INDEXES[name]
+    fts = index["fts"]
+    with utils.immediate(db):
+        cursor = db.execute("SELECT COUNT(*) FROM sqlite_master"
+                            " WHERE type='table' AND name=?", (fts,))
+        if not cursor.fetchone()[0]:
+            db.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5"
+                       f"({', '.join(index['values'])})")
+            cursor = db.execute(f"SELECT MAX({index['rowid']})"
+                                f" FROM {index['table']}")
+            db.execute("INSERT OR REPLACE INTO search_state"
+                       " (name, position, high) VALUES (?, 0, ?)",
+                       (name, cursor.fetchone()[0] or 0))
+        db.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_delete"
+                   f" AFTER DELETE ON {index['table']} BEGIN"
+                   f" DELETE FROM {fts} WHERE rowid=old.{index['rowid']};"
+                   f" END")
+
+def drop_index(db, name):
+    "Drop the FTS5 table and the triggers for the index, and its state."
+    fts = INDEXES[name]["fts"]
+    for suffix in ("insert", "delete", "update"):
+        db.execute(f"DROP TRIGGER IF EXISTS {fts}_{suffix}")
+    db.execute(f"DROP TABLE IF EXISTS {fts}")
+    db.execute("DELETE FROM search_state WHERE name=?", (name,))
+
+def get_state(db):
+    "Return the indexing state: for each index, its position and high."
+    return dict((row[0], dict(position=row[1], high=row[2]))
+                for row in db.execute("SELECT name, position, high"
+                                      " FROM search_state"))
+
+def backfill(db, name, chunk_size):
+    """Index the next chunk of the rows existing when the index was created.
+    Return the number of rows indexed; 0 when the index is complete.
+    """
+    index = INDEXES[name]
+    rowid = index["rowid"]
+    values = ", ".join(v.format(r="r") for v in index["values"].values())
+    # Transaction started explicitly, so that concurrent indexers
+    # do not index the same chunk.
+    db.execute("BEGIN IMMEDIATE")
+    with db:
+        position, high = db.execute("SELECT position, high FROM search_state"
+                                    " WHERE name=?", (name,)).fetchone()
+        if position >= high: return 0
+        cursor = db.execute(f"SELECT MAX(k), COUNT(*) FROM"
+                            f" (SELECT {rowid} AS k FROM {index['table']}"
+                            f"  WHERE {rowid} > ? AND {rowid} <= ?"
+                            f"  ORDER BY {rowid} LIMIT ?)",
+                            (position, high, chunk_size))
+        last, count = cursor.fetchone()
+        if last is None:
+            last = high
+        else:
+            # A stored index may already have a row added after creation
+            # with a rowid no higher than 'high'; replaced, not repeated.
+            conflict = "OR REPLACE" if index["content"] is None else ""
+            db.execute(f"INSERT {conflict} INTO {index['fts']}"
+                       f" (rowid, {', '.join(index['values'])})"
+                       f" SELECT r.{rowid}, {values}"
+                       f" FROM {index['table']} r"
+                       f" WHERE r.{rowid} > ? AND r.{rowid} <= ?",
+                       (position, last))
+        db.execute("UPDATE search_state SET position=? WHERE name=?",
+                   (last, name))
+    return count
+
+def rebuild(db):
+    """Rebuild all indexes from their content; needed after a VACUUM,
+    which may change the rowids of the tables 'users' and 'logs'.
+    """
+    with db:
+        for name, index in INDEXES.items():
+            db.execute(f"INSERT INTO {index['fts']} ({index['fts']})"
+                       " VALUES ('rebuild')")
+        db.execute("UPDATE search_state SET position=high")
+
+def get_match(query):
+    """Return the FTS5 MATCH expression for the words of the query:
+    all must match; the last as a prefix. Raise ValueError if no words.
+    """
+    words = re.findall(r"\w+", query or "")
+    if not words:
+        raise ValueError("No words to search for.")
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def search_users(query, limit, offset=0):
+    """Return the users matching the query, best first; at most 'limit',
+    starting at 'offset', and whether there are more.
+    """
+    cursor = flask.g.db.execute(
+        "SELECT u.iuid, u.username, u.email, u.role, u.status"
+        " FROM users_fts f JOIN users u ON u.rowid=f.rowid"
+        " WHERE users_fts MATCH ?"
+        " ORDER BY bm25(users_fts, 10.0, 5.0, 1.0, 1.0), u.username"
+        " LIMIT ? OFFSET ?",
+        (get_match(query), limit + 1, offset))
+    users = [dict(row) for row in cursor]
+    return users[:limit], len(users) > limit
+
+def search_logs(query, limit, offset=0):
+    """Return the log entries matching the query, best first, newest first
+    when equally good; at most 'limit', starting at 'offset', and whether
+    there are more. Also those in the other storage format, if any;
+    see 'logstore'. Archived log entries are not indexed.
+    """
+    match = get_match(query)
+    parts = []
+    params = []
+    for storage in logstore.get_storages(flask.g.db):
+        index = INDEXES[LOG_INDEXES[storage]]
+        fts = index["fts"]
+        parts.append(f"SELECT l.timestamp AS timestamp, l.docid AS docid,"
+                     f" f.username AS username,"
+                     f" snippet({fts}, 0, '[', ']', '...', 12) AS snippet,"
+                     f" bm25({fts}) AS rank"
+                     f" FROM {fts} f JOIN {index['table']} l"
+                     f" ON l.{index['rowid']}=f.rowid"
+                     f" WHERE {fts} MATCH ?")
+        params.append(match)
+    cursor = flask.g.db.execute(" UNION ALL ".join(parts) +
+                                " ORDER BY rank, timestamp DESC"
+                                " LIMIT ? OFFSET ?",
+                                params + [limit + 1, offset])
+    logs = [dict(row) for row in cursor]
+    for log in logs:
+        log.pop("rank")
+    return logs[:limit], len(logs) > limit
+
+def start_indexer():
+    "Ensure that the indexer has been started in this process."
+    get_indexer()
+
+def get_indexer():
+    "Get the indexer for the current app; create and start if needed."
+    app = flask.current_app._get_current_object()
+    with _lock:
+        indexer = app.extensions.get("search_indexer")
+        if indexer is None or indexer.pid != os.getpid():
+            indexer = Indexer(app,
+                              chunk_size=app.config["SEARCH_BACKFILL_CHUNK_SIZE"],
+                              pause=app.config["SEARCH_BACKFILL_PAUSE"])
+            app.extensions["search_indexer"] = indexer
+    return indexer
+
+
+class Indexer:
+    """Thread indexing the rows existing when the indexes were created,
+    one chunk per transaction, pausing between chunks to let other
+    writers in. The thread ends when all indexes are complete.
+    """
+
+    def __init__(self, app, chunk_size=1000, pause=0.05):
+        self.app = app
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.pid = os.getpid()
+        self.counts = dict(indexed=0, errors=0)
+        self.thread = threading.Thread(target=self.run,
+                                       name="search-indexer",
+                                       daemon=True)
+        self.thread.start()
+
+    def run(self):
+        "Index chunks until all indexes are complete."
+        try:
+            with utils.connection(self.app) as db:
+                for name in INDEXES:
+                    while True:
+                        count = backfill(db, name, self.chunk_size)
+                        if not count: break
+                        self.counts["indexed"] += count
+                        time.sleep(self.pause)
+        except Exception as error:
+            self.counts["errors"] += 1
+            with self.app.app_context():
+                utils.get_logger().error(f"search indexer: {error}")
+
+    def stats(self):
+        "Return a dictionary of statistics for the indexer."
+        with utils.connection(self.app) as db:
+            state = get_state(db)
+        return dict(running=self.thread.is_alive(), state=state,
+                    **self.counts)
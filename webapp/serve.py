@@ -0,0 +1,405 @@
+"""Production server: a master process preloads the app, and forks
+worker processes serving requests on a shared listening socket;
+TCP, or a Unix socket behind a reverse proxy.
+The app, its templates and the URL map are loaded before forking,
+so that the memory is shared copy-on-write between the workers.
+Each worker serves at most SERVE_THREADS requests concurrently, and
+is replaced after SERVE_MAX_REQUESTS requests, if set.
+Signals to the master:
+  SIGHUP           Reload: create the app again, with the settings read
+                   anew, start new workers, and stop the old gracefully.
+                   The code is not reloaded; restart for that.
+  SIGTERM, SIGINT  Stop: the workers finish the requests in progress.
+Run 'python -m webapp.serve' or 'cli.py --serve'.
+"""
+
+import argparse
+import gc
+import os
+import random
+import select
+import signal
+import socket
+import stat
+import sys
+import threading
+import time
+
+import werkzeug.serving
+
+import webapp.main
+from webapp import applog
+from webapp import utils
+
+# Signals handled by the master process.
+SIGNALS = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD)
+
+# Seconds a worker must have run to be replaced at once when it exits.
+MIN_LIFETIME = 1.0
+
+def preload(app):
+    """Load what is otherwise loaded on first use: the templates and
+    the URL map. Close the database connections of the process; they
+    must not be carried over into the workers.
+    """
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    app.url_map.update()
+    utils.get_pool(app).close_all()
+
+def get_socket(bind):
+    """Return the listening socket for the address 'host:port' or
+    'unix:/path/to/socket', and the host and port for the server.
+    """
+    if bind.startswith("unix:"):
+        path = os.path.abspath(bind[len("unix:"):])
+        # Remove a socket file left by a previous run.
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(socket.SOMAXCONN)
+        return sock, f"unix://{path}", 0
+    host, sep, port = bind.rpartition(":")
+    if not sep:
+        raise ValueError(f"invalid address '{bind}'; 'host:port' expected")
+    host = host.strip("[]")
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.create_server((host, int(port)), family=family,
+                                backlog=socket.SOMAXCONN)
+    return sock, host, sock.getsockname()[1]
+
+
+class Master:
+    """Master process: start and stop the worker processes, and replace
+    those that exit. Settings not given are taken from those of the app.
+    """
+
+    def __init__(self, bind=None, workers=None, threads=None,
+                 max_requests=None):
+        self.options = dict(SERVE_BIND=bind,
+                            SERVE_WORKERS=workers,
+                            SERVE_THREADS=threads,
+                            SERVE_MAX_REQUESTS=max_requests)
+        self.pid = os.getpid()
+        self.workers = {}           # pid -> (generation, start time)
+        self.generation = 0
+        self.signals = []
+        self.respawn_after = 0.0
+        self.load()
+
+    def load(self):
+        """Create and preload the app; get the settings. The logger is
+        set up anew, since its settings may have changed.
+        """
+        applog.reset()
+        app = webapp.main.create_app()
+        self.config = dict(app.config)
+        for key, value in self.options.items():
+            if value is not None:
+                self.config[key] = value
+        preload(app)
+        self.app = app
+        # Objects existing now are not touched by garbage collection in
+        # the workers, which would otherwise copy the memory pages.
+        gc.collect()
+        gc.freeze()
+
+    @property
+    def count(self):
+        "The number of worker processes to run."
+        return self.config["SERVE_WORKERS"] or os.cpu_count() or 1
+
+    def run(self):
+        "Serve until stopped by a signal."
+        bind = self.config["SERVE_BIND"]
+        self.socket, self.host, self.port = get_socket(bind)
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.wakeup[1])
+        for signum in SIGNALS:
+            signal.signal(signum, lambda signum, frame:
+                          self.signals.append(signum))
+        print(f"serving at {bind}, {self.count} workers"
+              f" of {self.config['SERVE_THREADS']} threads", file=sys.stderr)
+        try:
+            while True:
+                self.spawn_workers()
+                select.select([self.wakeup[0]], [], [], 1.0)
+                try:
+                    while os.read(self.wakeup[0], 512): pass
+                except BlockingIOError:
+                    pass
+                self.reap()
+                while self.signals:
+                    signum = self.signals.pop(0)
+                    if signum == signal.SIGHUP:
+                        self.reload()
+                    elif signum in (signal.SIGTERM, signal.SIGINT):
+                        self.stop()
+                        return
+        finally:
+            if os.getpid() == self.pid:
+                self.close()
+
+    def spawn_workers(self):
+        "Start workers of the current generation, up to the count."
+        if time.monotonic() < self.respawn_after: return
+        current = [pid for pid, (generation, started) in self.workers.items()
+                   if generation == self.generation]
+        for n in range(self.count - len(current)):
+            pid = os.fork()
+            if pid == 0:
+                self.run_worker()
+            self.workers[pid] = (self.generation, time.monotonic())
+
+    def run_worker(self):
+        "Run in the worker process; never returns."
+        status = 1
+        try:
+            for signum in SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
+            for fd in self.wakeup:
+                os.close(fd)
+            worker = Worker(self.app, self.socket, self.host, self.port,
+                            self.config)
+            worker.run()
+            status = 0
+        except BaseException as error:
+            self.log_error(f"server worker {os.getpid()}: {error}")
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def reap(self):
+        """Forget the workers that have exited. If one did so right after
+        starting, wait before starting another.
+        """
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid: break
+            generation, started = self.workers.pop(pid, (None, 0.0))
+            if generation is None: continue
+            if os.waitstatus_to_exitcode(status) != 0:
+                self.log_error(f"server worker {pid} exited with status"
+                               f" {os.waitstatus_to_exitcode(status)}")
+            if time.monotonic() - started < MIN_LIFETIME:
+                self.respawn_after = time.monotonic() + MIN_LIFETIME
+
+    def reload(self):
+        """Create the app again and start new workers; stop the old ones
+        when the new have been started. Keep the old if the app fails.
+        """
+        try:
+            self.load()
+        except Exception as error:
+            self.log_error(f"server reload failed: {error}")
+            return
+        old = list(self.workers)
+        self.generation += 1
+        self.respawn_after = 0.0
+        self.spawn_workers()
+        self.signal_workers(old, signal.SIGTERM)
+        print(f"reloaded, {self.count} workers", file=sys.stderr)
+
+    def stop(self):
+        """Stop the workers gracefully; kill those not stopped within
+        the timeout.
+        """
+        self.signal_workers(self.workers, signal.SIGTERM)
+        deadline = time.monotonic() + self.config["SERVE_TIMEOUT"] + 1.0
+        while self.workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+            self.reap()
+        self.signal_workers(self.workers, signal.SIGKILL)
+        self.reap()
+
+    def signal_workers(self, pids, signum):
+        "Send the signal to the worker processes."
+        for pid in list(pids):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def close(self):
+        "Close the listening socket; remove its file, if a Unix socket."
+        self.socket.close()
+        if self.host.startswith("unix://"):
+            try:
+                os.unlink(self.host[len("unix://"):])
+            except FileNotFoundError:
+                pass
+        signal.set_wakeup_fd(-1)
+        for fd in self.wakeup:
+            os.close(fd)
+
+    def log_error(self, message):
+        "Log the error message."
+        applog.get_logger(self.app).error(message)
+
+
+class Worker:
+    """Worker process: serve requests until stopped by SIGTERM, or
+    the max number of requests has been reached. Then finish the requests
+    in progress and stop the background threads of the app.
+    """
+
+    def __init__(self, app, sock, host, port, config):
+        self.app = app
+        self.config = config
+        max_requests = config["SERVE_MAX_REQUESTS"]
+        if max_requests:
+            # Spread out, so that the workers are not replaced together.
+            max_requests += random.randint(0, max_requests // 10)
+        self.server = Server(host, port, app, sock.fileno(),
+                             threads=config["SERVE_THREADS"],
+                             max_requests=max_requests,
+                             keepalive=config["SERVE_KEEPALIVE"])
+
+    def run(self):
+        "Serve until stopped; then clean up."
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.server.stop())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        gc.enable()
+        try:
+            self.server.serve_forever(poll_interval=0.5)
+            self.server.wait(self.config["SERVE_TIMEOUT"])
+        finally:
+            self.server.server_close()
+            self.cleanup()
+
+    def cleanup(self):
+        "Stop the background threads of the app; write queued log records."
+        extensions = self.app.extensions
+        for key in ["job_worker", "log_archiver", "log_writer"]:
+            component = extensions.get(key)
+            if component is None or component.pid != os.getpid(): continue
+            if key == "job_worker":
+                component.stop(self.config["SERVE_TIMEOUT"])
+            else:
+                component.stop()
+        utils.get_pool(self.app).close_all()
+        applog.stop()
+
+
+class Server(werkzeug.serving.BaseWSGIServer):
+    """WSGI server on an existing listening socket, shared with other
+    processes. With more than one thread, each request is handled in
+    a thread of its own, at most 'threads' at a time; when all are busy,
+    no more connections are accepted, and other processes get them.
+    """
+
+    multiprocess = True
+
+    def __init__(self, host, port, app, fd, threads=1, max_requests=None,
+                 keepalive=5.0):
+        # Must be set before the base class checks it.
+        self.multithread = threads > 1
+        super().__init__(host, port, self.call_app, handler=RequestHandler,
+                         fd=fd)
+        self.wsgi_app = app
+        self.max_requests = max_requests
+        self.keepalive = keepalive
+        self.slots = threading.BoundedSemaphore(threads)
+        self.lock = threading.Lock()
+        self.threads = set()
+        self.requests = 0
+        self.stopping = False
+
+    def call_app(self, environ, start_response):
+        "Call the app; stop when the max number of requests is reached."
+        with self.lock:
+            self.requests += 1
+            last = self.requests == self.max_requests
+        if last:
+            self.stop()
+        return self.wsgi_app(environ, start_response)
+
+    def process_request(self, request, client_address):
+        if not self.multithread:
+            super().process_request(request, client_address)
+            return
+        self.slots.acquire()
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address),
+                                  daemon=True)
+        with self.lock:
+            self.threads.add(thread)
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        "Handle the request in this thread; release the slot when done."
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.lock:
+                self.threads.discard(threading.current_thread())
+            self.slots.release()
+
+    def stop(self):
+        """Stop accepting connections. May be called from a request
+        or a signal handler; the loop is stopped by another thread.
+        """
+        with self.lock:
+            if self.stopping: return
+            self.stopping = True
+        threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def wait(self, timeout):
+        "Wait for the requests in progress to finish, at most 'timeout'."
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+
+class RequestHandler(werkzeug.serving.WSGIRequestHandler):
+    """An idle connection is closed after the keep-alive timeout.
+    Access is logged by the app, not here; see 'applog'.
+    """
+
+    def setup(self):
+        self.timeout = self.server.keepalive
+        super().setup()
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m webapp.serve",
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-b", "--bind",
+                        help="'host:port' or 'unix:/path/to/socket';"
+                        " default SERVE_BIND.")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="Number of processes; default SERVE_WORKERS,"
+                        " else the number of CPUs.")
+    parser.add_argument("-t", "--threads", type=int,
+                        help="Max concurrent requests per process;"
+                        " default SERVE_THREADS.")
+    parser.add_argument("--max-requests", type=int,
+                        help="Replace a process after this many requests;"
+                        " default SERVE_MAX_REQUESTS.")
+    args = parser.parse_args()
+    Master(bind=args.bind,
+           workers=args.workers,
+           threads=args.threads,
+           max_requests=args.max_requests).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,17 +5,19 @@ import os.path
 
 import flask
 
+from webapp import compress
+
 
 blueprint = flask.Blueprint("site", __name__)
 
 @blueprint.route("/static/<filename>")
 def static(filename):
-    "Static file for the site."
+    "Static file for the site; precompressed if available and accepted."
     dirpath = flask.current_app.config["SITE_STATIC_DIRPATH"]
     if not dirpath:
         raise ValueError("misconfiguration: no SITE_STATIC_DIRPATH set")
     dirpath = os.path.expandvars(os.path.expanduser(dirpath))
     if dirpath:
-        return flask.send_from_directory(dirpath, filename)
+        return compress.send_static(dirpath, filename)
     else:
         flask.abort(http.client.NOT_FOUND)
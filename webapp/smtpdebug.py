@@ -0,0 +1,131 @@
+"""Local SMTP server for debugging and tests; the messages are kept
+in memory, and optionally printed, but never delivered.
+Run 'python -m webapp.smtpdebug' and set MAIL_SERVER and MAIL_PORT
+to its address. Commands are answered after an optional delay,
+to mimic a slow server; the recipients given in 'refuse' are refused.
+"""
+
+import argparse
+import socketserver
+import sys
+import threading
+import time
+
+
+class Handler(socketserver.StreamRequestHandler):
+    "Handle one SMTP session; just enough of RFC 5321 for smtplib."
+
+    def reply(self, line):
+        time.sleep(self.server.delay)
+        self.wfile.write(f"{line}\r\n".encode("ascii"))
+
+    def handle(self):
+        self.reply("220 localhost debugging SMTP server")
+        sender = None
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line: return
+            command = line.decode("utf-8", "replace").strip()
+            verb = command[:4].upper()
+            if verb in ("HELO", "EHLO"):
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                sender = command.partition(":")[2].strip().strip("<>")
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipient = command.partition(":")[2].strip().strip("<>")
+                if recipient in self.server.refuse:
+                    self.reply("550 Recipient refused")
+                else:
+                    recipients.append(recipient)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b".\r\n", b".\n"): break
+                    if line.startswith(b".."):
+                        line = line[1:]
+                    data.append(line)
+                self.server.add(sender, recipients, b"".join(data))
+                self.reply("250 OK")
+            elif verb == "RSET":
+                sender = None
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "NOOP":
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class Server(socketserver.ThreadingTCPServer):
+    "SMTP server keeping the messages received in the list 'messages'."
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=("localhost", 8025), delay=0.0, refuse=(),
+                 verbose=False):
+        super().__init__(address, Handler)
+        self.delay = delay
+        self.refuse = set(refuse)
+        self.verbose = verbose
+        self.messages = []
+        self.sessions = 0
+        self.lock = threading.Lock()
+
+    def add(self, sender, recipients, data):
+        "Record the message; print it if verbose."
+        with self.lock:
+            self.messages.append(dict(sender=sender,
+                                      recipients=recipients,
+                                      data=data))
+        if self.verbose:
+            print(f"---------- from {sender} to {', '.join(recipients)}")
+            print(data.decode("utf-8", "replace"))
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.sessions += 1
+        super().process_request(request, client_address)
+
+    def start(self):
+        "Serve in a background thread; for tests. Return self."
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m webapp.smtpdebug",
+                                     description=__doc__)
+    parser.add_argument("-H", "--host", default="localhost")
+    parser.add_argument("-p", "--port", type=int, default=8025)
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="Seconds before each reply.")
+    parser.add_argument("--refuse", action="append", default=[],
+                        metavar="ADDRESS", help="Refuse this recipient.")
+    args = parser.parse_args()
+    server = Server((args.host, args.port), delay=args.delay,
+                    refuse=args.refuse, verbose=True)
+    print(f"debugging SMTP server at {args.host}:{server.port}",
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
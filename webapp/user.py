@@ -6,35 +6,63 @@ import json
 
 import flask
 import flask_mail
-from werkzeug.security import check_password_hash, generate_password_hash
 
+from webapp import archive
+from webapp import cache
 from webapp import constants
+from webapp import hashing
+from webapp import jobs
+from webapp import logstore
 from webapp import utils
 from webapp.saver import BaseSaver
 
 KEYS = ["iuid", "username", "email", "role", "status",
         "password", "apikey", "created", "modified"]
 
+# Columns of the list of all users, in the order displayed.
+ALL_COLUMNS = ["username", "email", "role", "status", "modified"]
+
+# Search for a substring of username or email; see '_like_pattern'.
+SEARCH_SQL = r"WHERE (username LIKE ? ESCAPE '\' OR email LIKE ? ESCAPE '\')"
+
+# Usernames that would be shadowed by API endpoints.
+RESERVED_USERNAMES = {"search"}
+
 def init(app):
-    "Initialize the database: create user table."
-    db = utils.get_db(app)
-    with db:
-        db.execute("CREATE TABLE IF NOT EXISTS users"
-                   "(iuid TEXT PRIMARY KEY,"
-                   " username TEXT NOT NULL,"
-                   " email TEXT NOT NULL,"
-                   " role TEXT NOT NULL,"
-                   " status TEXT NOT NULL,"
-                   " password TEXT,"
-                   " apikey TEXT,"
-                   " created TEXT NOT NULL,"
-                   " modified TEXT NOT NULL)")
-        db.execute("CREATE UNIQUE INDEX IF NOT EXISTS"
-                   " users_username_index ON users (username COLLATE NOCASE)")
-        db.execute("CREATE UNIQUE INDEX IF NOT EXISTS"
-                   " users_email_index ON users (email COLLATE NOCASE)")
-        db.execute("CREATE UNIQUE INDEX IF NOT EXISTS"
-                   " users_apikey_index ON users (apikey)")
+    "Set up the cache of users."
+    app.extensions["user_cache"] = cache.LRUCache(
+        size=app.config["USER_CACHE_SIZE"],
+        ttl=app.config["USER_CACHE_TTL"])
+
+def create_tables(db):
+    "Create the user table and its indexes, if not done; see 'migrations'."
+    db.execute("CREATE TABLE IF NOT EXISTS users"
+               "(iuid TEXT PRIMARY KEY,"
+               " username TEXT NOT NULL,"
+               " email TEXT NOT NULL,"
+               " role TEXT NOT NULL,"
+               " status TEXT NOT NULL,"
+               " password TEXT,"
+               " apikey TEXT,"
+               " created TEXT NOT NULL,"
+               " modified TEXT NOT NULL)")
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS"
+               " users_username_index ON users (username COLLATE NOCASE)")
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS"
+               " users_email_index ON users (email COLLATE NOCASE)")
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS"
+               " users_apikey_index ON users (apikey)")
+    db.execute("CREATE INDEX IF NOT EXISTS"
+               " users_role_index ON users (role, status)")
+    db.execute("CREATE INDEX IF NOT EXISTS"
+               " users_status_index ON users (status)")
+    db.execute("CREATE INDEX IF NOT EXISTS"
+               " users_created_index ON users (created)")
+    # Counter incremented on every change of users; for invalidating
+    # the user cache in other processes.
+    db.execute("CREATE TABLE IF NOT EXISTS generations"
+               "(name TEXT PRIMARY KEY,"
+               " value INTEGER NOT NULL)")
 
 blueprint = flask.Blueprint("user", __name__)
 
@@ -133,7 +161,7 @@ def register():
                                          recipients=emails)
             url = utils.url_for(".display", username=user["username"])
             message.body = f"To enable the user account, go to {url}"
-            utils.mail.send(message)
+            jobs.send_mail(message)
             utils.get_logger().info(f"pending user {user['username']}")
             utils.flash_message("User account created; an email will be sent"
                                 " when it has been enabled by the admin.")
@@ -193,7 +221,7 @@ def password():
                     if user["password"] != f"code:{code}": raise ValueError
                 else:
                     password = flask.request.form.get("current_password") or ""
-                    if not check_password_hash(user["password"], password):
+                    if not hashing.check(user["password"], password):
                         raise ValueError
             except ValueError:
                 if flask.current_app.config["MAIL_SERVER"]:
@@ -247,15 +275,16 @@ def edit(username):
                                      deletable=deletable)
 
     elif utils.http_POST():
-        with UserSaver(user) as saver:
-            if flask.g.am_admin:
-                email = flask.request.form.get("email")
-                if email != user["email"]:
-                    saver.set_email(email)
-            if am_admin_and_not_self(user):
-                saver.set_role(flask.request.form.get("role"))
-            if flask.request.form.get("apikey"):
-                saver.set_apikey()
+        try:
+            with UserSaver(user) as saver:
+                if flask.g.am_admin:
+                    saver.set_email(flask.request.form.get("email") or "")
+                if am_admin_and_not_self(user):
+                    saver.set_role(flask.request.form.get("role"))
+                if flask.request.form.get("apikey"):
+                    saver.set_apikey()
+        except ValueError as error:
+            return utils.error(error)
         return flask.redirect(
             flask.url_for(".display", username=user["username"]))
 
@@ -263,10 +292,13 @@ def edit(username):
         if not is_empty(user):
             return utils.error("Cannot delete non-empty user account.")
         with flask.g.db:
-            flask.g.db.execute("DELETE FROM logs WHERE docid=?",(user["iuid"],))
+            logstore.delete(flask.g.db, user["iuid"])
             flask.g.db.execute("DELETE FROM users "
                                " WHERE username=? COLLATE NOCASE",
                                (username,))
+            signal_users_modified()
+        invalidate_user_cache(user)
+        archive.delete(flask.g.db, user["iuid"])
         utils.flash_message(f"Deleted user {username}.")
         utils.get_logger().info(f"deleted user {username}")
         if flask.g.am_admin:
@@ -283,18 +315,63 @@ def logs(username):
         return utils.error("No such user.")
     if not am_admin_or_self(user):
         return utils.error("Access not allowed.")
+    limit = utils.get_limit()
+    archived = utils.to_bool(flask.request.args.get("archived"))
+    logs, next = utils.get_logs_page(user["iuid"], limit,
+                                     before=flask.request.args.get("before"),
+                                     archived=archived)
+    if next:
+        next = flask.url_for(".logs", username=user["username"],
+                             limit=limit, before=next,
+                             archived=archived or None)
     return flask.render_template(
         "logs.html",
         title=f"User {user['username']}",
         cancel_url=flask.url_for(".display", username=user["username"]),
         api_logs_url=flask.url_for("api_user.logs", username=user["username"]),
-        logs=utils.get_logs(user["iuid"]))
+        logs=logs,
+        next_url=next,
+        archived_url=None if archived else
+                     flask.url_for(".logs", username=user["username"],
+                                   limit=limit, archived=True))
 
 @blueprint.route("/all")
 @utils.admin_required
 def all():
-    "Display list of all users."
-    return flask.render_template("user/all.html", users=get_users())
+    "Display list of all users. The rows are fetched by 'all_data'."
+    return flask.render_template("user/all.html")
+
+@blueprint.route("/all/data")
+@utils.admin_required
+def all_data():
+    "Return a page of all users according to the DataTables server protocol."
+    args = flask.request.args
+    config = flask.current_app.config
+    try:
+        draw = int(args.get("draw", 0))
+        offset = max(0, int(args.get("start", 0)))
+        limit = int(args.get("length", config["PAGE_SIZE"]))
+        column = int(args.get("order[0][column]", 0))
+        order = ALL_COLUMNS[column]
+    except (ValueError, IndexError):
+        flask.abort(http.client.BAD_REQUEST)
+    if limit < 0:               # DataTables: -1 means all.
+        limit = config["PAGE_MAX_SIZE"]
+    limit = min(limit, config["PAGE_MAX_SIZE"])
+    descending = args.get("order[0][dir]") == "desc"
+    search = args.get("search[value]") or None
+    total = count_users()
+    data = [dict((k, u[k]) for k in ALL_COLUMNS)
+            for u in query_users(search=search,
+                                 order=order,
+                                 descending=descending,
+                                 offset=offset,
+                                 limit=limit)]
+    return utils.jsonify(dict(draw=draw,
+                              recordsTotal=total,
+                              recordsFiltered=count_users(search)
+                                              if search else total,
+                              data=data))
 
 @blueprint.route("/enable/<identifier:username>", methods=["POST"])
 @utils.admin_required
@@ -331,14 +408,19 @@ def disable(username):
 class UserSaver(BaseSaver):
     "User document saver context."
 
+    TABLE = "users"
+    KEYS = KEYS
     HIDDEN_VALUE_PATHS = [["password"]]
+    UNIQUE_ERRORS = {"users.username": "Username already in use.",
+                     "users.email": "Email already in use.",
+                     "users.apikey": "API key already in use."}
 
     def initialize(self):
         "Set the status for a new user."
         if flask.current_app.config["USER_ENABLE_IMMEDIATELY"]:
-            self.doc["status"] = constants.ENABLED
+            self["status"] = constants.ENABLED
         else:
-            self.doc["status"] = constants.PENDING
+            self["status"] = constants.PENDING
 
     def finalize(self):
         "Check that required fields have been set."
@@ -350,71 +432,77 @@ class UserSaver(BaseSaver):
         "Username can be set only when creating the account."
         if "username" in self.doc:
             raise ValueError("Username cannot be changed.")
-        if not constants.ID_RX.match(username):
+        if not constants.ID_RX.match(username or ""):
             raise ValueError("Invalid username; must be an identifier.")
-        if get_user(username=username):
-            raise ValueError("Username already in use.")
-        self.doc["username"] = username
+        if username.lower() in RESERVED_USERNAMES:
+            raise ValueError("Invalid username; reserved.")
+        self["username"] = username
 
     def set_email(self, email):
+        "Set the email, if changed."
         email = email.lower()
+        if email == self.doc.get("email"): return
         if not constants.EMAIL_RX.match(email):
             raise ValueError("Invalid email.")
-        if get_user(email=email):
-            raise ValueError("Email already in use.")
-        self.doc["email"] = email
+        self["email"] = email
         if self.doc.get("status") == constants.PENDING:
             for expr in flask.current_app.config["USER_ENABLE_EMAIL_WHITELIST"]:
                 if fnmatch.fnmatch(email, expr):
                     self.set_status(constants.ENABLED)
                     break
 
+    def check_unique(self):
+        """Raise ValueError if the username, email or API key is used by
+        another user. Not needed when saving, since the unique indexes
+        are checked then; for validation without saving.
+        """
+        cursor = flask.g.db.execute(
+            "SELECT username, email, apikey FROM users WHERE iuid!=? AND"
+            " (username=? COLLATE NOCASE OR email=? COLLATE NOCASE"
+            "  OR apikey=?) LIMIT 1",
+            (self.doc["iuid"], self.doc.get("username"),
+             self.doc.get("email"), self.doc.get("apikey")))
+        row = cursor.fetchone()
+        if row is None: return
+        for key in ["username", "email", "apikey"]:
+            value = self.doc.get(key)
+            if value and row[key] and value.lower() == row[key].lower():
+                raise ValueError(self.UNIQUE_ERRORS[f"users.{key}"])
+
     def set_status(self, status):
         if status not in constants.USER_STATUSES:
             raise ValueError("Invalid status.")
-        self.doc["status"] = status
+        self["status"] = status
 
     def set_role(self, role):
         if role not in constants.USER_ROLES:
             raise ValueError("Invalid role.")
-        self.doc["role"] = role
+        self["role"] = role
 
     def set_password(self, password=None):
         "Set the password; a one-time code if no password provided."
-        config = flask.current_app.config
         if password is None:
-            self.doc["password"] = "code:%s" % utils.get_iuid()
+            self["password"] = "code:%s" % utils.get_iuid()
         else:
-            if len(password) < config["MIN_PASSWORD_LENGTH"]:
-                raise ValueError("Password too short.")
-            self.doc["password"] = generate_password_hash(
-                password, salt_length=config["SALT_LENGTH"])
-            print("set password")
+            self.check_password(password)
+            self["password"] = hashing.generate(password)
+
+    def check_password(self, password):
+        "Raise ValueError if the password is not acceptable."
+        if len(password) < flask.current_app.config["MIN_PASSWORD_LENGTH"]:
+            raise ValueError("Password too short.")
 
     def set_apikey(self):
         "Set a new API key."
-        self.doc["apikey"] = utils.get_iuid()
-
-    def upsert(self):
-        "Actually insert or update the user in the database."
-        # Cannot use the Sqlite3 native UPSERT: was included only in v 3.24.0
-        cursor = flask.g.db.cursor()
-        rows = list(cursor.execute("SELECT COUNT(*) FROM users WHERE iuid=?",
-                                   (self.doc["iuid"],)))
-        if rows[0][0] == 0:
-            with flask.g.db:
-                cursor.execute(f"INSERT INTO users ({','.join(KEYS)})"
-                               f" VALUES ({','.join('?'*len(KEYS))})",
-                               [self.doc.get(k) for k in KEYS])
-        else:
-            with flask.g.db:
-                keys = KEYS[1:] # Skip 'iuid'
-                assignments = [f"{k}=?" for k in keys]
-                values = [self.doc.get(k) for k in keys]
-                values.append(self.doc["iuid"])
-                cursor.execute("UPDATE users SET"
-                               f" {','.join(assignments)}"
-                               "WHERE iuid=?", values)
+        self["apikey"] = utils.get_iuid()
+
+    def upserted(self):
+        "Signal the other processes that the users have been modified."
+        signal_users_modified()
+
+    def committed(self):
+        "Remove the user from the cache."
+        invalidate_user_cache(self.doc)
 
 # Utility functions
 
@@ -439,7 +527,9 @@ def get_user(username=None, email=None, apikey=None):
         return dict(zip(rows[0].keys(), rows[0]))
 
 def get_users(role=None, status=None):
-    "Get the users optionally specified by role and status."
+    """Yield the users optionally specified by role and status,
+    directly from the database cursor.
+    """
     assert role is None or role in constants.USER_ROLES
     assert status is None or status in constants.USER_STATUSES
     cursor = flask.g.db.cursor()
@@ -451,29 +541,146 @@ def get_users(role=None, status=None):
     else:
         rows = cursor.execute(f"SELECT {','.join(KEYS)} FROM users"
                               " WHERE role=? AND status=?", (role, status))
-    return [dict(zip(row.keys(), row)) for row in rows]
+    for row in rows:
+        yield dict(zip(row.keys(), row))
+
+def get_usernames(iuids):
+    "Return a dictionary of the usernames for the given user iuids."
+    iuids = list(iuids)
+    if not iuids: return {}
+    cursor = flask.g.db.execute("SELECT iuid, username FROM users WHERE iuid"
+                                f" IN ({','.join('?' * len(iuids))})", iuids)
+    return dict((row[0], row[1]) for row in cursor)
+
+def get_users_page(limit, after=None):
+    """Return a page of at most 'limit' users sorted by username, starting
+    after the given username, if any. Also return the username to start
+    the next page after, or None if there are no more users.
+    """
+    sql = [f"SELECT {','.join(KEYS)} FROM users"]
+    params = []
+    if after:
+        sql.append("WHERE username > ? COLLATE NOCASE")
+        params.append(after)
+    sql.append("ORDER BY username COLLATE NOCASE LIMIT ?")
+    params.append(limit + 1)
+    cursor = flask.g.db.execute(" ".join(sql), params)
+    users = [dict(zip(row.keys(), row)) for row in cursor]
+    if len(users) > limit:
+        users = users[:limit]
+        return users, users[-1]["username"]
+    return users, None
+
+def query_users(search=None, order="username", descending=False,
+                offset=0, limit=None):
+    """Yield the users having the search string in the username or email,
+    sorted by the given column, skipping 'offset' and at most 'limit'.
+    """
+    assert order in KEYS
+    sql = [f"SELECT {','.join(KEYS)} FROM users"]
+    params = []
+    if search:
+        sql.append(SEARCH_SQL)
+        params.extend([_like_pattern(search)] * 2)
+    if order in ("username", "email"):
+        order += " COLLATE NOCASE"
+    direction = "DESC" if descending else "ASC"
+    sql.append(f"ORDER BY {order} {direction}, iuid {direction}")
+    sql.append("LIMIT ? OFFSET ?")
+    params.extend([-1 if limit is None else limit, offset])
+    cursor = flask.g.db.execute(" ".join(sql), params)
+    for row in cursor:
+        yield dict(zip(row.keys(), row))
+
+def count_users(search=None):
+    "Return the number of users having the search string, if given."
+    if search:
+        cursor = flask.g.db.execute("SELECT COUNT(*) FROM users "
+                                    + SEARCH_SQL,
+                                    [_like_pattern(search)] * 2)
+    else:
+        cursor = flask.g.db.execute("SELECT COUNT(*) FROM users")
+    return cursor.fetchone()[0]
+
+def _like_pattern(search):
+    "Return the LIKE pattern for the search string; escape wildcards."
+    for c in "\\%_":
+        search = search.replace(c, "\\" + c)
+    return f"%{search}%"
 
 def get_current_user():
     """Return the user for the current session.
     Return None if no such user, or disabled.
+    Use the user cache, if enabled.
     """
-    user = get_user(username=flask.session.get("username"),
-                    apikey=flask.request.headers.get("x-apikey"))
+    username = flask.session.get("username")
+    apikey = flask.request.headers.get("x-apikey")
+    if username:
+        key = ("username", username.lower())
+    elif apikey:
+        key = ("apikey", apikey)
+    else:
+        key = None
+    user = None
+    if key:
+        user_cache = get_user_cache()
+        user = user_cache.get(key)
+        if user is None:
+            user = get_user(username=username, apikey=apikey)
+            if user is not None:
+                user_cache.put(key, user)
+        # A copy, since the caller may modify it.
+        if user is not None:
+            user = user.copy()
     if user is None or user["status"] != constants.ENABLED:
         flask.session.pop("username", None)
         return None
     return user
 
+def get_user_cache():
+    """Return the user cache. If shared between processes, first clear it
+    if the users have been modified by another process.
+    """
+    user_cache = flask.current_app.extensions["user_cache"]
+    if flask.current_app.config["USER_CACHE_SHARED"]:
+        cursor = flask.g.db.execute("SELECT value FROM generations"
+                                    " WHERE name='users'")
+        row = cursor.fetchone()
+        user_cache.set_generation(row[0] if row else 0)
+    return user_cache
+
+def invalidate_user_cache(user):
+    """Remove the user from the cache of this process.
+    Must be called after the transaction that modifies the user has been
+    committed; before, another thread may read the old row and cache it.
+    """
+    flask.current_app.extensions["user_cache"].remove_if(
+        lambda u: u["iuid"] == user["iuid"])
+
+def signal_users_modified():
+    """If the cache is shared, increment the generation to signal
+    the other processes. Called within the transaction that modifies
+    the user.
+    """
+    if flask.current_app.config["USER_CACHE_SHARED"]:
+        flask.g.db.execute("INSERT INTO generations (name, value)"
+                           " VALUES ('users', 1)"
+                           " ON CONFLICT (name) DO UPDATE"
+                           " SET value=value+1")
+
 def do_login(username, password):
     """Set the session cookie if successful login.
     Raise ValueError if some problem.
     """
     user = get_user(username=username)
     if user is None: raise ValueError
-    if not check_password_hash(user["password"], password):
+    if not hashing.check(user["password"], password):
         raise ValueError
     if user["status"] != constants.ENABLED:
         raise ValueError
+    if hashing.needs_rehash(user["password"]):
+        with UserSaver(user) as saver:
+            saver.set_password(password)
     flask.session["username"] = user["username"]
     flask.session.permanent = True
     utils.get_logger().info(f"logged in {user['username']}")
@@ -487,7 +694,7 @@ def send_password_code(user, action):
                         username=user["username"],
                         code=user["password"][len("code:"):])
     message.body = f"To set your password, go to {url}"
-    utils.mail.send(message)
+    jobs.send_mail(message)
 
 def is_empty(user):
     "Is the given user account empty? No data associated with it."
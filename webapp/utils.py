@@ -1,10 +1,11 @@
 "Various utility functions and classes."
 
+import contextlib
 import datetime
 import functools
+import hashlib
 import http.client
 import json
-import logging
 import sqlite3
 import time
 import uuid
@@ -14,63 +15,44 @@ import flask_mail
 import jinja2.utils
 import werkzeug.routing
 
+from webapp import applog
+from webapp import archive
 from webapp import constants
+from webapp import jsoncodec
+from webapp import logstore
+from webapp import metrics
+from webapp import pool
+from webapp import profiler
 
 def init(app):
     """Initialize app.
     - Add template filters.
-    - Create the logs table in the database.
+    - Select the JSON backend.
+    - Set up the pool of database connections; timed or profiled,
+      with the SQL function for decoding compact log diffs.
     """
     app.add_template_filter(thousands)
     app.add_template_filter(tojson2)
-    db = get_db(app)
-    with db:
-        db.execute("CREATE TABLE IF NOT EXISTS logs"
-                   "(iuid TEXT PRIMARY KEY,"
-                   " docid TEXT NOT NULL,"
-                   " diff TEXT NOT NULL,"
-                   " username TEXT,"
-                   " remote_addr TEXT,"
-                   " user_agent TEXT,"
-                   " timestamp TEXT NOT NULL)")
-        db.execute("CREATE INDEX IF NOT EXISTS"
-                   " logs_docid_index ON logs (docid)")
-
-# Global logger instance.
-_logger = None
-def get_logger():
-    global _logger
-    if _logger is None:
-        config = flask.current_app.config
-        _logger = logging.getLogger(config["LOG_NAME"])
-        if config["LOG_DEBUG"]:
-            _logger.setLevel(logging.DEBUG)
-        else:
-            _logger.setLevel(logging.WARNING)
-        if config["LOG_FILEPATH"]:
-            if config["LOG_ROTATING"]:
-                loghandler = logging.TimedRotatingFileHandler(
-                    config["LOG_FILEPATH"],
-                    when="midnight",
-                    backupCount=config["LOG_ROTATING"])
-            else:
-                loghandler = logging.FileHandler(config["LOG_FILEPATH"])
-        else:
-            loghandler = logging.StreamHandler()
-        loghandler.setFormatter(logging.Formatter(config["LOG_FORMAT"]))
-        _logger.addHandler(loghandler)
-    return _logger
-
-def log_access(response):
-    "Record access using the logger."
-    if flask.g.current_user:
-        username = flask.g.current_user["username"]
+    jsoncodec.init(app)
+    if app.config["SQLITE3_PROFILER"]:
+        profiler.init(app)
+        factory = profiler.Connection
+    elif app.config["METRICS"]:
+        factory = metrics.Connection
     else:
-        username = None
-    get_logger().debug(f"{flask.request.remote_addr} {username}"
-                       f" {flask.request.method} {flask.request.path}"
-                       f" {response.status_code}")
-    return response
+        factory = sqlite3.Connection
+    app.extensions["sqlite3_pool"] = pool.ConnectionPool(
+        app.config["SQLITE3_FILEPATH"],
+        size=app.config["SQLITE3_POOL_SIZE"],
+        timeout=app.config["SQLITE3_POOL_TIMEOUT"],
+        check_interval=app.config["SQLITE3_POOL_CHECK_INTERVAL"],
+        profile=app.config["SQLITE3_PROFILE"],
+        factory=factory,
+        functions=dict(log_decode=(1, logstore.get_diff)))
+
+def get_logger():
+    "Return the logger of the app; see 'applog'."
+    return applog.get_logger()
 
 # Global instance of mail interface.
 mail = flask_mail.Mail()
@@ -229,6 +211,18 @@ def accept_json():
     return best == constants.JSON_MIMETYPE and \
         acc[best] > acc[constants.HTML_MIMETYPE]
 
+def get_limit():
+    """Return the page size from the request argument 'limit',
+    or the default. Bounded by the configured max.
+    """
+    config = flask.current_app.config
+    try:
+        limit = int(flask.request.args["limit"])
+        if limit <= 0: raise ValueError
+    except (KeyError, ValueError):
+        limit = config["PAGE_SIZE"]
+    return min(limit, config["PAGE_MAX_SIZE"])
+
 def get_json(**data):
     "Return the JSON structure after fixing up for external representation."
     result = {"$id": flask.request.url,
@@ -239,31 +233,159 @@ def get_json(**data):
 def jsonify(result, schema_url=None):
     """Return a Response object containing the JSON of 'result'.
     Optionally add a header Link to the schema."""
-    response = flask.jsonify(result)
+    response = flask.Response(jsoncodec.dumps_bytes(result),
+                              mimetype=constants.JSON_MIMETYPE)
     if schema_url:
         response.headers.add("Link", schema_url, rel="schema")
     return response
 
-def get_db(app=None):
-    "Get the connection to the Sqlite3 database file."
+def get_pool(app=None):
+    "Get the pool of connections to the Sqlite3 database file."
     if app is None:
         app = flask.current_app
-    db = sqlite3.connect(app.config["SQLITE3_FILEPATH"])
-    db.row_factory = sqlite3.Row
-    return db
+    return app.extensions["sqlite3_pool"]
+
+def get_etag(*values):
+    "Return an ETag value computed from the string form of the values."
+    data = "\0".join(str(v) for v in values).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()[:32]
+
+def to_datetime(timestamp):
+    "Convert an ISO format timestamp (as from 'get_time') to a datetime."
+    return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+def not_modified(etag, last_modified=None):
+    """Return a 304 Not Modified response if the conditional request headers
+    If-None-Match or If-Modified-Since match the given validators,
+    else None. The 'last_modified' value is an ISO format timestamp.
+    The caller should set the validators of the response.
+    """
+    request = flask.request
+    if request.if_none_match:
+        # Weak comparison, as required for If-None-Match; also matches
+        # a strong ETag made weak when the response was compressed.
+        matched = request.if_none_match.contains_weak(etag)
+    elif last_modified and request.if_modified_since:
+        # HTTP dates have a resolution of seconds.
+        modified = to_datetime(last_modified).replace(microsecond=0)
+        matched = modified <= request.if_modified_since
+    else:
+        matched = False
+    if not matched:
+        return None
+    return flask.Response(status=http.client.NOT_MODIFIED)
+
+def set_validators(response, etag, weak=False, last_modified=None,
+                   max_age=0, private=True):
+    """Set the ETag, Last-Modified and Cache-Control headers of the response.
+    A private response depends on the user, so its cache key varies with
+    the session cookie and the API key.
+    """
+    response.set_etag(etag, weak=weak)
+    if last_modified:
+        response.last_modified = to_datetime(last_modified)
+    if private:
+        response.cache_control.private = True
+        response.vary.update(["Cookie", "X-APIKey"])
+    else:
+        response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
 
-def get_logs(docid):
+def get_db(app=None):
+    """Get a connection to the Sqlite3 database file from the pool.
+    It must be returned to the pool using 'release_db'.
+    """
+    return get_pool(app).acquire()
+
+def release_db(exception=None):
+    "Return the connection of the current context, if any, to the pool."
+    db = flask.g.pop("db", None)
+    if db is not None:
+        get_pool().release(db)
+
+@contextlib.contextmanager
+def connection(app=None):
+    "Context manager for a connection from the pool, outside of a request."
+    db = get_db(app)
+    try:
+        yield db
+    finally:
+        get_pool(app).release(db)
+
+@contextlib.contextmanager
+def immediate(db):
+    """Context manager for a transaction started explicitly, to lock out
+    other writers; committed at exit. If the connection is already within
+    a transaction, that one is used, and is not committed here.
+    """
+    if db.in_transaction:
+        yield db
+    else:
+        db.execute("BEGIN IMMEDIATE")
+        with db:
+            yield db
+
+def get_logs(docid, archived=False):
     """Return the list of log entries for the given document identifier,
-    sorted by reverse timestamp.
+    sorted by reverse timestamp. Include archived entries if 'archived'.
     """
-    cursor = flask.g.db.cursor()
-    cursor.execute("SELECT diff, username,"
-                   " remote_addr, user_agent, timestamp"
-                   " FROM logs WHERE docid=?"
-                   " ORDER BY timestamp DESC", (docid,))
-    result = []
-    for row in cursor:
+    return list(iter_logs(docid, archived=archived))
+
+def get_logs_page(docid, limit, before=None, raw=False, archived=False):
+    """Return a page of at most 'limit' log entries for the given document
+    identifier, sorted by reverse timestamp, starting after the cursor
+    'before', if given. Also return the cursor for the next page,
+    or None if there are no more entries.
+    """
+    logs = list(iter_logs(docid, limit=limit+1, before=before, keys=True,
+                          raw=raw, archived=archived))
+    if len(logs) > limit:
+        logs = logs[:limit]
+        next = f"{logs[-1]['timestamp']},{logs[-1]['key']}"
+    else:
+        next = None
+    for log in logs:
+        log.pop("key")
+    return logs, next
+
+def iter_with_archived(db, rows, docid, limit, before):
+    """Yield the rows from the cursor, and then the archived rows,
+    up to 'limit' rows in total. The archived entries are older than
+    the current, so the order and cursor 'before' still apply.
+    """
+    count = 0
+    for row in rows:
+        count += 1
+        yield row
+    if limit is not None:
+        limit -= count
+    yield from archive.select(db, docid, limit=limit, before=before)
+
+def iter_logs(docid, limit=None, before=None, keys=False, raw=False,
+              db=None, archived=False):
+    """Yield the log entries for the given document identifier, sorted by
+    reverse timestamp, directly from the database cursor.
+    The cursor 'before' is a string 'timestamp,key' for the entry
+    to start after. Include the entry 'key' if 'keys' is true.
+    If 'raw' is true, the diff is not decoded, but given as a RawJSON
+    to be inserted as-is into the JSON output, when that is faster.
+    Use the given connection, or the one for the current request.
+    If 'archived' is true, the archived entries follow the current.
+    """
+    raw = raw and jsoncodec.raw_is_faster()
+    db = db or flask.g.db
+    rows = logstore.select(db, docid, limit=limit, before=before)
+    if archived:
+        rows = iter_with_archived(db, rows, docid, limit, before)
+    for row in rows:
         item = dict(zip(row.keys(), row))
-        item["diff"] = json.loads(item["diff"])
-        result.append(item)
-    return result
+        item.pop("docid")
+        if not keys:
+            item.pop("key")
+        diff = logstore.get_diff(item["diff"])
+        if raw:
+            item["diff"] = jsoncodec.RawJSON(diff)
+        else:
+            item["diff"] = jsoncodec.loads(diff)
+        yield item